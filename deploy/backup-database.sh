@@ -50,4 +50,10 @@ rclone copy --stats 5m --stats-one-line "${DUMP_FILE}" "offsite-backup:${BACKUP_
 echo "  Deleting backups older than 20 days..."
 rclone delete "offsite-backup:${BACKUP_BUCKET}/mataroa-backups" --min-age 20d --rmdirs --include "postgres-mataroa-*/mataroa.dump"
 
+# Copy image files, which never change as they are named by their content
+if [ -n "${IMAGES_ROOT:-}" ] && [ -d "${IMAGES_ROOT}" ]; then
+    echo "  Copying images to ${BACKUP_BUCKET}..."
+    rclone copy --stats 5m --stats-one-line "${IMAGES_ROOT}" "offsite-backup:${BACKUP_BUCKET}/mataroa-images/"
+fi
+
 echo "==> Backup completed successfully!"
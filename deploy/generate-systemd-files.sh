@@ -70,6 +70,14 @@ TEMPLATE_FILES=(
     "mataroa-dailysummary.service"
     "mataroa-renewal.timer"
     "mataroa-renewal.service"
+    "mataroa-feeds.timer"
+    "mataroa-feeds.service"
+    "mataroa-rollups.timer"
+    "mataroa-rollups.service"
+    "mataroa-compaction.timer"
+    "mataroa-compaction.service"
+    "mataroa-partitions.timer"
+    "mataroa-partitions.service"
 )
 
 # Process each template file
@@ -68,6 +68,7 @@ run_remote "
 # 4. Create /var/www directory
 echo "==> Creating /var/www directory..."
 run_remote "mkdir -p /var/www && chown deploy:www-data /var/www && chmod 755 /var/www"
+run_remote "mkdir -p /var/www/mataroa-images && chown deploy:www-data /var/www/mataroa-images"
 
 # 5. Setup PostgreSQL database
 echo "==> Setting up PostgreSQL database..."
@@ -121,6 +122,14 @@ echo "==> Deploying systemd configuration files..."
     mv mataroa-dailysummary.service /etc/systemd/system/
     mv mataroa-renewal.timer /etc/systemd/system/
     mv mataroa-renewal.service /etc/systemd/system/
+    mv mataroa-feeds.timer /etc/systemd/system/
+    mv mataroa-feeds.service /etc/systemd/system/
+    mv mataroa-rollups.timer /etc/systemd/system/
+    mv mataroa-rollups.service /etc/systemd/system/
+    mv mataroa-compaction.timer /etc/systemd/system/
+    mv mataroa-compaction.service /etc/systemd/system/
+    mv mataroa-partitions.timer /etc/systemd/system/
+    mv mataroa-partitions.service /etc/systemd/system/
 
     # Cleanup
     cd /
@@ -156,11 +165,19 @@ run_remote "
     systemctl enable mataroa-backup.timer
     systemctl enable mataroa-dailysummary.timer
     systemctl enable mataroa-renewal.timer
+    systemctl enable mataroa-feeds.timer
+    systemctl enable mataroa-rollups.timer
+    systemctl enable mataroa-compaction.timer
+    systemctl enable mataroa-partitions.timer
     systemctl start mataroa-notifications.timer
     systemctl start mataroa-exports.timer
     systemctl start mataroa-backup.timer
     systemctl start mataroa-dailysummary.timer
     systemctl start mataroa-renewal.timer
+    systemctl start mataroa-feeds.timer
+    systemctl start mataroa-rollups.timer
+    systemctl start mataroa-compaction.timer
+    systemctl start mataroa-partitions.timer
     systemctl start mataroa
     systemctl start caddy
 "
@@ -0,0 +1,20 @@
+# Gunicorn configuration, read from the working directory on startup.
+# https://docs.gunicorn.org/en/stable/settings.html
+
+
+def worker_exit(server, worker):
+    """Save the analytic hits still buffered in the exiting worker."""
+    from django.apps import apps
+
+    if not apps.ready:
+        return  # worker exited before loading the app
+
+    from main import analytics
+
+    analytics.hit_buffer.flush()
+    server.log.info(
+        "Worker %s saved %d analytic hits, dropped %d",
+        worker.pid,
+        analytics.hit_buffer.flushed_count,
+        analytics.hit_buffer.dropped_count,
+    )
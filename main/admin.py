@@ -1,6 +1,7 @@
 from django.conf import settings
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as DjUserAdmin
+from django.utils import timezone
 from django.utils.html import format_html
 
 from main import models, scheme
@@ -8,7 +9,9 @@ from main import models, scheme
 
 @admin.action(description="Mark selected users as approved")
 def make_approved(modeladmin, request, queryset):
-    queryset.update(is_approved=True)
+    # a queryset update sends no post_save, so touch the blogs here, see
+    # signals.touch_user
+    queryset.update(is_approved=True, updated_at=timezone.now())
 
 
 @admin.register(models.User)
@@ -123,6 +126,7 @@ class ImageAdmin(admin.ModelAdmin):
         "name",
         "slug",
         "extension",
+        "size",
         "owner",
         "uploaded_at",
     )
@@ -150,6 +154,39 @@ class AnalyticPostAdmin(admin.ModelAdmin):
     ordering = ["-id"]
 
 
+@admin.register(models.AnalyticPageDay)
+class AnalyticPageDayAdmin(admin.ModelAdmin):
+    list_display = (
+        "id",
+        "user",
+        "path",
+        "date",
+        "count",
+    )
+    ordering = ["-date", "-id"]
+
+
+@admin.register(models.AnalyticPostDay)
+class AnalyticPostDayAdmin(admin.ModelAdmin):
+    list_display = (
+        "id",
+        "post",
+        "date",
+        "count",
+    )
+    ordering = ["-date", "-id"]
+
+
+@admin.register(models.AnalyticBotDay)
+class AnalyticBotDayAdmin(admin.ModelAdmin):
+    list_display = (
+        "id",
+        "date",
+        "count",
+    )
+    ordering = ["-date"]
+
+
 @admin.register(models.Comment)
 class CommentAdmin(admin.ModelAdmin):
     list_display = (
@@ -163,6 +200,12 @@ class CommentAdmin(admin.ModelAdmin):
     )
     ordering = ["-id"]
 
+    def delete_queryset(self, request, queryset):
+        # bulk deletion skips Comment.delete, which touches the blog
+        owner_ids = set(queryset.values_list("post__owner_id", flat=True))
+        super().delete_queryset(request, queryset)
+        models.User.objects.filter(id__in=owner_ids).update(updated_at=timezone.now())
+
 
 @admin.register(models.Notification)
 class NotificationAdmin(admin.ModelAdmin):
@@ -0,0 +1,285 @@
+"""
+Recording of blog visits for the analytics pages.
+
+A hit is a tuple of its kind and arguments:
+* ("post", post_id) for a blog post view
+* ("page", user_id, path) for any other blog page, eg. "index" or "rss"
+
+Hits are buffered in memory of each worker and saved in batches, see
+HitBuffer and the ANALYTICS_BUFFER_* settings.
+
+Hits by bots, see main/bots.py, are only counted per day in AnalyticBotDay.
+Other post hits also add their visitor to the HyperLogLog sketch of the post
+and day, to estimate unique visitors. A visitor is a hash of the client IP address
+and User-Agent, salted with the SECRET_KEY, and only the sketch is saved.
+The salt does not change across days, so that sketches of many days merge
+into the unique visitors of all of them.
+"""
+
+import logging
+import threading
+
+from django.conf import settings
+from django.db import DatabaseError, IntegrityError, connections, transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.crypto import salted_hmac
+
+from main import bots, models
+from main.hyperloglog import HyperLogLog
+
+logger = logging.getLogger(__name__)
+
+# analytic models and the foreign key their hits may outlive
+ANALYTIC_MODELS = {
+    models.AnalyticPost: "post",
+    models.AnalyticPage: "user",
+}
+
+
+def get_address(request):
+    """Return IP address of the client of request."""
+    # behind the reverse proxy, the client address is the last forwarded one
+    forwarded_for = request.META.get("HTTP_X_FORWARDED_FOR", "")
+    address = forwarded_for.rsplit(",", 1)[-1].strip()
+    return address or request.META.get("REMOTE_ADDR", "")
+
+
+def get_visitor(request, address):
+    """Return 64-bit hash identifying the client of request from IP address."""
+    user_agent = request.META.get("HTTP_USER_AGENT", "")
+    digest = salted_hmac("main.analytics.visitor", f"{address}\n{user_agent}")
+    return int.from_bytes(digest.digest()[:8], "big")
+
+
+def make_analytic(kind, *args):
+    """Return unsaved analytic row of a hit."""
+    created_at = timezone.now()
+    if kind == "post":
+        (post_id,) = args
+        return models.AnalyticPost(post_id=post_id, created_at=created_at)
+    elif kind == "page":
+        user_id, path = args
+        return models.AnalyticPage(user_id=user_id, path=path, created_at=created_at)
+    else:
+        raise ValueError(f"Unknown analytic hit kind: {kind}")
+
+
+def _bulk_create(model, analytics):
+    """Insert analytics of model. Returns the number inserted."""
+    try:
+        model.objects.bulk_create(analytics)
+        return len(analytics)
+    except IntegrityError:
+        # the post or user of some hits was deleted since they were buffered
+        field = model._meta.get_field(ANALYTIC_MODELS[model])
+        ids = {getattr(analytic, field.attname) for analytic in analytics}
+        existing_ids = set(
+            field.related_model.objects.filter(id__in=ids).values_list("id", flat=True)
+        )
+        analytics = [a for a in analytics if getattr(a, field.attname) in existing_ids]
+        model.objects.bulk_create(analytics)
+        return len(analytics)
+
+
+def _merge_sketches(sketches):
+    with transaction.atomic():
+        # in order of key, so that concurrent flushes lock rows in one order
+        for (post_id, date), sketch in sorted(sketches.items()):
+            visitors, created = (
+                models.AnalyticPostVisitors.objects.select_for_update().get_or_create(
+                    post_id=post_id, date=date, defaults={"sketch": bytes(sketch)}
+                )
+            )
+            if created:
+                continue
+            merged = HyperLogLog(visitors.sketch)
+            merged.merge(sketch)
+            # repeat visitors do not change the sketch
+            if bytes(merged) != bytes(visitors.sketch):
+                visitors.sketch = bytes(merged)
+                visitors.save(update_fields=["sketch"])
+
+
+def _save_sketches(sketches):
+    """Merge sketches, keyed by (post_id, date), into the saved ones."""
+    if not sketches:
+        return
+    try:
+        _merge_sketches(sketches)
+    except IntegrityError:
+        # the post of some sketches was deleted since they were buffered
+        post_ids = {post_id for post_id, _ in sketches}
+        existing_ids = set(
+            models.Post.objects.filter(id__in=post_ids).values_list("id", flat=True)
+        )
+        _merge_sketches(
+            {key: sketch for key, sketch in sketches.items() if key[0] in existing_ids}
+        )
+
+
+def _save_bot_counts(bot_counts):
+    """Add bot hit counts, keyed by date, to the saved ones."""
+    if not bot_counts:
+        return
+    with transaction.atomic():
+        for date, count in sorted(bot_counts.items()):
+            day, _ = models.AnalyticBotDay.objects.get_or_create(date=date)
+            models.AnalyticBotDay.objects.filter(id=day.id).update(
+                count=F("count") + count
+            )
+
+
+def get_unique_visitors(post_id, since):
+    """
+    Return estimated unique visitors of post since date, as a tuple of a dict
+    of date to visitors of that day and the visitors of all days.
+    """
+    day_visitors = {}
+    total = HyperLogLog()
+    for visitors in models.AnalyticPostVisitors.objects.filter(
+        post_id=post_id, date__gte=since
+    ):
+        sketch = HyperLogLog(visitors.sketch)
+        day_visitors[visitors.date] = sketch.count()
+        total.merge(sketch)
+    return day_visitors, total.count()
+
+
+class HitBuffer:
+    """
+    Hits waiting to be saved, held in memory of each worker.
+
+    Hits are saved with one insert per model once ANALYTICS_BUFFER_SIZE of them
+    are buffered, or ANALYTICS_FLUSH_INTERVAL seconds after the first of them,
+    and when the worker exits (see gunicorn.conf.py). Hits that cannot be
+    buffered because ANALYTICS_BUFFER_MAX are already waiting, eg. while the
+    database is down, are dropped. Visitors of post hits are buffered in one
+    sketch per post and day, merged into the saved sketches on every save.
+    Bot hits are buffered as a count per day.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.analytics = []
+        # visitor sketches of posts, keyed by (post_id, date)
+        self.sketches = {}
+        # bot hits, keyed by date
+        self.bot_counts = {}
+        self.timer = None
+        self.flushed_count = 0
+        self.dropped_count = 0
+
+    def add(self, analytic, visitor=None):
+        with self.lock:
+            if len(self.analytics) >= settings.ANALYTICS_BUFFER_MAX:
+                self.dropped_count += 1
+                return
+            self.analytics.append(analytic)
+            if visitor is not None and isinstance(analytic, models.AnalyticPost):
+                key = (analytic.post_id, analytic.created_at.date())
+                self.sketches.setdefault(key, HyperLogLog()).add(visitor)
+            is_full = self._is_full()
+            if not is_full:
+                self._schedule()
+        if is_full:
+            self.flush()
+
+    def add_bot(self, date):
+        with self.lock:
+            self.bot_counts[date] = self.bot_counts.get(date, 0) + 1
+            is_full = self._is_full()
+            if not is_full:
+                self._schedule()
+        if is_full:
+            self.flush()
+
+    def _is_full(self):
+        hit_count = len(self.analytics) + sum(self.bot_counts.values())
+        return hit_count >= settings.ANALYTICS_BUFFER_SIZE
+
+    def _schedule(self):
+        if self.timer is None:
+            self.timer = threading.Timer(
+                settings.ANALYTICS_FLUSH_INTERVAL, self._flush_on_timer
+            )
+            self.timer.daemon = True
+            self.timer.start()
+
+    def _flush_on_timer(self):
+        try:
+            self.flush()
+        finally:
+            # the timer thread opened database connections of its own
+            connections.close_all()
+
+    def flush(self):
+        """Save all buffered hits. Returns the number saved."""
+        with self.lock:
+            analytics, self.analytics = self.analytics, []
+            sketches, self.sketches = self.sketches, {}
+            bot_counts, self.bot_counts = self.bot_counts, {}
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        if not analytics and not sketches and not bot_counts:
+            return 0
+
+        by_model = {}
+        for analytic in analytics:
+            by_model.setdefault(type(analytic), []).append(analytic)
+        pending = list(by_model.items())
+
+        saved_count = dropped_count = 0
+        try:
+            while pending:
+                model, model_analytics = pending[0]
+                count = _bulk_create(model, model_analytics)
+                saved_count += count
+                dropped_count += len(model_analytics) - count
+                pending.pop(0)
+            # merging sketches again is harmless, adding bot counts again is not
+            _save_sketches(sketches)
+            _save_bot_counts(bot_counts)
+        except DatabaseError:
+            logger.exception("Saving analytic hits failed")
+            unsaved = [analytic for _, items in pending for analytic in items]
+            with self.lock:
+                # keep unsaved hits for the next flush, within the buffer limit
+                buffered = unsaved + self.analytics
+                self.analytics = buffered[: settings.ANALYTICS_BUFFER_MAX]
+                dropped_count += len(buffered) - len(self.analytics)
+                for key, sketch in sketches.items():
+                    self.sketches.setdefault(key, HyperLogLog()).merge(sketch)
+                for date, count in bot_counts.items():
+                    self.bot_counts[date] = self.bot_counts.get(date, 0) + count
+                self._schedule()
+
+        if dropped_count:
+            logger.warning("Analytic hits dropped: %d", dropped_count)
+        with self.lock:
+            self.flushed_count += saved_count
+            self.dropped_count += dropped_count
+        return saved_count
+
+
+hit_buffer = HitBuffer()
+
+
+def save_hit(request, kind, *args):
+    """Save a visit of request, or count it if by a bot."""
+    address = get_address(request)
+    if bots.is_bot(request, address):
+        hit_buffer.add_bot(timezone.now().date())
+    else:
+        analytic = make_analytic(kind, *args)
+        hit_buffer.add(analytic, get_visitor(request, address))
+
+
+def record_hit(request, kind, *args):
+    """
+    Record a visit, also noting it on the request so that the page cache can
+    record it again whenever it serves the same response.
+    """
+    request.analytic_hit = (kind, *args)
+    save_hit(request, kind, *args)
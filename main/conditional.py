@@ -0,0 +1,121 @@
+"""
+Conditional GET for public blog views: responses carry an ETag and
+Last-Modified of the whole blog, and revalidations are answered with 304
+before the view runs.
+"""
+
+import calendar
+import functools
+import hashlib
+from datetime import datetime
+
+from django.db.models import Max, Subquery
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+
+from main import analytics, models, pagecache
+
+
+def _latest(queryset, field):
+    return Subquery(
+        queryset.order_by()
+        .values("owner_id")
+        .annotate(latest=Max(field))
+        .values("latest")
+    )
+
+
+def get_blog_state(user_id):
+    """
+    Return tuple of when anything shown on a blog last changed and dict of the
+    values of its pagecache.THEME_FIELDS, or None if there is no such blog.
+    The last change is taken from the timestamps of its user, posts and pages.
+    Deletions and comment changes touch the user's updated_at (see signals),
+    and a scheduled post counts as changed on the day it gets published.
+    """
+    posts = models.Post.objects.filter(owner_id=user_id)
+    pages = models.Page.objects.filter(owner_id=user_id)
+    published_posts = posts.filter(published_at__lte=timezone.now().date())
+    blog = (
+        models.User.objects.filter(id=user_id)
+        .annotate(
+            posts_updated_at=_latest(posts, "updated_at"),
+            published_at=_latest(published_posts, "published_at"),
+            pages_updated_at=_latest(pages, "updated_at"),
+        )
+        .values(
+            "updated_at",
+            "posts_updated_at",
+            "published_at",
+            "pages_updated_at",
+            *pagecache.THEME_FIELDS,
+        )
+        .first()
+    )
+    if blog is None:
+        return None
+    published_at = blog["published_at"]
+    if published_at:
+        published_at = datetime.combine(published_at, datetime.min.time())
+    last_modified = max(
+        timestamp
+        for timestamp in (
+            blog["updated_at"],
+            blog["posts_updated_at"],
+            published_at,
+            blog["pages_updated_at"],
+        )
+        if timestamp
+    )
+    themes = {field: blog[field] for field in pagecache.THEME_FIELDS}
+    return last_modified, themes
+
+
+def blog_conditional(get_hit=None):
+    """
+    Make a blog view answer conditional requests of anonymous visitors.
+    get_hit(request, *args, **kwargs) returns the analytic hit the view would
+    record (see analytics), so that it is recorded on 304 responses too.
+    """
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            # pages look different for logged in users, so only anonymous
+            # responses get validators, same as the page cache
+            if not pagecache.is_cacheable(request):
+                return view(request, *args, **kwargs)
+
+            state = get_blog_state(request.blog_user_id)
+            if state is None:
+                return view(request, *args, **kwargs)
+            last_modified, themes = state
+            # the page cache keys pages by both, and pages are rendered with
+            # these themes rather than the cached ones of host_middleware
+            request.blog_last_modified = last_modified
+            for field, value in themes.items():
+                setattr(request, field, value)
+            timestamp = calendar.timegm(last_modified.utctimetuple())
+            # the date is part of the etag as the post lists change with it
+            validator = f"{last_modified.isoformat()}:{timezone.now().date()}"
+            etag = quote_etag(hashlib.sha256(validator.encode()).hexdigest()[:32])
+
+            response = get_conditional_response(
+                request, etag=etag, last_modified=timestamp
+            )
+            if response is not None:
+                hit = get_hit(request, *args, **kwargs) if get_hit else None
+                if hit and response.status_code == 304:
+                    analytics.save_hit(request, *hit)
+                return response
+
+            response = view(request, *args, **kwargs)
+            if response.status_code == 200:
+                response["ETag"] = etag
+                response["Last-Modified"] = http_date(timestamp)
+            return response
+
+        return wrapper
+
+    return decorator
@@ -1,50 +1,92 @@
+"""
+RSS feeds of blogs. The feed document of each blog is generated on first poll
+and stored in Feed, dropped when the blog or its posts change (see signals),
+and regenerated when a scheduled post gets published (see the rolloverfeeds
+command).
+"""
+
 from datetime import datetime
 
-from django.contrib.syndication.views import Feed
-from django.http import Http404
-from django.utils import timezone
+from django.conf import settings
+from django.db.models import Min
+from django.http import Http404, HttpResponse
+from django.urls import reverse
+from django.utils import feedgenerator, timezone
+
+from main import analytics, conditional, models, scheme
+
+FEED_LENGTH = 100
 
-from main import models
 
+def generate_feed(user):
+    """Return RSS document of the latest published posts of user."""
+    feed = feedgenerator.Rss201rev2Feed(
+        title=user.blog_title,
+        link=user.blog_url,
+        description=user.blog_byline_as_text,
+        language=settings.LANGUAGE_CODE,
+        feed_url=user.blog_url + reverse("rss_feed"),
+    )
+    posts = (
+        models.Post.objects.filter(
+            owner=user,
+            published_at__isnull=False,
+            published_at__lte=timezone.now().date(),
+        )
+        .select_related("owner")
+        .order_by("-published_at")[:FEED_LENGTH]
+    )
+    for post in posts:
+        link = scheme.get_protocol() + post.get_proper_url()
+        feed.add_item(
+            title=post.title,
+            link=link,
+            description=post.body_as_html,
+            unique_id=link,
+            # set time to 00:00 because we don't store time for published_at field
+            pubdate=timezone.make_aware(
+                datetime.combine(post.published_at, datetime.min.time())
+            ),
+        )
+    return feed.writeString("utf-8")
 
-class RSSBlogFeed(Feed):
-    title = ""
-    link = ""
-    description = ""
-    user = None
 
-    def __call__(self, request, *args, **kwargs):
-        if not hasattr(request, "subdomain"):
-            raise Http404()
-        self.user = models.User.objects.get(username=request.subdomain)
-        self.title = self.user.blog_title
-        self.description = self.user.blog_byline_as_text
-        self.link = self.user.blog_url
+def update_feed(user):
+    """Generate and store the feed document of user. Returns the document."""
+    document = generate_feed(user)
+    stale_on = models.Post.objects.filter(
+        owner=user, published_at__gt=timezone.now().date()
+    ).aggregate(Min("published_at"))["published_at__min"]
+    models.Feed.objects.update_or_create(
+        owner_id=user.id, defaults={"document": document, "stale_on": stale_on}
+    )
+    return document
 
-        models.AnalyticPage.objects.create(user=self.user, path="rss")
 
-        return super().__call__(request, *args, **kwargs)
+def invalidate_feed(user_id):
+    """Drop the stored feed document of a blog, to be generated on next poll."""
+    models.Feed.objects.filter(owner_id=user_id).delete()
 
-    def items(self):
-        return (
-            models.Post.objects.filter(
-                owner=self.user,
-                published_at__isnull=False,
-                published_at__lte=timezone.now().date(),
-            )
-            .select_related("owner")
-            .order_by("-published_at")[:100]
-        )
 
-    def item_title(self, item):
-        return item.title
+@conditional.blog_conditional(
+    get_hit=lambda request: ("page", request.blog_user_id, "rss")
+)
+def rss_feed(request):
+    if not hasattr(request, "subdomain"):
+        raise Http404()
 
-    def item_link(self, item):
-        return item.get_proper_url()
+    feed = (
+        models.Feed.objects.filter(owner_id=request.blog_user_id)
+        .values_list("document", "stale_on")
+        .first()
+    )
+    if feed is None or (feed[1] and feed[1] <= timezone.now().date()):
+        document = update_feed(request.blog_user)
+    else:
+        document = feed[0]
 
-    def item_description(self, item):
-        return item.body_as_html
+    analytics.record_hit(request, "page", request.blog_user_id, "rss")
 
-    def item_pubdate(self, item):
-        # set time to 00:00 because we don't store time for published_at field
-        return datetime.combine(item.published_at, datetime.min.time())
+    return HttpResponse(
+        document, content_type=feedgenerator.Rss201rev2Feed.content_type
+    )
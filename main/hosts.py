@@ -0,0 +1,148 @@
+"""
+Resolution of request hosts to the blog they serve, cached in-process with a
+TTL (see the "hosts" cache in settings) so that blog requests do not need a
+query to find their blog user.
+
+Also keeps the set of all served domains in memory, for domain_check.
+"""
+
+import hashlib
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import timezone
+
+from main import models
+
+# fields of the blog user needed before a request reaches a view
+BLOG_FIELDS = [
+    "id",
+    "username",
+    "custom_domain",
+    "redirect_domain",
+    "theme_zialucia",
+    "theme_sansserif",
+]
+
+
+def _get_key(host):
+    # host header is user input, so hash it into a key valid for any backend
+    return "host:" + hashlib.sha256(host.encode("utf-8", "surrogatepass")).hexdigest()
+
+
+def get_subdomain_host(username):
+    return f"{username}.{settings.CANONICAL_HOST}"
+
+
+def resolve(host, **lookup):
+    """
+    Return dict of BLOG_FIELDS of the user matching lookup, or None if there is
+    no such user. Both outcomes are cached under host.
+    """
+    cache = caches["hosts"]
+    key = _get_key(host)
+    blog = cache.get(key)
+    if blog is None:
+        # empty dict marks a host with no blog, as None cannot be told apart
+        # from a cache miss
+        blog = models.User.objects.filter(**lookup).values(*BLOG_FIELDS).first() or {}
+        cache.set(key, blog)
+    return blog or None
+
+
+def invalidate_blog(username, custom_domain=None):
+    """Forget resolutions of the hosts a blog is served on."""
+    hosts = [get_subdomain_host(username)]
+    if custom_domain:
+        hosts.append(custom_domain)
+    caches["hosts"].delete_many([_get_key(host) for host in hosts])
+
+
+class DomainSet:
+    """
+    Usernames and custom domains of all users, held in memory of each worker.
+
+    Loaded on first use, then refreshed at most every refresh_interval with
+    the users updated since the last refresh, so that lookups need no query.
+    Renamed and deleted users only leave the set on the full reload every
+    reload_interval, which is fine for on-demand TLS: a stale name just gets
+    a certificate it won't use.
+    """
+
+    refresh_interval = 5  # seconds
+    reload_interval = 600  # seconds
+    # rows saved in transactions that commit late can carry an updated_at
+    # older than the watermark, so refreshes look back a bit further
+    watermark_overlap = timedelta(minutes=1)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.usernames = set()
+        self.custom_domains = set()
+        # time the last refresh started at, by the app clock that also sets
+        # updated_at (auto_now), so that both are compared on one clock
+        self.watermark = None
+        self.loaded_at = None
+        self.refreshed_at = None
+
+    def has_username(self, username):
+        self.refresh()
+        return username in self.usernames
+
+    def has_custom_domain(self, domain):
+        self.refresh()
+        return domain in self.custom_domains
+
+    def add(self, username, custom_domain=None):
+        """Add a user's domains ahead of the next refresh."""
+        if self.loaded_at is None:
+            return  # not loaded, will be read from the database anyway
+        self.usernames.add(username)
+        if custom_domain:
+            self.custom_domains.add(custom_domain)
+
+    def _is_due(self, now):
+        return (
+            self.refreshed_at is None
+            or now - self.refreshed_at >= self.refresh_interval
+        )
+
+    def refresh(self):
+        if not self._is_due(time.monotonic()):
+            return
+        with self.lock:
+            now = time.monotonic()
+            if not self._is_due(now):
+                return  # refreshed by another thread meanwhile
+
+            watermark = timezone.now()
+            users = models.User.objects.values_list("username", "custom_domain")
+            if self.loaded_at is None or now - self.loaded_at >= self.reload_interval:
+                usernames, custom_domains = set(), set()
+                self.loaded_at = now
+            else:
+                users = users.filter(
+                    updated_at__gte=self.watermark - self.watermark_overlap
+                )
+                usernames, custom_domains = self.usernames, self.custom_domains
+
+            for username, custom_domain in users.iterator():
+                usernames.add(username)
+                if custom_domain:
+                    custom_domains.add(custom_domain)
+
+            # a reload builds new sets and swaps them in whole, so that
+            # readers never see them partially built
+            self.usernames = usernames
+            self.custom_domains = custom_domains
+            self.watermark = watermark
+            self.refreshed_at = now
+
+
+domain_set = DomainSet()
@@ -0,0 +1,55 @@
+"""
+HyperLogLog sketches, estimating the number of distinct values added to them
+in a fixed amount of memory, see Flajolet et al. "HyperLogLog: the analysis of
+a near-optimal cardinality estimation algorithm".
+
+Values are 64-bit hashes. A sketch of PRECISION 10 takes 1 KiB and estimates
+with a standard error of about 3%. Sketches merge without loss, so the
+sketch of many days is the merge of the sketches of each day.
+"""
+
+import math
+
+PRECISION = 10
+REGISTER_COUNT = 1 << PRECISION
+RANK_BITS = 64 - PRECISION
+ALPHA = 0.7213 / (1 + 1.079 / REGISTER_COUNT)
+
+
+class HyperLogLog:
+    def __init__(self, registers=None):
+        if registers is None:
+            registers = bytes(REGISTER_COUNT)
+        if len(registers) != REGISTER_COUNT:
+            raise ValueError(
+                f"Expected {REGISTER_COUNT} registers, got {len(registers)}"
+            )
+        self.registers = bytearray(registers)
+
+    def add(self, value):
+        """Add 64-bit hash value."""
+        index = value >> RANK_BITS
+        # position of the leftmost 1 bit of the remaining bits
+        rank = RANK_BITS - (value & ((1 << RANK_BITS) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        """Add all values of sketch other."""
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self):
+        """Return estimated number of distinct values added."""
+        estimate = (
+            ALPHA
+            * REGISTER_COUNT**2
+            / sum(2.0**-register for register in self.registers)
+        )
+        zero_count = self.registers.count(0)
+        if estimate <= 2.5 * REGISTER_COUNT and zero_count:
+            # linear counting is more accurate for few values
+            estimate = REGISTER_COUNT * math.log(REGISTER_COUNT / zero_count)
+        return round(estimate)
+
+    def __bytes__(self):
+        return bytes(self.registers)
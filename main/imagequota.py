@@ -0,0 +1,53 @@
+"""
+Image storage quota of users, checked against the totals of ImageUsage so that
+no upload needs to add up the sizes of all images of a user.
+"""
+
+from django.db import transaction
+from django.db.models import Count, F, Sum
+
+from main import models
+
+QUOTA_BYTES = 1_000_000_000
+
+
+def lock_usage(user_id):
+    """
+    Return the ImageUsage of user, locked until the end of the transaction, so
+    that concurrent uploads check the quota one after the other.
+    """
+    models.ImageUsage.objects.get_or_create(owner_id=user_id)
+    return models.ImageUsage.objects.select_for_update().get(owner_id=user_id)
+
+
+def add_usage(user_id, size, count):
+    """Add size bytes and count images to the usage of user."""
+    usage = models.ImageUsage.objects.filter(owner_id=user_id)
+    updated = usage.update(
+        total_bytes=F("total_bytes") + size, image_count=F("image_count") + count
+    )
+    # only added images create the usage, as a user being deleted has no more
+    # usage when their images are deleted along with them
+    if not updated and count > 0:
+        models.ImageUsage.objects.get_or_create(owner_id=user_id)
+        usage.update(
+            total_bytes=F("total_bytes") + size, image_count=F("image_count") + count
+        )
+
+
+def reconcile(user_id):
+    """
+    Recompute the usage of user from their images. Returns tuple of the usage
+    before and after, as (total_bytes, image_count) tuples.
+    """
+    with transaction.atomic():
+        usage = lock_usage(user_id)
+        before = (usage.total_bytes, usage.image_count)
+        totals = models.Image.objects.filter(owner_id=user_id).aggregate(
+            total_bytes=Sum("size", default=0), image_count=Count("id")
+        )
+        usage.total_bytes = totals["total_bytes"]
+        usage.image_count = totals["image_count"]
+        if (usage.total_bytes, usage.image_count) != before:
+            usage.save()
+    return before, (usage.total_bytes, usage.image_count)
@@ -0,0 +1,63 @@
+"""
+References of posts to the images in their bodies, kept in PostImage so that
+the posts using an image, or the images no post uses, are found with a query
+instead of by searching the bodies of all posts.
+"""
+
+import re
+
+from main import models
+
+# an image URL, eg. /images/a1b2c3d4.jpeg or a variant /images/a1b2c3d4.w640.webp
+IMAGE_URL_RE = re.compile(r"/images/([-a-zA-Z0-9_]+)\.")
+
+
+def get_image_slugs(body):
+    """Return set of slugs of the images body refers to."""
+    if not body:
+        return set()
+    return set(IMAGE_URL_RE.findall(body))
+
+
+def update(post_bodies):
+    """
+    Bring the image references of posts up to date with their bodies, given as
+    dict of post id to body. Returns tuple of references added and removed.
+    """
+    slugs_by_post = {
+        post_id: get_image_slugs(body) for post_id, body in post_bodies.items()
+    }
+    slugs = set().union(*slugs_by_post.values())
+    image_ids = dict(
+        models.Image.objects.filter(slug__in=slugs).values_list("slug", "id")
+        if slugs
+        else []
+    )
+    references = {
+        (post_id, image_ids[slug])
+        for post_id, post_slugs in slugs_by_post.items()
+        for slug in post_slugs
+        if slug in image_ids
+    }
+
+    existing = {
+        (post_id, image_id): reference_id
+        for reference_id, post_id, image_id in models.PostImage.objects.filter(
+            post_id__in=post_bodies
+        ).values_list("id", "post_id", "image_id")
+    }
+    removed_ids = [
+        reference_id
+        for reference, reference_id in existing.items()
+        if reference not in references
+    ]
+    if removed_ids:
+        models.PostImage.objects.filter(id__in=removed_ids).delete()
+    added = [
+        models.PostImage(post_id=post_id, image_id=image_id)
+        for post_id, image_id in references
+        if (post_id, image_id) not in existing
+    ]
+    # saved concurrently by another request, or backfilled meanwhile
+    models.PostImage.objects.bulk_create(added, ignore_conflicts=True)
+    return len(added), len(removed_ids)
@@ -0,0 +1,117 @@
+"""
+Storage of image files, named by the SHA-256 hash of their content.
+
+Files are kept in the "images" storage of the STORAGES setting, a local
+directory by default. Any Django storage backend can take its place, eg. the
+S3 one of django-storages for an S3-compatible object storage.
+
+Files are shared by all images of the same content, and only deleted once no
+image has it (see models.Image.delete_unused_file). Storing a file and
+deleting it lock its content in the database until the end of the
+transaction, so that an upload of the content cannot end up without its file
+when the last other image of it is deleted concurrently.
+"""
+
+import hashlib
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import storages
+from django.db import connection
+
+
+def get_storage():
+    return storages["images"]
+
+
+def get_name(sha256):
+    # nested directories keep the number of files per directory low
+    return f"{sha256[:2]}/{sha256[2:4]}/{sha256}"
+
+
+def get_variant_name(sha256, variant):
+    """Name of a variant of a file, eg. a resized image, stored next to it."""
+    return f"{get_name(sha256)}.{variant}"
+
+
+def get_lock_key(sha256):
+    """Return key of the advisory lock of the content of sha256."""
+    return int.from_bytes(bytes.fromhex(sha256[:16]), signed=True)
+
+
+def get_sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def lock(*sha256s):
+    """
+    Lock the contents of sha256s until the end of the transaction. They are
+    locked in order, so that transactions storing several cannot deadlock.
+    """
+    with connection.cursor() as cursor:
+        for sha256 in sorted(set(sha256s)):
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", [get_lock_key(sha256)])
+
+
+def _save_as(name, data):
+    """Store data as name, unless stored already. Returns whether stored."""
+    storage = get_storage()
+    if storage.exists(name):
+        return False
+    saved_name = storage.save(name, ContentFile(data))
+    if saved_name != name:
+        # stored concurrently with the same content, under name
+        storage.delete(saved_name)
+        return False
+    return True
+
+
+def store(data):
+    """
+    Store image file data, unless a file of the same content is stored
+    already. Returns tuple of its SHA-256 and whether it was stored. Must run
+    in the transaction that saves the image of data, see lock.
+    """
+    sha256 = get_sha256(data)
+    lock(sha256)
+    return sha256, _save_as(get_name(sha256), data)
+
+
+def save(data):
+    """Store image file data, unless stored already. Returns its SHA-256."""
+    sha256, _ = store(data)
+    return sha256
+
+
+def save_variant(sha256, variant, data):
+    _save_as(get_variant_name(sha256, variant), data)
+
+
+def has_variant(sha256, variant):
+    return get_storage().exists(get_variant_name(sha256, variant))
+
+
+def open_file(sha256):
+    return get_storage().open(get_name(sha256), "rb")
+
+
+def open_variant(sha256, variant):
+    """Return binary file object of variant of file, or None if not stored."""
+    try:
+        return get_storage().open(get_variant_name(sha256, variant), "rb")
+    except FileNotFoundError:
+        return None
+
+
+def delete(sha256):
+    """Delete file along with its variants."""
+    storage = get_storage()
+    name = get_name(sha256)
+    storage.delete(name)
+    directory, filename = name.rsplit("/", 1)
+    try:
+        _, filenames = storage.listdir(directory)
+    except FileNotFoundError:
+        return
+    for variant_filename in filenames:
+        if variant_filename.startswith(f"{filename}."):
+            storage.delete(f"{directory}/{variant_filename}")
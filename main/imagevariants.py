@@ -0,0 +1,125 @@
+"""
+Smaller variants of images, resized to a width and encoded in a format,
+generated on first request and kept in the image storage next to the original.
+
+A variant is requested as images/<slug>.w<width>.<extension>, with width one
+of WIDTHS and extension either the one of the image, when the format is chosen
+from the Accept header of the request, or one of MODERN_FORMATS.
+
+Variants are made with Pillow, which is optional. Without it, and for images it
+does not resize, eg. GIF animations and SVG, the variant is the original image.
+Images Pillow fails to make a variant of get an empty marker file stored in
+place of the variant, so that they are not decoded again on every request.
+"""
+
+import io
+
+from main import imagestore
+
+try:
+    from PIL import Image as PILImage
+    from PIL import ImageOps
+except ImportError:
+    PILImage = None
+
+WIDTHS = (320, 640, 1280)
+
+# formats variants are made from and encoded in, by extension
+FORMATS = {
+    "jpeg": ("JPEG", {"quality": 82, "optimize": True}),
+    "png": ("PNG", {"optimize": True}),
+    "webp": ("WEBP", {"quality": 80, "method": 5}),
+    "avif": ("AVIF", {"quality": 60}),
+}
+
+# in order of preference when the Accept header allows them
+MODERN_FORMATS = ("avif", "webp")
+
+
+def can_encode(extension):
+    if PILImage is None or extension not in FORMATS:
+        return False
+    PILImage.init()
+    return FORMATS[extension][0] in PILImage.SAVE
+
+
+def negotiate(extension, accept):
+    """
+    Return extension of the format to serve a variant of an image of extension
+    in, for a request with Accept header accept.
+    """
+    for modern_extension in MODERN_FORMATS:
+        if f"image/{modern_extension}" in accept and can_encode(modern_extension):
+            return modern_extension
+    return extension
+
+
+def get_variant_name(width, extension):
+    return f"w{width}.{extension}"
+
+
+def get_failed_name(variant):
+    """Name of the marker of a variant that could not be made."""
+    return f"{variant}.failed"
+
+
+def make(image_file, width, extension):
+    """
+    Return data of the image in image_file resized to width at most and encoded
+    in the format of extension, or None if Pillow cannot.
+    """
+    if not can_encode(extension):
+        return None
+    try:
+        with PILImage.open(image_file) as source:
+            if source.format not in {name for name, _ in FORMATS.values()}:
+                return None
+            if getattr(source, "is_animated", False):
+                return None
+            icc_profile = source.info.get("icc_profile")
+            picture = ImageOps.exif_transpose(source)
+            picture.thumbnail((width, picture.height))
+            has_alpha = "A" in picture.getbands() or "transparency" in picture.info
+            if extension == "jpeg":
+                picture = picture.convert("RGB")
+            elif picture.mode not in ("RGB", "RGBA", "L", "LA"):
+                picture = picture.convert("RGBA" if has_alpha else "RGB")
+            output = io.BytesIO()
+            format_name, options = FORMATS[extension]
+            if icc_profile:
+                options = {**options, "icc_profile": icc_profile}
+            picture.save(output, format_name, **options)
+            return output.getvalue()
+    except (OSError, ValueError, PILImage.DecompressionBombError):
+        # not an image Pillow can read, whatever its extension says
+        return None
+
+
+def open_variant(image, width, extension):
+    """
+    Return tuple of binary file object and size of the variant of image, made
+    on first request, or None if image has no such variant.
+    """
+    # images still in the database have no variants until moved
+    if not image.sha256:
+        return None
+    variant = get_variant_name(width, extension)
+    variant_file = imagestore.open_variant(image.sha256, variant)
+    if variant_file is not None:
+        return variant_file, variant_file.size
+
+    if image.extension not in FORMATS or not can_encode(extension):
+        return None
+    if imagestore.has_variant(image.sha256, get_failed_name(variant)):
+        return None
+    with image.open() as image_file:
+        data = make(image_file, width, extension)
+    if data is None:
+        imagestore.save_variant(image.sha256, get_failed_name(variant), b"")
+        return None
+    if extension == image.extension and len(data) >= image.size:
+        # already small, eg. an optimized PNG narrower than width
+        with image.open() as image_file:
+            data = image_file.read()
+    imagestore.save_variant(image.sha256, variant, data)
+    return io.BytesIO(data), len(data)
@@ -0,0 +1,289 @@
+import gc
+import json
+import random
+import statistics
+import time
+import tracemalloc
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from main import models, text_processing
+
+SAMPLE_TEXT = (
+    "the of and to in is was for on that with as by at from his her it an "
+    "blog post write reader mataroa markdown simple minimal web page note "
+    "idea garden morning coffee river mountain code software design essay"
+)
+WORDS = SAMPLE_TEXT.split()
+
+LANGS = ["python", "js", "rust", "go", "html", "sql", "sh", "nonexistentlang"]
+
+
+def _sentence(rng):
+    words = rng.choices(WORDS, k=rng.randint(6, 18))
+    return " ".join(words).capitalize() + "."
+
+
+def _paragraph(rng):
+    return " ".join(_sentence(rng) for _ in range(rng.randint(3, 7)))
+
+
+def _until(size, make_block):
+    """Join blocks made by make_block(index) until text is size bytes long."""
+    blocks = []
+    length = index = 0
+    while length < size:
+        block = make_block(index)
+        blocks.append(block)
+        length += len(block) + 2
+        index += 1
+    return "\n\n".join(blocks)
+
+
+def generate_prose(rng, size):
+    def make_block(index):
+        if index % 6 == 0:
+            return f"## {_sentence(rng)[:-1]}"
+        if index % 6 == 3:
+            return f"> {_sentence(rng)} **{rng.choice(WORDS)}** [link](https://example.com/{index})"
+        return _paragraph(rng)
+
+    return _until(size, make_block)
+
+
+def generate_tables(rng, size):
+    def make_block(index):
+        rows = ["| " + " | ".join(rng.choices(WORDS, k=5)) + " |" for _ in range(12)]
+        return "\n".join([rows[0], "|---|---|---|---|---|", *rows[1:]])
+
+    return _until(size, make_block)
+
+
+def generate_footnotes(rng, size):
+    def make_block(index):
+        return (
+            f"{_paragraph(rng)}[^{index}] {_sentence(rng)}\n\n"
+            f"[^{index}]: {_sentence(rng)}"
+        )
+
+    return _until(size, make_block)
+
+
+def generate_code(rng, size):
+    def make_block(index):
+        lines = [
+            f"    {rng.choice(WORDS)} = {rng.choice(WORDS)}({rng.randint(0, 99)})"
+            for _ in range(rng.randint(5, 30))
+        ]
+        code = "\n".join(lines)
+        return f"{_sentence(rng)}\n\n```{rng.choice(LANGS)}\n{code}\n```"
+
+    return _until(size, make_block)
+
+
+def generate_pathological(rng):
+    """Inputs at the edges of what the editor accepts."""
+    return {
+        "10k-lines": "\n".join(f"- {rng.choice(WORDS)} {i}" for i in range(10_000)),
+        "long-line": " ".join(rng.choices(WORDS, k=24_000)),
+        "nested-emphasis": "*a **b _c " * 2_000,
+        "unclosed-fences": "\n".join(
+            f"```{rng.choice(LANGS)}\n{_sentence(rng)}" for _ in range(2_000)
+        ),
+        "html-soup": "<div><span style='color: red'>x</span><b>" * 1_000,
+    }
+
+
+def generate_corpus(sizes, seed=0):
+    """Return a dict of corpus name to markdown text, same for the same seed."""
+    rng = random.Random(seed)
+    generators = {
+        "prose": generate_prose,
+        "tables": generate_tables,
+        "footnotes": generate_footnotes,
+        "code": generate_code,
+    }
+    corpus = {}
+    for size in sizes:
+        for kind, generate in generators.items():
+            corpus[f"{kind}-{size}k"] = generate(rng, size * 1024)
+    for name, text in generate_pathological(rng).items():
+        corpus[f"pathological-{name}"] = text
+    return corpus
+
+
+def get_benchmarks(owner):
+    """
+    Return functions to benchmark, each with a function that makes its argument
+    from corpus text.
+    """
+    return {
+        "md_to_html": (text_processing.md_to_html, str),
+        "syntax_highlight": (text_processing.syntax_highlight, str),
+        "clean_html": (text_processing.clean_html, text_processing.md_to_html),
+        "sanitize_text": (text_processing.sanitize_text, str),
+        "create_post_slug": (
+            lambda title: text_processing.create_post_slug(title, owner),
+            lambda text: text[:300],
+        ),
+    }
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    index = max(0, round(fraction * len(sorted_values)) - 1)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+def measure(func, arg, repeat):
+    """Time repeat calls of func(arg) and return statistics of the calls."""
+    func(arg)  # warm up caches
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter_ns()
+        func(arg)
+        timings.append(time.perf_counter_ns() - start)
+    timings.sort()
+
+    tracemalloc.start()
+    try:
+        # collected so that only blocks kept alive by the call count as retained
+        gc.collect()
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        func(arg)
+        _, peak = tracemalloc.get_traced_memory()
+        gc.collect()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    retained_blocks = sum(
+        stat.count_diff for stat in after.compare_to(before, "filename")
+    )
+
+    mean = statistics.fmean(timings)
+    return {
+        "ops_per_sec": 1e9 / mean if mean else 0.0,
+        "p50_us": percentile(timings, 0.50) / 1000,
+        "p99_us": percentile(timings, 0.99) / 1000,
+        "peak_kib": peak / 1024,
+        "retained_blocks": retained_blocks,
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the markdown rendering functions of text_processing over a "
+        "generated corpus, and compare results against a stored baseline."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes",
+            default="1,16,64",
+            help="Comma separated corpus sizes in KiB (default: 1,16,64).",
+        )
+        parser.add_argument(
+            "--repeat",
+            type=int,
+            default=10,
+            help="Timed calls per function and input (default: 10).",
+        )
+        parser.add_argument(
+            "--only",
+            help="Only run benchmarks whose name contains this string.",
+        )
+        parser.add_argument(
+            "--baseline",
+            help="Baseline JSON file to compare results against.",
+        )
+        parser.add_argument(
+            "--save",
+            help="Write results as JSON to this file, to use as future baseline.",
+        )
+        parser.add_argument(
+            "--tolerance",
+            type=float,
+            default=10.0,
+            help="Percent of p50 slowdown over baseline reported as regression.",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options["sizes"].split(",")]
+        except ValueError as ex:
+            raise CommandError("--sizes must be comma separated integers.") from ex
+        if options["repeat"] < 1:
+            raise CommandError("--repeat must be positive.")
+
+        baseline = {}
+        if options["baseline"]:
+            with open(options["baseline"]) as baseline_file:
+                baseline = json.load(baseline_file)
+
+        corpus = generate_corpus(sizes)
+        self.stdout.write(
+            self.style.NOTICE(
+                f"Benchmarking {len(corpus)} inputs, {options['repeat']} calls each."
+            )
+        )
+
+        # create_post_slug queries posts of its owner, so give it a user that
+        # is rolled back when the benchmark is done, with a random name so that
+        # it does not collide with an existing user
+        with transaction.atomic():
+            owner = models.User.objects.create(
+                username=f"benchrender-{uuid.uuid4().hex}"
+            )
+            results, regressions = self.run_benchmarks(corpus, owner, baseline, options)
+            transaction.set_rollback(True)
+
+        if options["save"]:
+            with open(options["save"], "w") as save_file:
+                json.dump(results, save_file, indent=2, sort_keys=True)
+            self.stdout.write(
+                self.style.SUCCESS(f"Results saved to {options['save']}.")
+            )
+
+        if regressions:
+            raise CommandError(f"{regressions} benchmarks regressed over baseline.")
+
+    def run_benchmarks(self, corpus, owner, baseline, options):
+        """Measure and report each benchmark. Returns results and regressions."""
+        results = {}
+        regressions = 0
+        benchmarks = get_benchmarks(owner)
+        for name, text in corpus.items():
+            for func_name, (func, make_arg) in benchmarks.items():
+                key = f"{func_name}/{name}"
+                if options["only"] and options["only"] not in key:
+                    continue
+                results[key] = measure(func, make_arg(text), options["repeat"])
+                if not self.report(
+                    key, results[key], baseline.get(key), options["tolerance"]
+                ):
+                    regressions += 1
+        return results, regressions
+
+    def report(self, key, result, baseline_result, tolerance):
+        """Write the result line of a benchmark. Returns False on regression."""
+        line = (
+            f"{key:<45} {result['ops_per_sec']:>10.1f} ops/s"
+            f"  p50 {result['p50_us']:>10.1f}us  p99 {result['p99_us']:>10.1f}us"
+            f"  peak {result['peak_kib']:>8.1f}KiB"
+            f"  {result['retained_blocks']:>6} retained blocks"
+        )
+        if baseline_result is None:
+            self.stdout.write(line)
+            return True
+
+        change = (result["p50_us"] / baseline_result["p50_us"] - 1) * 100
+        line += f"  {change:+.1f}% vs baseline"
+        if change > tolerance:
+            self.stdout.write(self.style.ERROR(line))
+            return False
+        self.stdout.write(self.style.SUCCESS(line))
+        return True
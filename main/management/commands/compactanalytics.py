@@ -0,0 +1,116 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+
+from main import models, partitions, rollups
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete raw analytics older than the retention window, once they are "
+        "counted in the daily rollups. Deletes in batches, each a short "
+        "transaction of its own. Of tables partitioned by month, only the "
+        "legacy partition is deleted from, as partitionanalytics drops the "
+        "monthly ones. Also deletes the unique visitor sketches of days older "
+        "than the retention window."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=settings.ANALYTICS_RETENTION_DAYS,
+            help="Keep analytics of this many days (default: ANALYTICS_RETENTION_DAYS).",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=5_000,
+            help="Analytics deleted per batch.",
+        )
+        parser.add_argument(
+            "--sleep",
+            type=float,
+            default=0.1,
+            help="Seconds to pause between batches, to let other writes through.",
+        )
+
+    def get_until(self, table, before):
+        """
+        Return datetime before which analytics of table are deleted, or None if
+        none are. The legacy partition of a converted table holds all visits
+        until the month after the conversion, which would otherwise only go
+        once all of them expire.
+        """
+        with connection.cursor() as cursor:
+            if not partitions.is_partitioned(cursor, table):
+                return before
+            legacy = partitions.get_legacy_partition_name(table)
+            for name, upper in partitions.get_partitions(cursor, table):
+                if name == legacy:
+                    return min(before, upper)
+        return None
+
+    def handle(self, *args, **options):
+        if options["days"] < 1:
+            raise CommandError("--days must be positive.")
+        if options["batch_size"] < 1:
+            raise CommandError("--batch-size must be positive.")
+
+        before = timezone.now() - timedelta(days=options["days"])
+        self.stdout.write(self.style.NOTICE(f"Deleting analytics before {before}."))
+
+        for kind, (analytic_model, _, _) in rollups.ROLLUPS.items():
+            table = analytic_model._meta.db_table
+            until = self.get_until(table, before)
+            if until is None:
+                msg = (
+                    f"Skipping {table}, it has no legacy partition and "
+                    "partitionanalytics drops its expired partitions."
+                )
+                self.stdout.write(self.style.NOTICE(msg))
+                continue
+
+            # count everything seen so far before deleting, so that only
+            # analytics the last rollup run has not seen yet are kept
+            while rollups.roll_up_batch(kind, options["batch_size"]) is not None:
+                pass
+            last_id = rollups.get_last_id(kind)
+
+            start = time.monotonic()
+            deleted_count = 0
+            while True:
+                ids = list(
+                    analytic_model.objects.filter(created_at__lt=until, id__lte=last_id)
+                    .order_by("created_at")
+                    .values_list("id", flat=True)[: options["batch_size"]]
+                )
+                if not ids:
+                    break
+                count, _ = analytic_model.objects.filter(id__in=ids).delete()
+                deleted_count += count
+                if len(ids) < options["batch_size"]:
+                    break
+                time.sleep(options["sleep"])
+
+            remaining_count = analytic_model.objects.filter(
+                created_at__lt=until
+            ).count()
+            elapsed = time.monotonic() - start
+            msg = (
+                f"Reclaimed {deleted_count} {kind} analytics in {elapsed:.1f}s, "
+                f"{remaining_count} older ones not rolled up yet."
+            )
+            self.stdout.write(self.style.SUCCESS(msg))
+
+        # unique visitors are only estimated within the retention window
+        deleted_count, _ = models.AnalyticPostVisitors.objects.filter(
+            date__lt=before.date()
+        ).delete()
+        self.stdout.write(
+            self.style.SUCCESS(f"Deleted {deleted_count} visitor sketches.")
+        )
@@ -150,6 +150,8 @@ class Command(BaseCommand):
                         published_at=published_at,
                     )
                 )
+        for obj in posts:
+            obj.render_markdown()  # bulk_create does not call save()
         models.Post.objects.bulk_create(posts)
         created["posts"] = len(posts)
 
@@ -173,6 +175,8 @@ class Command(BaseCommand):
                         is_hidden=page_number % 3 == 0,
                     )
                 )
+        for obj in pages:
+            obj.render_markdown()
         models.Page.objects.bulk_create(pages)
         created["pages"] = len(pages)
 
@@ -204,6 +208,8 @@ class Command(BaseCommand):
                         is_approved=comment_number % 4 != 0,
                     )
                 )
+        for obj in comments:
+            obj.render_markdown()
         models.Comment.objects.bulk_create(comments)
         created["comments"] = len(comments)
 
@@ -0,0 +1,122 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from main import imagerefs, models
+
+# markdown fields shown on blogs, that images are referred to from
+REFERRING_FIELDS = {
+    models.Post: ["body"],
+    models.Page: ["body"],
+    models.User: ["blog_byline", "footer_note"],
+    models.Comment: ["body"],
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Find images no post, page, blog byline or footer, or comment refers to, "
+        "uploaded before a grace period, and report their size per user. Only "
+        "deletes them, in batches, with --delete."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--grace-days",
+            type=int,
+            default=30,
+            help="Keep images uploaded in the last days, even if not referred to.",
+        )
+        parser.add_argument(
+            "--delete",
+            action="store_true",
+            help="Delete the images found, instead of only reporting them.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=100,
+            help="Images deleted per batch.",
+        )
+        parser.add_argument(
+            "--sleep",
+            type=float,
+            default=0.1,
+            help="Seconds to pause between batches, to let other queries through.",
+        )
+
+    def get_referenced_slugs(self):
+        """Return set of slugs of the images referred to, scanning all bodies."""
+        slugs = set()
+        for model, fields in REFERRING_FIELDS.items():
+            rows = model.objects.values_list(*fields).iterator(chunk_size=2000)
+            for row in rows:
+                for body in row:
+                    slugs |= imagerefs.get_image_slugs(body)
+        return slugs
+
+    def handle(self, *args, **options):
+        if options["grace_days"] < 0:
+            raise CommandError("--grace-days must not be negative.")
+        if options["batch_size"] < 1:
+            raise CommandError("--batch-size must be positive.")
+
+        cutoff = timezone.now() - timedelta(days=options["grace_days"])
+        referenced_slugs = self.get_referenced_slugs()
+
+        # users by id to tuple of the number and size of their images found
+        user_totals = {}
+        image_ids = []
+        images = (
+            models.Image.objects.filter(uploaded_at__lt=cutoff)
+            .order_by("id")
+            .values_list("id", "slug", "owner_id", "size")
+            .iterator(chunk_size=2000)
+        )
+        for image_id, slug, owner_id, size in images:
+            if slug in referenced_slugs:
+                continue
+            image_ids.append(image_id)
+            count, total_bytes = user_totals.get(owner_id, (0, 0))
+            user_totals[owner_id] = (count + 1, total_bytes + size)
+
+        usernames = dict(
+            models.User.objects.filter(id__in=user_totals).values_list("id", "username")
+        )
+        for owner_id, (count, total_bytes) in sorted(
+            user_totals.items(), key=lambda item: -item[1][1]
+        ):
+            msg = (
+                f"{usernames.get(owner_id, owner_id)}: {count} images "
+                f"({total_bytes / 1_000_000:.2f}MB)"
+            )
+            self.stdout.write(self.style.NOTICE(msg))
+
+        total_bytes = sum(total_bytes for _, total_bytes in user_totals.values())
+        msg = (
+            f"Found {len(image_ids)} unreferenced images "
+            f"({total_bytes / 1_000_000:.2f}MB) of {len(user_totals)} users, "
+            f"uploaded over {options['grace_days']} days ago."
+        )
+        self.stdout.write(self.style.SUCCESS(msg))
+        if not options["delete"]:
+            if image_ids:
+                self.stdout.write("Dry run, delete them with --delete.")
+            return
+
+        deleted_count = 0
+        for start in range(0, len(image_ids), options["batch_size"]):
+            batch_ids = image_ids[start : start + options["batch_size"]]
+            # posts saved since the scan may refer to some of them now
+            batch = models.Image.objects.filter(id__in=batch_ids).exclude(
+                post_references__isnull=False
+            )
+            # delete signals remove the file and update the usage of the owner
+            _, deleted = batch.delete()
+            deleted_count += deleted.get("main.Image", 0)
+            time.sleep(options["sleep"])
+
+        msg = f"Deleted {deleted_count} images."
+        self.stdout.write(self.style.SUCCESS(msg))
@@ -0,0 +1,55 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from main import imagerefs, models
+
+
+class Command(BaseCommand):
+    help = (
+        "Index the images referred to in the bodies of all posts, in batches. "
+        "Posts are indexed whenever saved, so this is only needed once for "
+        "existing posts; an interrupted run can be resumed with --after-id."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--after-id",
+            type=int,
+            default=0,
+            help="Resume from the first post after this id.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Posts read per batch.",
+        )
+
+    def handle(self, *args, **options):
+        if options["batch_size"] < 1:
+            raise CommandError("--batch-size must be positive.")
+
+        start = time.monotonic()
+        post_count = added_count = removed_count = 0
+        last_id = options["after_id"]
+        while True:
+            rows = list(
+                models.Post.objects.filter(id__gt=last_id)
+                .order_by("id")
+                .values_list("id", "body")[: options["batch_size"]]
+            )
+            if not rows:
+                break
+            added, removed = imagerefs.update(dict(rows))
+            post_count += len(rows)
+            added_count += added
+            removed_count += removed
+            last_id = rows[-1][0]
+
+        elapsed = time.monotonic() - start
+        msg = (
+            f"Indexed {post_count} posts in {elapsed:.1f}s, added {added_count} "
+            f"and removed {removed_count} image references."
+        )
+        self.stdout.write(self.style.SUCCESS(msg))
@@ -69,7 +69,7 @@ class Command(BaseCommand):
             ) as export_archive:
                 for file_name, data in export_files:
                     export_archive.writestr(
-                        export_name + f"/{container_dir}/" + file_name, data.getvalue()
+                        export_name + f"/{container_dir}/" + file_name, data
                     )
 
             # reopen zipfile and load in memory
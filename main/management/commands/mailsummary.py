@@ -3,9 +3,8 @@ from datetime import datetime, timedelta
 from django.conf import settings
 from django.core import mail
 from django.core.management.base import BaseCommand
-from django.db.models import Count, Q
 
-from main import models, scheme
+from main import models, rollups, scheme
 
 
 def build_summary_text(target_date: datetime.date) -> str:
@@ -28,19 +27,8 @@ def build_summary_text(target_date: datetime.date) -> str:
         .order_by("-created_at")
     )
 
-    post_visits_count = models.AnalyticPost.objects.filter(
-        created_at__date=target_date
-    ).count()
-    top_posts_by_visits_qs = (
-        models.Post.objects.filter(analyticpost__created_at__date=target_date)
-        .annotate(
-            visit_count=Count(
-                "analyticpost", filter=Q(analyticpost__created_at__date=target_date)
-            )
-        )
-        .select_related("owner")
-        .order_by("-visit_count", "-id")
-    )
+    post_visits_count = rollups.get_total("post", target_date)
+    top_posts_by_visits = rollups.get_top_posts(20, target_date)
 
     lines: list[str] = []
     lines.append(f"# Mataroa Summary {target_date.strftime('%Y-%m-%d')}")
@@ -57,8 +45,8 @@ def build_summary_text(target_date: datetime.date) -> str:
     lines.append("")
 
     lines.append("## Top Posts by Visits")
-    if top_posts_by_visits_qs.exists():
-        for post in top_posts_by_visits_qs[:20]:
+    if top_posts_by_visits:
+        for post in top_posts_by_visits:
             lines.append(
                 f"* {post.title} [{post.visit_count}] {scheme.get_protocol()}{post.get_proper_url()}"
             )
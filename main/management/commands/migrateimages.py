@@ -0,0 +1,99 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count, Max, Sum
+
+from main import imagestore, models
+
+
+class Command(BaseCommand):
+    help = (
+        "Move image file data out of the database into the image storage, in "
+        "batches, storing identical images once. Images can be viewed while "
+        "they are moved."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=100,
+            help="Images moved per batch.",
+        )
+        parser.add_argument(
+            "--sleep",
+            type=float,
+            default=0.1,
+            help="Seconds to pause between batches, to let other queries through.",
+        )
+
+    def handle(self, *args, **options):
+        if options["batch_size"] < 1:
+            raise CommandError("--batch-size must be positive.")
+
+        start = time.monotonic()
+        moved_count = moved_bytes = 0
+        # images with the content of a file stored already, by any user
+        deduplicated_count = deduplicated_bytes = 0
+        last_id = 0
+        while True:
+            images = list(
+                models.Image.objects.filter(
+                    id__gt=last_id, sha256="", data__isnull=False
+                )
+                .order_by("id")
+                .only("id", "data")[: options["batch_size"]]
+            )
+            if not images:
+                break
+            for image in images:
+                data = bytes(image.data)
+                # the file is stored before the data is cleared, so that no
+                # image is ever without either
+                with transaction.atomic():
+                    sha256, stored = imagestore.store(data)
+                    updated = models.Image.objects.filter(
+                        id=image.id, sha256=""
+                    ).update(sha256=sha256, size=len(data), data=None)
+                    if not updated:
+                        # deleted meanwhile, so its file may be of no image
+                        if stored:
+                            models.Image.delete_unused_file(sha256)
+                        continue
+                moved_count += 1
+                moved_bytes += len(data)
+                if not stored:
+                    deduplicated_count += 1
+                    deduplicated_bytes += len(data)
+            last_id = images[-1].id
+            time.sleep(options["sleep"])
+
+        elapsed = time.monotonic() - start
+        remaining_count = models.Image.objects.filter(sha256="").count()
+        msg = (
+            f"Moved {moved_count} images ({moved_bytes / 1_000_000:.2f}MB) "
+            f"in {elapsed:.1f}s, {remaining_count} left in the database. "
+            f"{deduplicated_count} had the content of a stored file, saving "
+            f"{deduplicated_bytes / 1_000_000:.2f}MB."
+        )
+        self.stdout.write(self.style.SUCCESS(msg))
+
+        # images are stored once per content, however many users upload them
+        files = (
+            models.Image.objects.exclude(sha256="")
+            .values("sha256")
+            .annotate(file_size=Max("size"))
+        )
+        file_stats = files.aggregate(count=Count("sha256"), size=Sum("file_size"))
+        image_stats = models.Image.objects.exclude(sha256="").aggregate(
+            count=Count("id"), size=Sum("size", default=0)
+        )
+        file_size = file_stats["size"] or 0
+        msg = (
+            f"Storing {image_stats['count']} images "
+            f"({image_stats['size'] / 1_000_000:.2f}MB) as {file_stats['count']} "
+            f"files ({file_size / 1_000_000:.2f}MB), saving "
+            f"{(image_stats['size'] - file_size) / 1_000_000:.2f}MB."
+        )
+        self.stdout.write(self.style.SUCCESS(msg))
@@ -0,0 +1,93 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+
+from main import partitions, rollups
+
+
+class Command(BaseCommand):
+    help = (
+        "Create monthly partitions of the analytics tables ahead of time, and "
+        "drop the partitions past the analytics retention once rolled up."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--months-ahead",
+            type=int,
+            default=3,
+            help="Months after the current one to have partitions for.",
+        )
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=settings.ANALYTICS_RETENTION_DAYS,
+            help="Keep analytics of this many days (default: ANALYTICS_RETENTION_DAYS).",
+        )
+        parser.add_argument(
+            "--detach-only",
+            action="store_true",
+            help="Detach expired partitions instead of dropping them, eg. to archive.",
+        )
+
+    def handle(self, *args, **options):
+        if options["months_ahead"] < 0:
+            raise CommandError("--months-ahead must not be negative.")
+        if options["days"] < 1:
+            raise CommandError("--days must be positive.")
+
+        today = timezone.now().date()
+        before = timezone.now() - timedelta(days=options["days"])
+        with connection.cursor() as cursor:
+            for kind, (analytic_model, _, _) in rollups.ROLLUPS.items():
+                table = analytic_model._meta.db_table
+                if not partitions.is_partitioned(cursor, table):
+                    self.stdout.write(
+                        self.style.ERROR(f"{table} is not partitioned, run migrate.")
+                    )
+                    continue
+                self.create_partitions(cursor, table, today, options["months_ahead"])
+                self.drop_partitions(
+                    cursor, kind, table, before, options["detach_only"]
+                )
+
+    def create_partitions(self, cursor, table, today, months_ahead):
+        # tables partitioned before there was a default partition get one too
+        partitions.create_default_partition(cursor, table)
+        upper = max(upper for _, upper in partitions.get_partitions(cursor, table))
+        month = upper.date()
+        last_month = partitions.add_months(today, months_ahead)
+        while month <= last_month:
+            name = partitions.create_partition(cursor, table, month)
+            self.stdout.write(self.style.SUCCESS(f"Created partition {name}."))
+            month = partitions.add_months(month, 1)
+
+    def drop_partitions(self, cursor, kind, table, before, detach_only):
+        # count analytics in the rollups before their partitions go
+        while rollups.roll_up_batch(kind, 50_000) is not None:
+            pass
+        last_id = rollups.get_last_id(kind)
+
+        reclaimed_count = 0
+        for name, upper in partitions.get_partitions(cursor, table):
+            if upper > before:
+                continue
+            max_id = partitions.get_max_id(cursor, name)
+            if max_id is not None and max_id > last_id:
+                self.stdout.write(
+                    self.style.NOTICE(f"Keeping {name}, not rolled up yet.")
+                )
+                continue
+            row_count = partitions.get_row_estimate(cursor, name)
+            partitions.drop_partition(cursor, table, name, detach_only)
+            reclaimed_count += row_count
+            action = "Detached" if detach_only else "Dropped"
+            self.stdout.write(
+                self.style.SUCCESS(f"{action} partition {name} of ~{row_count} rows.")
+            )
+        self.stdout.write(
+            self.style.SUCCESS(f"Reclaimed ~{reclaimed_count} {kind} analytics.")
+        )
@@ -7,7 +7,7 @@ from django.core.management.base import BaseCommand
 from django.template.loader import render_to_string
 from django.utils import timezone
 
-from main import models, scheme, text_processing
+from main import models, scheme
 
 
 def get_mail_connection():
@@ -53,7 +53,7 @@ def get_email_body_html(post, notification):
     post_url = scheme.get_protocol() + post.get_proper_url()
     unsubscribe_url = scheme.get_protocol() + notification.get_unsubscribe_url()
     blog_title = post.owner.blog_title or post.owner.username
-    post_body_html = text_processing.md_to_html(post.body)
+    post_body_html = post.body_as_html
 
     published_date = ""
     if post.published_at:
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from main import imagequota, models
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the image storage totals of users from their images, fixing "
+        "any drift of the totals the quota is checked against."
+    )
+
+    def handle(self, *args, **options):
+        user_ids = set(
+            models.Image.objects.values_list("owner_id", flat=True).distinct()
+        )
+        user_ids.update(models.ImageUsage.objects.values_list("owner_id", flat=True))
+
+        fixed_count = 0
+        for user_id in sorted(user_ids):
+            before, after = imagequota.reconcile(user_id)
+            if before != after:
+                fixed_count += 1
+                msg = (
+                    f"Fixed user {user_id}: {before[1]} images of {before[0]} bytes, "
+                    f"now {after[1]} images of {after[0]} bytes."
+                )
+                self.stdout.write(self.style.NOTICE(msg))
+
+        msg = f"Reconciled image usage of {len(user_ids)} users, fixed {fixed_count}."
+        self.stdout.write(self.style.SUCCESS(msg))
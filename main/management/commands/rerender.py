@@ -0,0 +1,171 @@
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from main import models, text_processing
+
+RENDERED_MODELS = {
+    "post": models.Post,
+    "page": models.Page,
+    "comment": models.Comment,
+    "user": models.User,
+}
+
+# field of each rendered model with the id of the user whose blog shows it
+OWNER_FIELDS = {
+    models.Post: "owner_id",
+    models.Page: "owner_id",
+    models.Comment: "post__owner_id",
+    models.User: "id",
+}
+
+
+def render(markdown_string):
+    """Render markdown in a worker process."""
+    return text_processing.md_to_html(markdown_string)
+
+
+class Command(BaseCommand):
+    help = (
+        "Re-render stored markdown renders that are stale, eg. after a "
+        "RENDERER_VERSION bump. Rows already up to date are skipped, so an "
+        "interrupted run can be started again or resumed with --model and "
+        "--after-id. Blogs with rows re-rendered count as changed, for their "
+        "cached pages and conditional GET validators."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--model",
+            choices=list(RENDERED_MODELS),
+            action="append",
+            dest="model_names",
+            help="Only re-render this model. Can be given multiple times.",
+        )
+        parser.add_argument(
+            "--after-id",
+            type=int,
+            default=0,
+            help="Resume from the first row after this id, of the one --model given.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Rows read and written per batch.",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=None,
+            help="Rendering processes. Defaults to CPU count; 1 renders in-process.",
+        )
+
+    def handle(self, *args, **options):
+        if options["batch_size"] < 1:
+            raise CommandError("--batch-size must be positive.")
+        if options["workers"] is not None and options["workers"] < 1:
+            raise CommandError("--workers must be positive.")
+        model_names = options["model_names"] or list(RENDERED_MODELS)
+        # ids of different models have nothing to do with each other
+        if options["after_id"] and len(model_names) != 1:
+            raise CommandError("--after-id needs a single --model.")
+
+        if options["workers"] == 1:
+            self.render_many = lambda values: list(map(render, values))
+            self.rerender_models(model_names, options)
+            return
+
+        with ProcessPoolExecutor(
+            max_workers=options["workers"], initializer=django.setup
+        ) as executor:
+            self.render_many = lambda values: list(
+                executor.map(render, values, chunksize=16)
+            )
+            self.rerender_models(model_names, options)
+
+    def rerender_models(self, model_names, options):
+        for name in model_names:
+            self.rerender_model(
+                RENDERED_MODELS[name], options["after_id"], options["batch_size"]
+            )
+
+    def touch_owners(self, model, ids):
+        # bulk updates leave updated_at as it was, which blog pages are cached
+        # and validated by (see conditional)
+        owner_ids = model.objects.filter(id__in=ids).values_list(
+            OWNER_FIELDS[model], flat=True
+        )
+        models.User.objects.filter(id__in=set(owner_ids)).update(
+            updated_at=timezone.now()
+        )
+
+    def rerender_model(self, model, after_id, batch_size):
+        name = model._meta.model_name
+        self.stdout.write(
+            self.style.NOTICE(f"Re-rendering {name} after id {after_id}.")
+        )
+
+        sources = list(model.rendered_fields)
+        hash_fields = [model.rendered_fields[source][1] for source in sources]
+        scanned_count = rendered_count = 0
+        start = time.monotonic()
+        last_id = after_id
+        while True:
+            rows = list(
+                model.objects.filter(id__gt=last_id)
+                .order_by("id")
+                .values_list("id", *sources, *hash_fields)[:batch_size]
+            )
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            scanned_count += len(rows)
+
+            # keyed by source field so that each bulk update only writes the
+            # fields that were rendered
+            stale = {source: [] for source in sources}
+            for row in rows:
+                for index, source in enumerate(sources):
+                    markdown_string = row[1 + index]
+                    render_hash = text_processing.get_render_hash(markdown_string)
+                    if render_hash != row[1 + len(sources) + index]:
+                        stale[source].append((row[0], markdown_string, render_hash))
+
+            rendered_ids = set()
+            for source, items in stale.items():
+                if not items:
+                    continue
+                htmls = self.render_many([item[1] for item in items])
+                instances = []
+                for (pk, _, render_hash), html in zip(items, htmls, strict=True):
+                    instance = model(id=pk)
+                    fields = instance.set_rendered(source, html, render_hash)
+                    instances.append(instance)
+                model.objects.bulk_update(instances, fields)
+                rendered_count += len(instances)
+                rendered_ids.update(instance.id for instance in instances)
+            if rendered_ids:
+                self.touch_owners(model, rendered_ids)
+
+            elapsed = time.monotonic() - start
+            msg = (
+                f"{name}: up to id {last_id}, {scanned_count} rows scanned, "
+                f"{rendered_count} re-rendered, {scanned_count / max(elapsed, 0.001):.0f} rows/s."
+            )
+            self.stdout.write(self.style.NOTICE(msg))
+
+        if rendered_count and model in (models.Post, models.User):
+            # stored feeds embed post renders and bylines, so drop them to be
+            # generated again on their next poll
+            models.Feed.objects.all().delete()
+
+        elapsed = time.monotonic() - start
+        msg = (
+            f"Re-rendered {rendered_count} of {scanned_count} {name} rows "
+            f"in {elapsed:.1f}s."
+        )
+        self.stdout.write(self.style.SUCCESS(msg))
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from main import feeds, models
+
+
+class Command(BaseCommand):
+    help = (
+        "Regenerate stored RSS feeds of blogs with scheduled posts published "
+        "since their feed was generated."
+    )
+
+    def handle(self, *args, **options):
+        today = timezone.now().date()
+        stale_feeds = (
+            models.Feed.objects.filter(stale_on__lte=today)
+            .select_related("owner")
+            .order_by("owner_id")
+        )
+        self.stdout.write(self.style.NOTICE(f"Rolling over feeds for {today}."))
+
+        count = 0
+        for feed in stale_feeds.iterator():
+            feeds.update_feed(feed.owner)
+            count += 1
+
+        self.stdout.write(self.style.SUCCESS(f"Regenerated {count} feeds."))
@@ -0,0 +1,40 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from main import rollups
+
+
+class Command(BaseCommand):
+    help = (
+        "Add new post and page analytics to their daily rollups. Analytics are "
+        "rolled up on the run after the one that first sees them."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=50_000,
+            help="Analytic ids rolled up per transaction.",
+        )
+
+    def handle(self, *args, **options):
+        if options["batch_size"] < 1:
+            raise CommandError("--batch-size must be positive.")
+
+        for kind in rollups.ROLLUPS:
+            start = time.monotonic()
+            total = 0
+            while (
+                count := rollups.roll_up_batch(kind, options["batch_size"])
+            ) is not None:
+                total += count
+            seen_id = rollups.mark_seen(kind)
+
+            elapsed = time.monotonic() - start
+            msg = (
+                f"Rolled up {total} {kind} analytics in {elapsed:.1f}s, "
+                f"next run rolls up to id {seen_id}."
+            )
+            self.stdout.write(self.style.SUCCESS(msg))
@@ -4,9 +4,10 @@ from unicodedata import normalize
 from django.conf import settings
 from django.http import Http404, HttpResponseBadRequest
 from django.shortcuts import redirect
+from django.utils.functional import SimpleLazyObject
 from django.utils.http import MAX_URL_LENGTH
 
-from main import denylist, models, scheme
+from main import denylist, hosts, models, scheme
 
 
 def _redirect_to_domain(domain, path):
@@ -36,6 +37,22 @@ def _retired_blog_path(path):
     return path
 
 
+def _get_blog_user(user_id):
+    try:
+        return models.User.objects.get(id=user_id)
+    except models.User.DoesNotExist as ex:
+        # cached host resolution outlived the user
+        raise Http404() from ex
+
+
+def _set_blog_user(request, blog):
+    # blog user is only queried if a view needs more than the cached fields
+    request.blog_user = SimpleLazyObject(lambda: _get_blog_user(blog["id"]))
+    request.blog_user_id = blog["id"]
+    request.theme_zialucia = blog["theme_zialucia"]
+    request.theme_sansserif = blog["theme_sansserif"]
+
+
 def host_middleware(get_response):
     def middleware(request):
         host = request.META.get("HTTP_HOST")
@@ -77,36 +94,33 @@ def host_middleware(get_response):
             # check if subdomain is disallowed
             if request.subdomain in denylist.DISALLOWED_USERNAMES:
                 return redirect(f"{scheme.get_protocol()}//{settings.CANONICAL_HOST}")
+
             # check if subdomain exists as blog
-            elif models.User.objects.filter(username=request.subdomain).exists():
-                request.blog_user = models.User.objects.get(username=request.subdomain)
-
-                # set theme
-                request.theme_zialucia = request.blog_user.theme_zialucia
-                request.theme_sansserif = request.blog_user.theme_sansserif
-
-                # redirect to custom and/or retired urls for cases:
-                # * logged out / anon users
-                # * logged in but on other user's subdomain
-                if not request.user.is_authenticated or (
-                    request.user.is_authenticated
-                    and request.user.username != request.subdomain
-                ):
-                    # user has retired their mataroa blog, redirect to new domain
-                    if request.blog_user.redirect_domain:
-                        return _redirect_to_domain(
-                            request.blog_user.redirect_domain,
-                            _retired_blog_path(request.path_info),
-                        )
-
-                    if request.blog_user.custom_domain:  # user has set custom domain
-                        return _redirect_to_domain(
-                            request.blog_user.custom_domain,
-                            request.path_info,
-                        )
-            else:
+            blog = hosts.resolve(host, username=request.subdomain)
+            if not blog:
                 raise Http404()
-        elif models.User.objects.filter(custom_domain=host).exists():
+            _set_blog_user(request, blog)
+
+            # redirect to custom and/or retired urls for cases:
+            # * logged out / anon users
+            # * logged in but on other user's subdomain
+            if not request.user.is_authenticated or (
+                request.user.is_authenticated
+                and request.user.username != request.subdomain
+            ):
+                # user has retired their mataroa blog, redirect to new domain
+                if blog["redirect_domain"]:
+                    return _redirect_to_domain(
+                        blog["redirect_domain"],
+                        _retired_blog_path(request.path_info),
+                    )
+
+                if blog["custom_domain"]:  # user has set custom domain
+                    return _redirect_to_domain(
+                        blog["custom_domain"],
+                        request.path_info,
+                    )
+        elif blog := hosts.resolve(host, custom_domain=host):
             # custom domain case
 
             # redirect auth URLs to canonical domain
@@ -119,16 +133,14 @@ def host_middleware(get_response):
                 )
                 return redirect(canonical_url)
 
-            request.blog_user = models.User.objects.get(custom_domain=host)
-            request.subdomain = request.blog_user.username
-            request.theme_zialucia = request.blog_user.theme_zialucia
-            request.theme_sansserif = request.blog_user.theme_sansserif
+            _set_blog_user(request, blog)
+            request.subdomain = blog["username"]
 
             # if user has retired their mataroa blog (and keeps the custom domain)
             # redirect to new domain
-            if request.blog_user.redirect_domain:
+            if blog["redirect_domain"]:
                 return _redirect_to_domain(
-                    request.blog_user.redirect_domain,
+                    blog["redirect_domain"],
                     _retired_blog_path(request.path_info),
                 )
 
@@ -0,0 +1,29 @@
+# Generated by Django 6.0.1 on 2026-10-17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("main", "0114_user_is_delisted"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="post",
+            name="body_hash",
+            field=models.CharField(
+                blank=True, default="", editable=False, max_length=64
+            ),
+        ),
+        migrations.AddField(
+            model_name="post",
+            name="body_html",
+            field=models.TextField(blank=True, default="", editable=False),
+        ),
+        migrations.AddField(
+            model_name="post",
+            name="body_text",
+            field=models.TextField(blank=True, default="", editable=False),
+        ),
+    ]
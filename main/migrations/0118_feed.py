@@ -0,0 +1,39 @@
+# Generated by Django 6.0.1 on 2026-10-17
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("main", "0117_user_updated_at"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Feed",
+            fields=[
+                (
+                    "owner",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        serialize=False,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+                ("document", models.TextField()),
+                (
+                    "stale_on",
+                    models.DateField(
+                        blank=True,
+                        db_index=True,
+                        help_text="Publication date of the next scheduled post, when the document needs regenerating.",
+                        null=True,
+                    ),
+                ),
+                ("generated_at", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
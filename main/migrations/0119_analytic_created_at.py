@@ -0,0 +1,27 @@
+# Generated by Django 6.0.1 on 2026-10-17
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("main", "0118_feed"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="analyticpage",
+            name="created_at",
+            field=models.DateTimeField(
+                db_index=True, default=django.utils.timezone.now, editable=False
+            ),
+        ),
+        migrations.AlterField(
+            model_name="analyticpost",
+            name="created_at",
+            field=models.DateTimeField(
+                db_index=True, default=django.utils.timezone.now, editable=False
+            ),
+        ),
+    ]
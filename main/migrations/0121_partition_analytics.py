@@ -0,0 +1,24 @@
+# Generated by Django 6.0.1 on 2026-10-17
+
+from django.db import migrations
+
+from main import partitions
+
+
+def partition_analytics(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        for model_name in ["AnalyticPost", "AnalyticPage"]:
+            table = apps.get_model("main", model_name)._meta.db_table
+            partitions.convert(cursor, table)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("main", "0120_analytic_rollups"),
+    ]
+
+    # irreversible, as the tables are not converted back, rather than leaving
+    # earlier migrations to run against the partitioned tables
+    operations = [
+        migrations.RunPython(partition_analytics),
+    ]
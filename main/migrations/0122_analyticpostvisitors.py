@@ -0,0 +1,39 @@
+# Generated by Django 6.0.1 on 2026-10-17
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("main", "0121_partition_analytics"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="AnalyticPostVisitors",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("date", models.DateField(db_index=True)),
+                ("sketch", models.BinaryField()),
+                (
+                    "post",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, to="main.post"
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ["-date"],
+                "unique_together": {("post", "date")},
+            },
+        ),
+    ]
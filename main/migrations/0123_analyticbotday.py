@@ -0,0 +1,31 @@
+# Generated by Django 6.0.1 on 2026-10-17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("main", "0122_analyticpostvisitors"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="AnalyticBotDay",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("date", models.DateField(unique=True)),
+                ("count", models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                "ordering": ["-date"],
+            },
+        ),
+    ]
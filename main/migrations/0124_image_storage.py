@@ -0,0 +1,39 @@
+# Generated by Django 6.0.1 on 2026-10-17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("main", "0123_analyticbotday"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="image",
+            name="sha256",
+            field=models.CharField(
+                blank=True,
+                db_index=True,
+                help_text="Hash of the file, naming it in the image storage.",
+                max_length=64,
+            ),
+        ),
+        migrations.AddField(
+            model_name="image",
+            name="size",
+            field=models.PositiveIntegerField(
+                default=0, help_text="File size in bytes."
+            ),
+        ),
+        migrations.AlterField(
+            model_name="image",
+            name="data",
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        # sizes of images still in the database, moved out by migrateimages
+        migrations.RunSQL(
+            "UPDATE main_image SET size = octet_length(data) WHERE data IS NOT NULL",
+            migrations.RunSQL.noop,
+        ),
+    ]
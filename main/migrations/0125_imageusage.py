@@ -0,0 +1,38 @@
+# Generated by Django 6.0.1 on 2026-10-17
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("main", "0124_image_storage"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ImageUsage",
+            fields=[
+                (
+                    "owner",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="image_usage",
+                        serialize=False,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+                ("total_bytes", models.BigIntegerField(default=0)),
+                ("image_count", models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunSQL(
+            """
+            INSERT INTO main_imageusage (owner_id, total_bytes, image_count)
+            SELECT owner_id, SUM(size), COUNT(*) FROM main_image GROUP BY owner_id
+            """,
+            migrations.RunSQL.noop,
+        ),
+    ]
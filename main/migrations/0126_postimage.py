@@ -0,0 +1,46 @@
+# Generated by Django 6.0.1 on 2026-10-17
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("main", "0125_imageusage"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PostImage",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "image",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="post_references",
+                        to="main.image",
+                    ),
+                ),
+                (
+                    "post",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="image_references",
+                        to="main.post",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("post", "image")},
+            },
+        ),
+    ]
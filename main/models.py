@@ -1,16 +1,16 @@
 import base64
 import binascii
+import io
 import os
 import uuid
 
-import bleach
 from django.conf import settings
 from django.contrib.auth.models import AbstractUser
-from django.db import models
+from django.db import models, transaction
 from django.urls import reverse
 from django.utils import timezone
 
-from main import scheme, text_processing, validators
+from main import imagestore, imagevariants, scheme, text_processing, validators
 
 
 def _generate_key():
@@ -18,7 +18,61 @@ def _generate_key():
     return binascii.b2a_hex(os.urandom(16)).decode("utf-8")
 
 
-class User(AbstractUser):
+class RenderedMarkdownMixin:
+    """
+    Keeps the HTML render of markdown fields stored next to them, so that it is
+    produced once per edit instead of once per request. rendered_fields maps
+    each markdown field to the names of its HTML and hash fields.
+    """
+
+    rendered_fields = {}
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get("update_fields")
+        sources = list(self.rendered_fields)
+        if update_fields is not None:
+            sources = [source for source in sources if source in update_fields]
+        changed_fields = self.render_markdown(sources)
+        if changed_fields and update_fields is not None:
+            kwargs["update_fields"] = {*update_fields, *changed_fields}
+        super().save(*args, **kwargs)
+
+    def render_markdown(self, sources=None):
+        """
+        Regenerate stored renders of the given markdown fields (all by default)
+        whose content changed since they were last rendered. Returns the names
+        of the fields that were updated.
+        """
+        if sources is None:
+            sources = self.rendered_fields
+        changed_fields = []
+        for source in sources:
+            _, hash_field = self.rendered_fields[source]
+            markdown_string = getattr(self, source)
+            render_hash = text_processing.get_render_hash(markdown_string)
+            if render_hash != getattr(self, hash_field):
+                html = text_processing.md_to_html(markdown_string)
+                changed_fields += self.set_rendered(source, html, render_hash)
+        return changed_fields
+
+    def set_rendered(self, source, html, render_hash):
+        """Store the render of a markdown field. Returns the fields updated."""
+        html_field, hash_field = self.rendered_fields[source]
+        setattr(self, html_field, html)
+        setattr(self, hash_field, render_hash)
+        return [html_field, hash_field]
+
+    def get_rendered_html(self, source):
+        """Return stored render of a markdown field, rendering it if stale."""
+        html_field, hash_field = self.rendered_fields[source]
+        markdown_string = getattr(self, source)
+        render_hash = text_processing.get_render_hash(markdown_string)
+        if getattr(self, hash_field) == render_hash:
+            return getattr(self, html_field)
+        return text_processing.md_to_html(markdown_string)
+
+
+class User(RenderedMarkdownMixin, AbstractUser):
     username = models.CharField(
         max_length=150,
         unique=True,
@@ -138,6 +192,22 @@ class User(AbstractUser):
         ),
     )
 
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    blog_byline_html = models.TextField(blank=True, default="", editable=False)
+    blog_byline_hash = models.CharField(
+        max_length=64, blank=True, default="", editable=False
+    )
+    footer_note_html = models.TextField(blank=True, default="", editable=False)
+    footer_note_hash = models.CharField(
+        max_length=64, blank=True, default="", editable=False
+    )
+
+    rendered_fields = {
+        "blog_byline": ("blog_byline_html", "blog_byline_hash"),
+        "footer_note": ("footer_note_html", "footer_note_hash"),
+    }
+
     class Meta:
         ordering = ["-id"]
 
@@ -156,17 +226,16 @@ class User(AbstractUser):
 
     @property
     def blog_byline_as_text(self):
-        linker = bleach.linkifier.Linker(callbacks=[lambda attrs, new: None])
         html_text = text_processing.md_to_html(self.blog_byline, strip_tags=True)
-        return linker.linkify(html_text)
+        return text_processing.linkify(html_text)
 
     @property
     def blog_byline_as_html(self):
-        return text_processing.md_to_html(self.blog_byline)
+        return self.get_rendered_html("blog_byline")
 
     @property
     def footer_note_as_html(self):
-        return text_processing.md_to_html(self.footer_note)
+        return self.get_rendered_html("footer_note")
 
     @property
     def post_count(self):
@@ -195,7 +264,7 @@ class User(AbstractUser):
         return self.username
 
 
-class Post(models.Model):
+class Post(RenderedMarkdownMixin, models.Model):
     title = models.CharField(max_length=300)
     slug = models.CharField(max_length=300)
     body = models.TextField(blank=True, null=True)
@@ -210,6 +279,12 @@ class Post(models.Model):
     )
     broadcasted_at = models.DateTimeField(blank=True, null=True, default=None)
 
+    body_html = models.TextField(blank=True, default="", editable=False)
+    body_text = models.TextField(blank=True, default="", editable=False)
+    body_hash = models.CharField(max_length=64, blank=True, default="", editable=False)
+
+    rendered_fields = {"body": ("body_html", "body_hash")}
+
     class Meta:
         ordering = ["-published_at", "-created_at"]
         unique_together = [["slug", "owner"]]
@@ -217,14 +292,19 @@ class Post(models.Model):
             models.Index(fields=["owner", "-published_at"]),
         ]
 
+    def set_rendered(self, source, html, render_hash):
+        self.body_text = text_processing.html_to_text(html)
+        return super().set_rendered(source, html, render_hash) + ["body_text"]
+
     @property
     def body_as_html(self):
-        return text_processing.md_to_html(self.body)
+        return self.get_rendered_html("body")
 
     @property
     def body_as_text(self):
-        as_html = text_processing.md_to_html(self.body)
-        return bleach.clean(as_html, strip=True, tags=[])
+        if self.body_hash == text_processing.get_render_hash(self.body):
+            return self.body_text
+        return text_processing.html_to_text(self.body_as_html)
 
     @property
     def is_draft(self):
@@ -266,25 +346,53 @@ class Image(models.Model):
     owner = models.ForeignKey(User, on_delete=models.CASCADE)
     name = models.CharField(max_length=300)  # original filename
     slug = models.CharField(max_length=300, unique=True)
-    data = models.BinaryField()
+    # file data, until moved to the image storage by migrateimages
+    data = models.BinaryField(null=True, blank=True)
+    size = models.PositiveIntegerField(default=0, help_text="File size in bytes.")
+    sha256 = models.CharField(
+        max_length=64,
+        blank=True,
+        db_index=True,
+        help_text="Hash of the file, naming it in the image storage.",
+    )
     extension = models.CharField(max_length=10)
     uploaded_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
         ordering = ["-uploaded_at"]
 
+    @classmethod
+    def delete_unused_file(cls, sha256):
+        """Delete the stored file of content sha256, unless an image has it."""
+        with transaction.atomic():
+            # images of the content being saved hold the lock until committed
+            imagestore.lock(sha256)
+            if not cls.objects.filter(sha256=sha256).exists():
+                imagestore.delete(sha256)
+
     @property
     def filename(self):
         return self.slug + "." + self.extension
 
+    def open(self):
+        """Return binary file object of image."""
+        if not self.sha256:
+            return io.BytesIO(self.data)
+        return imagestore.open_file(self.sha256)
+
+    def read(self):
+        """Return file data of image."""
+        with self.open() as image_file:
+            return image_file.read()
+
     @property
     def data_as_base64(self):
-        return base64.b64encode(self.data).decode("utf-8")
+        return base64.b64encode(self.read()).decode("utf-8")
 
     @property
     def data_size(self):
         """Get image size in MB."""
-        return round(len(self.data) / (1024 * 1024), 2)
+        return round(self.size / (1024 * 1024), 2)
 
     @property
     def raw_url_absolute(self):
@@ -293,6 +401,19 @@ class Image(models.Model):
         )
         return f"//{settings.CANONICAL_HOST}{path}"
 
+    @property
+    def variant_url_absolute(self):
+        """URL of the largest smaller variant, see imagevariants."""
+        path = reverse(
+            "image_variant",
+            kwargs={
+                "slug": self.slug,
+                "width": imagevariants.WIDTHS[-1],
+                "extension": self.extension,
+            },
+        )
+        return f"//{settings.CANONICAL_HOST}{path}"
+
     def get_absolute_url(self):
         path = reverse("image_detail", kwargs={"slug": self.slug})
         return f"//{settings.CANONICAL_HOST}{path}"
@@ -301,7 +422,43 @@ class Image(models.Model):
         return self.name
 
 
-class Page(models.Model):
+class ImageUsage(models.Model):
+    """
+    ImageUsage model holds the total size and number of images of a user,
+    kept up to date on image upload and delete, see imagequota.
+    """
+
+    owner = models.OneToOneField(
+        User, on_delete=models.CASCADE, primary_key=True, related_name="image_usage"
+    )
+    total_bytes = models.BigIntegerField(default=0)
+    image_count = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.owner.username}: {self.image_count} images"
+
+
+class PostImage(models.Model):
+    """
+    PostImage model holds a reference of a post to an image in its body, kept
+    up to date whenever the post is saved, see imagerefs.
+    """
+
+    post = models.ForeignKey(
+        Post, on_delete=models.CASCADE, related_name="image_references"
+    )
+    image = models.ForeignKey(
+        Image, on_delete=models.CASCADE, related_name="post_references"
+    )
+
+    class Meta:
+        unique_together = [["post", "image"]]
+
+    def __str__(self):
+        return f"{self.post_id} -> {self.image_id}"
+
+
+class Page(RenderedMarkdownMixin, models.Model):
     title = models.CharField(max_length=300)
     slug = models.CharField(
         max_length=300,
@@ -317,13 +474,18 @@ class Page(models.Model):
         help_text="If checked, page link will not appear on the blog header.",
     )
 
+    body_html = models.TextField(blank=True, default="", editable=False)
+    body_hash = models.CharField(max_length=64, blank=True, default="", editable=False)
+
+    rendered_fields = {"body": ("body_html", "body_hash")}
+
     class Meta:
         ordering = ["slug"]
         unique_together = [["slug", "owner"]]
 
     @property
     def body_as_html(self):
-        return text_processing.md_to_html(self.body)
+        return self.get_rendered_html("body")
 
     def get_absolute_url(self):
         path = reverse("page_detail", kwargs={"slug": self.slug})
@@ -333,10 +495,30 @@ class Page(models.Model):
         return self.title
 
 
+class Feed(models.Model):
+    """Feed model stores the generated RSS document of each blog."""
+
+    owner = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True)
+    document = models.TextField()
+    stale_on = models.DateField(
+        null=True,
+        blank=True,
+        db_index=True,
+        help_text="Publication date of the next scheduled post, when the document needs regenerating.",
+    )
+    generated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.generated_at.strftime("%c") + ": " + self.owner.username
+
+
 class AnalyticPage(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     path = models.CharField(max_length=300)
-    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    # set when the hit happened, as hits are saved in batches later
+    created_at = models.DateTimeField(
+        default=timezone.now, editable=False, db_index=True
+    )
 
     class Meta:
         ordering = ["-created_at"]
@@ -350,7 +532,10 @@ class AnalyticPage(models.Model):
 
 class AnalyticPost(models.Model):
     post = models.ForeignKey(Post, on_delete=models.CASCADE)
-    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    # set when the hit happened, as hits are saved in batches later
+    created_at = models.DateTimeField(
+        default=timezone.now, editable=False, db_index=True
+    )
 
     class Meta:
         ordering = ["-created_at"]
@@ -359,7 +544,85 @@ class AnalyticPost(models.Model):
         return self.created_at.strftime("%c") + ": " + self.post.title
 
 
-class Comment(models.Model):
+class AnalyticPostDay(models.Model):
+    """AnalyticPostDay model holds daily visit counts of posts, see rollups."""
+
+    post = models.ForeignKey(Post, on_delete=models.CASCADE)
+    date = models.DateField(db_index=True)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        ordering = ["-date"]
+        unique_together = [["post", "date"]]
+
+    def __str__(self):
+        return f"{self.date}: {self.post.title}"
+
+
+class AnalyticPageDay(models.Model):
+    """AnalyticPageDay model holds daily visit counts of pages, see rollups."""
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    path = models.CharField(max_length=300)
+    date = models.DateField(db_index=True)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        ordering = ["-date"]
+        unique_together = [["user", "path", "date"]]
+
+    def __str__(self):
+        return f"{self.date}: {self.user.username} {self.path}"
+
+
+class AnalyticPostVisitors(models.Model):
+    """
+    AnalyticPostVisitors model holds a HyperLogLog sketch of the visitors of a
+    post on a day, see analytics.
+    """
+
+    post = models.ForeignKey(Post, on_delete=models.CASCADE)
+    date = models.DateField(db_index=True)
+    sketch = models.BinaryField()
+
+    class Meta:
+        ordering = ["-date"]
+        unique_together = [["post", "date"]]
+
+    def __str__(self):
+        return f"{self.date}: {self.post.title}"
+
+
+class AnalyticBotDay(models.Model):
+    """AnalyticBotDay model holds daily counts of blog visits by bots, see bots."""
+
+    date = models.DateField(unique=True)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        ordering = ["-date"]
+
+    def __str__(self):
+        return f"{self.date}: {self.count}"
+
+
+class AnalyticRollup(models.Model):
+    """AnalyticRollup model keeps how far analytics are rolled up, per kind."""
+
+    kind = models.CharField(max_length=10, unique=True)
+    last_id = models.BigIntegerField(
+        default=0, help_text="Analytics up to this id are counted in the rollup."
+    )
+    seen_id = models.BigIntegerField(
+        default=0, help_text="Highest analytic id when the rollup last ran."
+    )
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.kind}: {self.last_id}"
+
+
+class Comment(RenderedMarkdownMixin, models.Model):
     post = models.ForeignKey(Post, on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
     body = models.TextField()
@@ -370,12 +633,23 @@ class Comment(models.Model):
         default=False, help_text="True if logged in author has posted comment."
     )
 
+    body_html = models.TextField(blank=True, default="", editable=False)
+    body_hash = models.CharField(max_length=64, blank=True, default="", editable=False)
+
+    rendered_fields = {"body": ("body_html", "body_hash")}
+
     class Meta:
         ordering = ["created_at"]
 
     @property
     def body_as_html(self):
-        return text_processing.md_to_html(self.body)
+        return self.get_rendered_html("body")
+
+    def delete(self, *args, **kwargs):
+        """Delete comment and touch its blog, see signals.touch_comment_owner."""
+        result = super().delete(*args, **kwargs)
+        User.objects.filter(id=self.post.owner_id).update(updated_at=timezone.now())
+        return result
 
     def get_absolute_url(self):
         if self.post.owner.post_altpath_on:
@@ -0,0 +1,142 @@
+"""
+Cache of whole blog pages as served to anonymous visitors.
+
+Pages are keyed by when their blog last changed, the date, host and path. The
+last change is read from the database on every request (see conditional), so
+that pages never need invalidating one by one, and all workers agree on it
+whichever cache backend they share. The cache backend is the "pages" cache in
+settings.
+"""
+
+import functools
+import hashlib
+import time
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import caches
+from django.http import HttpResponse
+from django.middleware.csrf import get_token
+from django.utils import timezone
+from django.utils.crypto import salted_hmac
+
+from main import analytics
+
+# Stand-ins rendered in cacheable pages instead of per-visitor values, which
+# are filled in every time the page is served. Derived from SECRET_KEY so that
+# all workers agree on them and users cannot guess them into their posts.
+CSRF_TOKEN_PLACEHOLDER = salted_hmac("pagecache", "csrf_token").hexdigest()
+TIMESTAMP_PLACEHOLDER = salted_hmac("pagecache", "timestamp").hexdigest()
+
+
+# fields of the blog user that change how its pages are rendered, which pages
+# are keyed by too; blog_conditional reads them along with the last change of
+# the blog, as the copy of host_middleware may be stale (see hosts)
+THEME_FIELDS = ["theme_zialucia", "theme_sansserif"]
+
+# headers not replayed from cached responses, as they are set again or differ
+# once placeholders are filled
+UNCACHED_HEADERS = {"content-length", "x-page-cache"}
+
+
+def is_cacheable(request):
+    # anonymous visitors have neither a session nor pending messages, and
+    # checking cookies avoids the session query of request.user
+    return (
+        request.method in ("GET", "HEAD")
+        and hasattr(request, "blog_user_id")
+        and settings.SESSION_COOKIE_NAME not in request.COOKIES
+        and "messages" not in request.COOKIES
+    )
+
+
+def get_placeholders(request):
+    """
+    Return template context that replaces per-visitor values with
+    placeholders, if the page being rendered is to be cached.
+    """
+    if not getattr(request, "page_cacheable", False):
+        return {}
+    return {
+        "csrf_token": CSRF_TOKEN_PLACEHOLDER,
+        "comment_ts": TIMESTAMP_PLACEHOLDER,
+    }
+
+
+def _fill_placeholders(request, response):
+    if response.streaming:
+        return response
+    content = response.content
+    if CSRF_TOKEN_PLACEHOLDER.encode() in content:
+        # also makes CsrfViewMiddleware set the CSRF cookie of the visitor
+        content = content.replace(
+            CSRF_TOKEN_PLACEHOLDER.encode(), get_token(request).encode()
+        )
+    if TIMESTAMP_PLACEHOLDER.encode() in content:
+        # signed timestamp for the anti-spam time trap in CommentCreate
+        content = content.replace(
+            TIMESTAMP_PLACEHOLDER.encode(), signing.dumps(int(time.time())).encode()
+        )
+    if content is not response.content:
+        response.content = content
+    return response
+
+
+def _get_page_key(request, last_modified):
+    location = request.META["HTTP_HOST"] + request.get_full_path()
+    location_hash = hashlib.sha256(location.encode("utf-8", "surrogatepass"))
+    themes = "".join(str(int(getattr(request, field, False))) for field in THEME_FIELDS)
+    version = f"{last_modified.isoformat()}:{themes}"
+    today = timezone.now().date().isoformat()
+    return f"page:{request.blog_user_id}:{version}:{today}:{location_hash.hexdigest()}"
+
+
+def cache_page(view):
+    """
+    Serve anonymous visitors a cached response of view, when there is one.
+    Analytic hits recorded by the view are recorded again on every cache hit.
+    Must be wrapped by conditional.blog_conditional, which reads when the blog
+    last changed into request.blog_last_modified, and its THEME_FIELDS.
+    """
+
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        last_modified = getattr(request, "blog_last_modified", None)
+        if not is_cacheable(request) or last_modified is None:
+            return view(request, *args, **kwargs)
+
+        cache = caches["pages"]
+        key = _get_page_key(request, last_modified)
+        entry = cache.get(key)
+        if entry is not None:
+            if entry["analytic_hit"]:
+                analytics.save_hit(request, *entry["analytic_hit"])
+            response = HttpResponse(entry["content"], headers=entry["headers"])
+            response["X-Page-Cache"] = "hit"
+            return _fill_placeholders(request, response)
+
+        request.page_cacheable = True
+        response = view(request, *args, **kwargs)
+        if hasattr(response, "render"):
+            response.render()
+
+        if (
+            response.status_code == 200
+            and not response.streaming
+            and not response.cookies
+            and not request.META.get("CSRF_COOKIE_NEEDS_UPDATE")
+        ):
+            entry = {
+                "content": response.content,
+                "headers": {
+                    name: value
+                    for name, value in response.items()
+                    if name.lower() not in UNCACHED_HEADERS
+                },
+                "analytic_hit": getattr(request, "analytic_hit", None),
+            }
+            cache.set(key, entry)
+            response["X-Page-Cache"] = "miss"
+        return _fill_placeholders(request, response)
+
+    return wrapper
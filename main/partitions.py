@@ -0,0 +1,280 @@
+"""
+Monthly range partitioning of the analytics tables on created_at.
+
+Converting a table renames it to <table>_legacy and attaches it as the
+partition of everything before the month after the conversion, so existing
+rows are not copied. Later months each get a partition <table>_pYYYY_MM,
+created ahead of time by the partitionanalytics command, which also drops the
+partitions past the analytics retention. Rows of months without a partition
+yet, eg. while the command is not run, go to the partition <table>_default
+and are moved out when their month gets one.
+"""
+
+import re
+from datetime import UTC, date, datetime
+
+from django.db import transaction
+from django.utils import timezone
+
+_BOUND_RE = re.compile(r"TO \('([^']+)'\)")
+
+
+def _quote(cursor, name):
+    return cursor.db.ops.quote_name(name)
+
+
+def add_months(month, months):
+    """Return first day of the month months after the month of date month."""
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def get_partition_name(table, month):
+    return f"{table}_p{month.year}_{month.month:02}"
+
+
+def get_legacy_partition_name(table):
+    return f"{table}_legacy"
+
+
+def get_default_partition_name(table):
+    return f"{table}_default"
+
+
+def get_legacy_key_name(table):
+    """Name of the index on the unpartitioned table matching the primary key."""
+    return f"{table}_id_created_at"
+
+
+def is_partitioned(cursor, table):
+    cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", [table])
+    row = cursor.fetchone()
+    return row is not None and row[0] == "p"
+
+
+def exists(cursor, name):
+    cursor.execute("SELECT to_regclass(%s) IS NOT NULL", [name])
+    return cursor.fetchone()[0]
+
+
+def get_partitions(cursor, table):
+    """
+    Return list of (name, upper bound datetime) of the range partitions of
+    table, leaving out the default partition.
+    """
+    cursor.execute(
+        """
+        SELECT child.relname, pg_get_expr(child.relpartbound, child.oid)
+        FROM pg_inherits
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE pg_inherits.inhparent = to_regclass(%s)
+        ORDER BY child.relname
+        """,
+        [table],
+    )
+    partitions = []
+    for name, bound in cursor.fetchall():
+        match = _BOUND_RE.search(bound)
+        if match is None:
+            continue
+        upper = datetime.fromisoformat(match.group(1))
+        # naive UTC, like all datetimes with USE_TZ off; bounds of timestamp
+        # columns without time zone are naive already
+        if upper.tzinfo is not None:
+            upper = upper.astimezone(UTC).replace(tzinfo=None)
+        partitions.append((name, upper))
+    return partitions
+
+
+def create_default_partition(cursor, table):
+    """Create the partition of table for rows no other partition is for."""
+    name = get_default_partition_name(table)
+    cursor.execute(
+        f"CREATE TABLE IF NOT EXISTS {_quote(cursor, name)} "
+        f"PARTITION OF {_quote(cursor, table)} DEFAULT"
+    )
+    return name
+
+
+def create_partition(cursor, table, month):
+    """
+    Create partition of table for month, unless it exists, moving the rows of
+    month out of the default partition. Returns its name.
+    """
+    name = get_partition_name(table, month)
+    if exists(cursor, name):
+        return name
+    q_table, q_name = _quote(cursor, table), _quote(cursor, name)
+    lower = f"{month.isoformat()} 00:00:00+00"
+    upper = f"{add_months(month, 1).isoformat()} 00:00:00+00"
+    create_sql = (
+        f"CREATE TABLE {q_name} PARTITION OF {q_table} "
+        f"FOR VALUES FROM ('{lower}') TO ('{upper}')"
+    )
+
+    default = get_default_partition_name(table)
+    q_default = _quote(cursor, default)
+    has_default_rows = False
+    if exists(cursor, default):
+        cursor.execute(
+            f"SELECT EXISTS (SELECT 1 FROM {q_default} "
+            "WHERE created_at >= %s AND created_at < %s)",
+            [lower, upper],
+        )
+        has_default_rows = cursor.fetchone()[0]
+    if not has_default_rows:
+        cursor.execute(create_sql)
+        return name
+
+    # a partition cannot be created for rows the default partition holds, so
+    # they are moved while the default partition is detached
+    with transaction.atomic(using=cursor.db.alias):
+        cursor.execute(f"ALTER TABLE {q_table} DETACH PARTITION {q_default}")
+        cursor.execute(create_sql)
+        cursor.execute(
+            f"WITH moved AS (DELETE FROM {q_default} "
+            "WHERE created_at >= %s AND created_at < %s RETURNING *) "
+            f"INSERT INTO {q_name} SELECT * FROM moved",
+            [lower, upper],
+        )
+        cursor.execute(f"ALTER TABLE {q_table} ATTACH PARTITION {q_default} DEFAULT")
+    return name
+
+
+def get_max_id(cursor, name):
+    cursor.execute(f"SELECT MAX(id) FROM {_quote(cursor, name)}")
+    return cursor.fetchone()[0]
+
+
+def get_row_estimate(cursor, name):
+    """Return row count of table name as estimated by the planner statistics."""
+    cursor.execute("SELECT reltuples FROM pg_class WHERE oid = to_regclass(%s)", [name])
+    return max(int(cursor.fetchone()[0]), 0)
+
+
+def drop_partition(cursor, table, name, detach_only=False):
+    cursor.execute(
+        f"ALTER TABLE {_quote(cursor, table)} DETACH PARTITION {_quote(cursor, name)}"
+    )
+    if not detach_only:
+        cursor.execute(f"DROP TABLE {_quote(cursor, name)}")
+
+
+def convert(cursor, table, months_ahead=3):
+    """
+    Convert table into a table partitioned by month of created_at, keeping
+    its name, columns, id sequence, constraints and index names for Django.
+    Does nothing if table is partitioned already.
+    """
+    if is_partitioned(cursor, table):
+        return
+    legacy = get_legacy_partition_name(table)
+    sequence = f"{table}_id_seq"
+    legacy_key = get_legacy_key_name(table)
+    q_table, q_legacy = _quote(cursor, table), _quote(cursor, legacy)
+    bound = add_months(timezone.now().date(), 1)
+
+    # ids continue from the same sequence position
+    cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [table])
+    old_sequence = cursor.fetchone()[0]
+    cursor.execute(
+        f"SELECT GREATEST(MAX(id), (SELECT last_value FROM {old_sequence})) "
+        f"FROM {q_table}"
+    )
+    next_id = (cursor.fetchone()[0] or 0) + 1
+
+    cursor.execute(
+        "SELECT indexname, indexdef FROM pg_indexes "
+        "WHERE schemaname = current_schema() AND tablename = %s "
+        "AND indexname != %s",
+        [table, legacy_key],
+    )
+    indexes = cursor.fetchall()
+    cursor.execute(
+        "SELECT conname, contype, pg_get_constraintdef(oid) FROM pg_constraint "
+        "WHERE conrelid = to_regclass(%s)",
+        [table],
+    )
+    constraints = cursor.fetchall()
+    primary_key_names = {name for name, contype, _ in constraints if contype == "p"}
+    cursor.execute("SELECT current_schema()")
+    schema = cursor.fetchone()[0]
+
+    cursor.execute(f"ALTER TABLE {q_table} RENAME TO {q_legacy}")
+    cursor.execute(f"ALTER TABLE {q_legacy} ALTER COLUMN id DROP IDENTITY IF EXISTS")
+    cursor.execute(f"ALTER TABLE {q_legacy} ALTER COLUMN id DROP DEFAULT")
+    # a serial id leaves its sequence behind, an identity one does not
+    cursor.execute(f"DROP SEQUENCE IF EXISTS {old_sequence}")
+    # free the names of indexes and constraints for the partitioned table
+    for name, _ in indexes:
+        cursor.execute(
+            f"ALTER INDEX {_quote(cursor, name)} "
+            f"RENAME TO {_quote(cursor, f'{name[:48]}_legacy')}"
+        )
+    for name, contype, _ in constraints:
+        if contype != "p":
+            cursor.execute(
+                f"ALTER TABLE {q_legacy} RENAME CONSTRAINT {_quote(cursor, name)} "
+                f"TO {_quote(cursor, f'{name[:48]}_legacy')}"
+            )
+
+    cursor.execute(
+        f"CREATE TABLE {q_table} (LIKE {q_legacy} INCLUDING DEFAULTS) "
+        "PARTITION BY RANGE (created_at)"
+    )
+    cursor.execute(
+        f"CREATE SEQUENCE {_quote(cursor, sequence)} "
+        f"START WITH {next_id} OWNED BY {q_table}.id"
+    )
+    cursor.execute(
+        f"ALTER TABLE {q_table} ALTER COLUMN id "
+        f"SET DEFAULT nextval('{sequence}'::regclass)"
+    )
+    # primary keys of partitioned tables must include the partition key
+    for name in primary_key_names:
+        cursor.execute(
+            f"ALTER TABLE {q_table} ADD CONSTRAINT {_quote(cursor, name)} "
+            "PRIMARY KEY (id, created_at)"
+        )
+    for name, indexdef in indexes:
+        if name not in primary_key_names:
+            cursor.execute(
+                indexdef.replace(f" ON {schema}.{table} ", f" ON {q_table} ")
+            )
+    for name, contype, definition in constraints:
+        if contype != "p":
+            cursor.execute(
+                f"ALTER TABLE {q_table} ADD CONSTRAINT {_quote(cursor, name)} "
+                f"{definition}"
+            )
+
+    # with an index matching the primary key and a constraint matching the
+    # partition bound, the attach neither builds an index nor scans the table;
+    # the index can be created concurrently ahead of the conversion (README)
+    cursor.execute(
+        f"CREATE UNIQUE INDEX IF NOT EXISTS {_quote(cursor, legacy_key)} "
+        f"ON {q_legacy} (id, created_at)"
+    )
+    for name in primary_key_names:
+        # swap in a primary key matching the one of the partitioned table, for
+        # the attach to take over
+        cursor.execute(
+            f"ALTER TABLE {q_legacy} "
+            f"DROP CONSTRAINT {_quote(cursor, f'{name[:48]}_legacy')}, "
+            f"ADD CONSTRAINT {_quote(cursor, f'{legacy}_pkey')} "
+            f"PRIMARY KEY USING INDEX {_quote(cursor, legacy_key)}"
+        )
+    check = _quote(cursor, f"{table}_legacy_bound")
+    cursor.execute(
+        f"ALTER TABLE {q_legacy} ADD CONSTRAINT {check} "
+        f"CHECK (created_at < '{bound.isoformat()} 00:00:00+00')"
+    )
+    cursor.execute(
+        f"ALTER TABLE {q_table} ATTACH PARTITION {q_legacy} "
+        f"FOR VALUES FROM (MINVALUE) TO ('{bound.isoformat()} 00:00:00+00')"
+    )
+    cursor.execute(f"ALTER TABLE {q_legacy} DROP CONSTRAINT {check}")
+
+    for months in range(months_ahead + 1):
+        create_partition(cursor, table, add_months(bound, months))
+    create_default_partition(cursor, table)
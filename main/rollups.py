@@ -0,0 +1,221 @@
+"""
+Daily rollups of analytics, so that visit counts are read from one row per
+post or page and day instead of one row per visit.
+
+The rollupanalytics command adds analytics to the rollups in order of id, up
+to the highest id seen on its previous run, so that rows of transactions
+still committing when an id was first seen are not skipped. The id up to
+which analytics are rolled up is kept in AnalyticRollup, and reads add the
+counts of the analytics after it (the tail) to those of the rollups.
+"""
+
+from datetime import datetime
+
+from django.db import transaction
+from django.db.models import Count, Max, Sum
+from django.db.models.functions import TruncDate
+
+from main import models
+
+# kind: (analytic model, rollup model, fields a rollup row is counted by)
+ROLLUPS = {
+    "post": (models.AnalyticPost, models.AnalyticPostDay, ["post_id"]),
+    "page": (models.AnalyticPage, models.AnalyticPageDay, ["user_id", "path"]),
+}
+
+
+def get_last_id(kind):
+    """Return id of the last analytic of kind counted in its rollup."""
+    last_id = (
+        models.AnalyticRollup.objects.filter(kind=kind)
+        .values_list("last_id", flat=True)
+        .first()
+    )
+    return last_id or 0
+
+
+def roll_up_batch(kind, batch_size):
+    """
+    Add the next batch of analytics of kind to the rollups, as far as the
+    previous run has seen. Returns the number of analytics rolled up, None when
+    there are none left.
+    """
+    analytic_model, day_model, fields = ROLLUPS[kind]
+    with transaction.atomic():
+        # lock so that concurrent runs do not count the same analytics twice
+        rollup, _ = models.AnalyticRollup.objects.select_for_update().get_or_create(
+            kind=kind
+        )
+        if rollup.last_id >= rollup.seen_id:
+            return None
+        upper_id = min(rollup.last_id + batch_size, rollup.seen_id)
+
+        analytics = analytic_model.objects.filter(
+            id__gt=rollup.last_id, id__lte=upper_id
+        )
+        counts = {
+            (*(row[field] for field in fields), row["date"]): row["visits"]
+            for row in analytics.order_by()
+            .values(*fields, date=TruncDate("created_at"))
+            .annotate(visits=Count("id"))
+        }
+        count = sum(counts.values())
+        add_counts(day_model, fields, counts)
+
+        rollup.last_id = upper_id
+        rollup.save(update_fields=["last_id", "updated_at"])
+    return count
+
+
+def add_counts(day_model, fields, counts):
+    """Add counts, keyed by (*fields, date), to the rows of day_model."""
+    if not counts:
+        return
+    existing_rows = day_model.objects.filter(
+        **{
+            f"{field}__in": {key[index] for key in counts}
+            for index, field in enumerate([*fields, "date"])
+        }
+    )
+    updated_rows = []
+    for row in existing_rows:
+        key = (*(getattr(row, field) for field in fields), row.date)
+        if key in counts:
+            row.count += counts.pop(key)
+            updated_rows.append(row)
+    day_model.objects.bulk_update(updated_rows, ["count"])
+    day_model.objects.bulk_create(
+        day_model(**dict(zip([*fields, "date"], key, strict=True)), count=count)
+        for key, count in counts.items()
+    )
+
+
+def mark_seen(kind):
+    """Note the highest analytic id, to be rolled up on the next run."""
+    analytic_model = ROLLUPS[kind][0]
+    seen_id = analytic_model.objects.aggregate(Max("id"))["id__max"] or 0
+    models.AnalyticRollup.objects.update_or_create(
+        kind=kind, defaults={"seen_id": seen_id}
+    )
+    return seen_id
+
+
+def get_day_counts(kind, since, **filters):
+    """Return dict of date to visit count since date of analytics of kind."""
+    analytic_model, day_model, _ = ROLLUPS[kind]
+    day_counts = dict(
+        day_model.objects.filter(date__gte=since, **filters).values_list(
+            "date", "count"
+        )
+    )
+    tail = (
+        analytic_model.objects.filter(
+            id__gt=get_last_id(kind),
+            created_at__gte=datetime.combine(since, datetime.min.time()),
+            **filters,
+        )
+        .order_by()
+        .values(date=TruncDate("created_at"))
+        .annotate(visits=Count("id"))
+    )
+    for row in tail:
+        day_counts[row["date"]] = day_counts.get(row["date"], 0) + row["visits"]
+    return day_counts
+
+
+def iter_day_counts(kind, chunk_size=2000, **filters):
+    """
+    Yield (*values of fields, date, visit count) of analytics of kind, by date.
+    Rollups are read with a server-side cursor, chunk_size rows at a time.
+    """
+    analytic_model, day_model, fields = ROLLUPS[kind]
+    tail = {
+        (*(row[field] for field in fields), row["date"]): row["visits"]
+        for row in analytic_model.objects.filter(id__gt=get_last_id(kind), **filters)
+        .order_by()
+        .values(*fields, date=TruncDate("created_at"))
+        .annotate(visits=Count("id"))
+    }
+    rows = (
+        day_model.objects.filter(**filters)
+        .order_by("date", *fields)
+        .values_list(*fields, "date", "count")
+        .iterator(chunk_size=chunk_size)
+    )
+    for *values, date, count in rows:
+        key = (*values, date)
+        yield (*key, count + tail.pop(key, 0))
+    # the tail is of the latest days, after those rolled up
+    for key in sorted(tail, key=lambda key: (key[-1], *key[:-1])):
+        yield (*key, tail[key])
+
+
+def _count_by(queryset, fields, aggregate, limit=None):
+    queryset = queryset.order_by().values(*fields).annotate(visits=aggregate)
+    if limit is not None:
+        queryset = queryset.order_by("-visits")[:limit]
+    return {tuple(row[field] for field in fields): row["visits"] for row in queryset}
+
+
+def get_top_counts(kind, fields, limit, date=None):
+    """
+    Return list of (values of fields, visit count) of the most visited values
+    of fields, of all time or of date. fields are lookups valid on both the
+    analytic and rollup model of kind, eg. ["post__owner_id"].
+    """
+    analytic_model, day_model, _ = ROLLUPS[kind]
+    analytics = analytic_model.objects.filter(id__gt=get_last_id(kind))
+    days = day_model.objects.all()
+    if date is not None:
+        analytics = analytics.filter(created_at__date=date)
+        days = days.filter(date=date)
+
+    tail_counts = _count_by(analytics, fields, Count("id"))
+    counts = _count_by(days, fields, Sum("count"), limit=limit)
+
+    # values visited since the last rollup can make it to the top with their
+    # rolled up counts being out of it, so get those too
+    missing = {key for key in tail_counts if key not in counts}
+    if missing:
+        missing_days = days.filter(
+            **{
+                f"{field}__in": {key[index] for key in missing}
+                for index, field in enumerate(fields)
+            }
+        )
+        for key, count in _count_by(missing_days, fields, Sum("count")).items():
+            if key in missing:
+                counts[key] = count
+
+    for key, count in tail_counts.items():
+        counts[key] = counts.get(key, 0) + count
+    return sorted(counts.items(), key=lambda item: -item[1])[:limit]
+
+
+def get_total(kind, date=None):
+    """Return visit count of analytics of kind, of all time or of date."""
+    analytic_model, day_model, _ = ROLLUPS[kind]
+    analytics = analytic_model.objects.filter(id__gt=get_last_id(kind))
+    days = day_model.objects.all()
+    if date is not None:
+        analytics = analytics.filter(created_at__date=date)
+        days = days.filter(date=date)
+    return (days.aggregate(Sum("count"))["count__sum"] or 0) + analytics.count()
+
+
+def get_top_posts(limit, date=None):
+    """
+    Return list of the most visited posts, of all time or of date, with their
+    owner and a visit_count attribute.
+    """
+    visit_counts = {
+        post_id: count
+        for (post_id,), count in get_top_counts("post", ["post_id"], limit, date)
+    }
+    posts = models.Post.objects.filter(id__in=visit_counts).select_related("owner")
+    post_list = []
+    for post in posts:
+        post.visit_count = visit_counts[post.id]
+        post_list.append(post)
+    post_list.sort(key=lambda post: (-post.visit_count, -post.id))
+    return post_list
@@ -0,0 +1,102 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from main import feeds, hosts, imagequota, imagerefs, models
+
+
+@receiver([post_save, post_delete], sender=models.User)
+def invalidate_blog_hosts(sender, instance, **kwargs):
+    hosts.invalidate_blog(instance.username, instance.custom_domain)
+
+
+@receiver(post_save, sender=models.User)
+def add_blog_domains(sender, instance, **kwargs):
+    hosts.domain_set.add(instance.username, instance.custom_domain)
+
+
+@receiver(post_save, sender=models.User)
+def invalidate_user_feed(sender, instance, created, update_fields=None, **kwargs):
+    # a new blog has no feed yet, and last_login is not in it
+    if created or update_fields == {"last_login"}:
+        return
+    feeds.invalidate_feed(instance.id)
+
+
+def _touch_user(user_id):
+    # changes that leave no timestamp of their own to compute the blog's
+    # conditional GET validators from
+    models.User.objects.filter(id=user_id).update(updated_at=timezone.now())
+
+
+@receiver(post_save, sender=models.User)
+def touch_user(sender, instance, update_fields=None, **kwargs):
+    # saving some fields leaves updated_at as it was, eg. is_premium from
+    # billing, and logging in only updates last_login, not shown on the blog
+    if update_fields is None or "updated_at" in update_fields:
+        return
+    if update_fields == {"last_login"}:
+        return
+    _touch_user(instance.id)
+
+
+@receiver(post_delete, sender=models.Post)
+@receiver(post_delete, sender=models.Page)
+def touch_owner(sender, instance, **kwargs):
+    _touch_user(instance.owner_id)
+
+
+@receiver(post_save, sender=models.Comment)
+def touch_comment_owner(sender, instance, **kwargs):
+    # deleting a comment touches the owner in Comment.delete, as a post_delete
+    # receiver would keep comments from being deleted in bulk with their post
+    if models.Comment.post.is_cached(instance):
+        _touch_user(instance.post.owner_id)
+        return
+    owner_id = (
+        models.Post.objects.filter(id=instance.post_id)
+        .values_list("owner_id", flat=True)
+        .first()
+    )
+    if owner_id is not None:
+        _touch_user(owner_id)
+
+
+@receiver(post_save, sender=models.Post)
+def update_post_image_references(
+    sender, instance, created, update_fields=None, **kwargs
+):
+    if update_fields is not None and "body" not in update_fields:
+        return
+    # a new post refers to no images unless its body does
+    if created and not imagerefs.get_image_slugs(instance.body):
+        return
+    imagerefs.update({instance.id: instance.body})
+
+
+@receiver([post_save, post_delete], sender=models.Post)
+def invalidate_post_feed(sender, instance, **kwargs):
+    # the feed is generated again on next poll, so that saving a post does not
+    # wait for it, and a user being deleted along with their posts gets none
+    feeds.invalidate_feed(instance.owner_id)
+
+
+@receiver(post_delete, sender=models.Image)
+def delete_image_file(sender, instance, **kwargs):
+    if not instance.sha256:
+        return
+
+    # other images may have the same content
+    transaction.on_commit(lambda: models.Image.delete_unused_file(instance.sha256))
+
+
+@receiver(post_save, sender=models.Image)
+def add_image_usage(sender, instance, created, **kwargs):
+    if created:
+        imagequota.add_usage(instance.owner_id, instance.size, 1)
+
+
+@receiver(post_delete, sender=models.Image)
+def remove_image_usage(sender, instance, **kwargs):
+    imagequota.add_usage(instance.owner_id, -instance.size, -1)
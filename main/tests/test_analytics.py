@@ -1,8 +1,17 @@
+import json
+import random
+from datetime import timedelta
+from io import StringIO
+from unittest.mock import patch
+
 from django.conf import settings
-from django.test import TestCase
+from django.core.management import call_command
+from django.test import TestCase, TransactionTestCase, override_settings
 from django.urls import reverse
+from django.utils import timezone
 
-from main import models
+from main import analytics, bots, models, rollups
+from main.hyperloglog import HyperLogLog
 
 
 class PostAnalyticAnonTestCase(TestCase):
@@ -24,6 +33,7 @@ class PostAnalyticAnonTestCase(TestCase):
             reverse("post_detail", args=(self.post.slug,)),
             # needs HTTP_HOST because we need to request it on the subdomain
             HTTP_HOST=self.user.username + "." + settings.CANONICAL_HOST,
+            HTTP_USER_AGENT="Firefox/128.0",
         )
         self.assertEqual(response.status_code, 200)
         self.assertEqual(models.AnalyticPost.objects.filter(post=self.post).count(), 1)
@@ -46,6 +56,7 @@ class PostAnalyticTestCase(TestCase):
         response = self.client.get(
             reverse("post_detail", args=(self.post.slug,)),
             HTTP_HOST=self.user.username + "." + settings.CANONICAL_HOST,
+            HTTP_USER_AGENT="Firefox/128.0",
         )
         self.assertEqual(response.status_code, 200)
         self.assertFalse(models.AnalyticPost.objects.filter(post=self.post).exists())
@@ -71,6 +82,7 @@ class PageAnalyticAnonTestCase(TestCase):
             reverse("page_detail", args=(self.page.slug,)),
             # needs HTTP_HOST because we need to request it on the subdomain
             HTTP_HOST=self.user.username + "." + settings.CANONICAL_HOST,
+            HTTP_USER_AGENT="Firefox/128.0",
         )
         self.assertEqual(response.status_code, 200)
         self.assertEqual(
@@ -97,6 +109,7 @@ class PageAnalyticTestCase(TestCase):
             reverse("page_detail", args=(self.page.slug,)),
             # needs HTTP_HOST because we need to request it on the subdomain
             HTTP_HOST=self.user.username + "." + settings.CANONICAL_HOST,
+            HTTP_USER_AGENT="Firefox/128.0",
         )
         self.assertEqual(response.status_code, 200)
         self.assertFalse(
@@ -115,6 +128,7 @@ class PageAnalyticIndexTestCase(TestCase):
             reverse("index"),
             # needs HTTP_HOST because we need to request it on the subdomain
             HTTP_HOST=self.user.username + "." + settings.CANONICAL_HOST,
+            HTTP_USER_AGENT="Firefox/128.0",
         )
         self.assertEqual(response.status_code, 200)
         self.assertEqual(models.AnalyticPage.objects.filter(path="index").count(), 1)
@@ -131,6 +145,7 @@ class PageAnalyticRSSTestCase(TestCase):
             reverse("rss_feed"),
             # needs HTTP_HOST because we need to request it on the subdomain
             HTTP_HOST=self.user.username + "." + settings.CANONICAL_HOST,
+            HTTP_USER_AGENT="Firefox/128.0",
         )
         self.assertEqual(response.status_code, 200)
         self.assertEqual(models.AnalyticPage.objects.filter(path="rss").count(), 1)
@@ -177,6 +192,7 @@ class PostAnalyticDetailTestCase(TestCase):
         self.client.get(
             reverse("post_detail", args=(self.post.slug,)),
             HTTP_HOST=self.user.username + "." + settings.CANONICAL_HOST,
+            HTTP_USER_AGENT="Firefox/128.0",
         )
 
         # need to login again to access analytic post detail dashboard page
@@ -214,6 +230,7 @@ class PageAnalyticDetailTestCase(TestCase):
         self.client.get(
             reverse("page_detail", args=(self.page.slug,)),
             HTTP_HOST=self.user.username + "." + settings.CANONICAL_HOST,
+            HTTP_USER_AGENT="Firefox/128.0",
         )
 
         # need to login again to access analytic page detail dashboard page
@@ -246,6 +263,7 @@ class PageAnalyticDetailIndexTestCase(TestCase):
         self.client.get(
             reverse("index"),
             HTTP_HOST=self.user.username + "." + settings.CANONICAL_HOST,
+            HTTP_USER_AGENT="Firefox/128.0",
         )
 
         # login again to access analytic page detail dashboard page
@@ -278,6 +296,7 @@ class PageAnalyticDetailRSSTestCase(TestCase):
         self.client.get(
             reverse("rss_feed"),
             HTTP_HOST=self.user.username + "." + settings.CANONICAL_HOST,
+            HTTP_USER_AGENT="Firefox/128.0",
         )
 
         # login again to access analytic page detail dashboard page
@@ -294,3 +313,434 @@ class PageAnalyticDetailRSSTestCase(TestCase):
             '<svg version="1.1" viewBox="0 0 500 192" xmlns="http://www.w3.org/2000/svg">',
         )
         self.assertContains(response, "1 hits")
+
+
+@override_settings(
+    ANALYTICS_BUFFER_SIZE=3, ANALYTICS_BUFFER_MAX=5, ANALYTICS_FLUSH_INTERVAL=3600
+)
+class AnalyticBufferTestCase(TestCase):
+    """Test analytic hits are buffered and saved in batches."""
+
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice")
+        self.post = models.Post.objects.create(
+            owner=self.user, title="Welcome post", slug="welcome-post", body="Hi."
+        )
+        self.buffer = analytics.HitBuffer()
+
+    def tearDown(self):
+        self.buffer.flush()
+        analytics.hit_buffer.flush()
+
+    def test_saved_when_full(self):
+        for _ in range(2):
+            self.client.get(
+                reverse("post_detail", args=(self.post.slug,)),
+                HTTP_HOST=self.user.username + "." + settings.CANONICAL_HOST,
+                HTTP_USER_AGENT="Firefox/128.0",
+            )
+        self.assertFalse(models.AnalyticPost.objects.exists())
+
+        self.client.get(
+            reverse("post_detail", args=(self.post.slug,)),
+            HTTP_HOST=self.user.username + "." + settings.CANONICAL_HOST,
+            HTTP_USER_AGENT="Firefox/128.0",
+        )
+        self.assertEqual(models.AnalyticPost.objects.filter(post=self.post).count(), 3)
+
+    def test_flush(self):
+        analytic = analytics.make_analytic("page", self.user.id, "index")
+        self.buffer.add(analytic)
+        self.buffer.add(analytics.make_analytic("post", self.post.id))
+        with self.assertNumQueries(2):
+            self.assertEqual(self.buffer.flush(), 2)
+        self.assertEqual(self.buffer.flushed_count, 2)
+
+        # time of the hit is kept, not the time of the flush
+        saved = models.AnalyticPage.objects.get(user=self.user)
+        self.assertEqual(saved.created_at, analytic.created_at)
+
+    def test_dropped_when_over_max(self):
+        with self.settings(ANALYTICS_BUFFER_SIZE=10):
+            for _ in range(7):
+                self.buffer.add(analytics.make_analytic("post", self.post.id))
+        self.assertEqual(self.buffer.dropped_count, 2)
+        self.assertEqual(self.buffer.flush(), 5)
+
+    def test_unknown_kind(self):
+        with self.assertRaises(ValueError):
+            analytics.make_analytic("image", 1)
+
+
+@override_settings(
+    ANALYTICS_BUFFER_SIZE=10, ANALYTICS_BUFFER_MAX=10, ANALYTICS_FLUSH_INTERVAL=0.1
+)
+class AnalyticBufferCommitTestCase(TransactionTestCase):
+    """Test buffered hits saved outside of the request that recorded them."""
+
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice")
+        self.post = models.Post.objects.create(
+            owner=self.user, title="Welcome post", slug="welcome-post", body="Hi."
+        )
+        self.buffer = analytics.HitBuffer()
+
+    def test_saved_on_timer(self):
+        self.buffer.add(analytics.make_analytic("post", self.post.id))
+        self.buffer.timer.join(timeout=5)
+        self.assertEqual(models.AnalyticPost.objects.count(), 1)
+        self.assertEqual(self.buffer.flushed_count, 1)
+
+    def test_deleted_post_dropped(self):
+        other_post = models.Post.objects.create(
+            owner=self.user, title="Other post", slug="other-post", body="Hi."
+        )
+        self.buffer.add(analytics.make_analytic("post", self.post.id))
+        self.buffer.add(analytics.make_analytic("post", other_post.id))
+        other_post.delete()
+
+        self.assertEqual(self.buffer.flush(), 1)
+        self.assertEqual(self.buffer.dropped_count, 1)
+        self.assertEqual(models.AnalyticPost.objects.get().post, self.post)
+
+    def test_deleted_post_sketch_dropped(self):
+        other_post = models.Post.objects.create(
+            owner=self.user, title="Other post", slug="other-post", body="Hi."
+        )
+        self.buffer.add(analytics.make_analytic("post", self.post.id), 1 << 54)
+        self.buffer.add(analytics.make_analytic("post", other_post.id), 2 << 54)
+        other_post.delete()
+
+        self.buffer.flush()
+        self.assertEqual(models.AnalyticPostVisitors.objects.get().post, self.post)
+        self.assertFalse(self.buffer.sketches)
+
+
+class HyperLogLogTestCase(TestCase):
+    """Test HyperLogLog sketches estimate distinct values and merge."""
+
+    def setUp(self):
+        rng = random.Random(42)
+        self.values = [rng.getrandbits(64) for _ in range(20_000)]
+
+    def test_count(self):
+        sketch = HyperLogLog()
+        self.assertEqual(sketch.count(), 0)
+        for value in self.values[:10]:
+            sketch.add(value)
+            sketch.add(value)
+        self.assertEqual(sketch.count(), 10)
+
+        for value in self.values:
+            sketch.add(value)
+        self.assertAlmostEqual(sketch.count(), 20_000, delta=2_000)
+        self.assertEqual(len(bytes(sketch)), 1024)
+
+    def test_merge(self):
+        first, second = HyperLogLog(), HyperLogLog()
+        for value in self.values[:12_000]:
+            first.add(value)
+        for value in self.values[8_000:]:
+            second.add(value)
+        first.merge(second)
+        self.assertAlmostEqual(first.count(), 20_000, delta=2_000)
+
+        # merged sketch equals sketch of all values
+        everything = HyperLogLog()
+        for value in self.values:
+            everything.add(value)
+        self.assertEqual(bytes(first), bytes(everything))
+
+    def test_invalid_registers(self):
+        with self.assertRaises(ValueError):
+            HyperLogLog(b"\x00" * 10)
+
+
+class UniqueVisitorsTestCase(TestCase):
+    """Test post visits are counted in unique visitors per day."""
+
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice")
+        self.post = models.Post.objects.create(
+            owner=self.user, title="Welcome post", slug="welcome-post", body="Hi."
+        )
+
+    def visit(self, user_agent, address="192.0.2.1"):
+        self.client.get(
+            reverse("post_detail", args=(self.post.slug,)),
+            HTTP_HOST=self.user.username + "." + settings.CANONICAL_HOST,
+            HTTP_USER_AGENT=user_agent,
+            HTTP_X_FORWARDED_FOR=address,
+        )
+
+    def test_unique_visitors(self):
+        for _ in range(3):
+            self.visit("Firefox")
+        self.visit("Chrome")
+        self.visit("Firefox", address="192.0.2.2")
+
+        today = timezone.now().date()
+        day_visitors, total = analytics.get_unique_visitors(self.post.id, today)
+        self.assertEqual(day_visitors, {today: 3})
+        self.assertEqual(total, 3)
+        self.assertEqual(models.AnalyticPost.objects.count(), 5)
+
+        # only the sketch is saved
+        self.assertEqual(len(models.AnalyticPostVisitors.objects.get().sketch), 1024)
+
+        self.client.force_login(self.user)
+        response = self.client.get(
+            reverse("analytic_post_detail", args=(self.post.slug,))
+        )
+        self.assertContains(response, "5 hits, about 3 unique visitors.")
+
+    def test_merged_across_days(self):
+        today = timezone.now().date()
+        yesterday = today - timedelta(days=1)
+        for date, visitors in [(yesterday, [1, 2]), (today, [2, 3])]:
+            sketch = HyperLogLog()
+            for visitor in visitors:
+                sketch.add(visitor << 54)
+            models.AnalyticPostVisitors.objects.create(
+                post=self.post, date=date, sketch=bytes(sketch)
+            )
+
+        day_visitors, total = analytics.get_unique_visitors(self.post.id, yesterday)
+        self.assertEqual(day_visitors, {yesterday: 2, today: 2})
+        self.assertEqual(total, 3)
+
+    @override_settings(ANALYTICS_BUFFER_SIZE=10, ANALYTICS_FLUSH_INTERVAL=3600)
+    def test_buffered_sketches_merged(self):
+        buffer = analytics.HitBuffer()
+        for visitor in [1 << 54, 2 << 54]:
+            buffer.add(analytics.make_analytic("post", self.post.id), visitor)
+        buffer.flush()
+        buffer.add(analytics.make_analytic("post", self.post.id), 3 << 54)
+        buffer.add(analytics.make_analytic("page", self.user.id, "index"), 4 << 54)
+        buffer.flush()
+
+        _, total = analytics.get_unique_visitors(self.post.id, timezone.now().date())
+        self.assertEqual(total, 3)
+
+
+class BotAnalyticTestCase(TestCase):
+    """Test visits by bots are counted per day instead of saved."""
+
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice")
+        self.post = models.Post.objects.create(
+            owner=self.user, title="Welcome post", slug="welcome-post", body="Hi."
+        )
+        bots.address_rates.counts.clear()
+
+    def visit(self, path, user_agent, address="192.0.2.1"):
+        return self.client.get(
+            path,
+            HTTP_HOST=self.user.username + "." + settings.CANONICAL_HOST,
+            HTTP_USER_AGENT=user_agent,
+            HTTP_X_FORWARDED_FOR=address,
+        )
+
+    def test_user_agents(self):
+        for user_agent in [
+            "Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)",
+            "Feedly/1.0 (+http://www.feedly.com/fetcher.html; 12 subscribers)",
+            "Mozilla/5.0 (compatible; UptimeRobot/2.0; http://www.uptimerobot.com/)",
+            "Mozilla/5.0 (compatible; bingbot/2.0; +http://www.bing.com/bingbot.htm)",
+            "Mozilla/5.0 (compatible; Bot)",
+            "curl/8.5.0",
+            "python-requests/2.32.3",
+        ]:
+            self.assertTrue(bots.is_bot_user_agent(user_agent), user_agent)
+        for user_agent in [
+            "Mozilla/5.0 (X11; Linux x86_64; rv:128.0) Gecko/20100101 Firefox/128.0",
+            "Mozilla/5.0 (iPhone; CPU iPhone OS 17_5 like Mac OS X) "
+            "AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.5 Mobile/15E148 "
+            "Safari/604.1",
+            "Mozilla/5.0 (Linux; Android 10; Cubot KingKong 5 Pro) "
+            "AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0.0.0 Mobile "
+            "Safari/537.36",
+            "Mozilla/5.0 (Linux; Android 9; Bottle) Firefox/128.0",
+        ]:
+            self.assertFalse(bots.is_bot_user_agent(user_agent), user_agent)
+
+    def test_bot_counted(self):
+        self.visit(reverse("post_detail", args=(self.post.slug,)), "Googlebot/2.1")
+        self.visit(reverse("index"), "curl/8.5.0")
+        self.visit(reverse("post_detail", args=(self.post.slug,)), "Firefox/128.0")
+
+        self.assertEqual(models.AnalyticPost.objects.count(), 1)
+        self.assertFalse(models.AnalyticPage.objects.exists())
+        bot_day = models.AnalyticBotDay.objects.get()
+        self.assertEqual(bot_day.date, timezone.now().date())
+        self.assertEqual(bot_day.count, 2)
+
+        self.user.is_superuser = True
+        self.user.save()
+        self.client.force_login(self.user)
+        response = self.client.get(
+            reverse("moderation_summary", args=(timezone.now().date().isoformat(),))
+        )
+        self.assertContains(response, "Bot visits: 2")
+
+    def test_no_user_agent_counted(self):
+        # browsers always send a User-Agent
+        self.visit(reverse("index"), "")
+        self.visit(reverse("index"), "  ")
+        self.client.get(
+            reverse("index"),
+            HTTP_HOST=self.user.username + "." + settings.CANONICAL_HOST,
+        )
+
+        self.assertFalse(models.AnalyticPage.objects.exists())
+        self.assertEqual(models.AnalyticBotDay.objects.get().count, 3)
+
+    @override_settings(ANALYTICS_BOT_IP_RATE=2)
+    def test_address_rate(self):
+        # all in the same minute
+        with patch.object(bots.time, "monotonic", return_value=60.0):
+            for _ in range(4):
+                self.visit(reverse("index"), "Firefox/128.0")
+            self.visit(reverse("index"), "Firefox/128.0", address="192.0.2.2")
+
+        self.assertEqual(models.AnalyticPage.objects.count(), 3)
+        self.assertEqual(models.AnalyticBotDay.objects.get().count, 2)
+
+
+class AnalyticRollupReadTestCase(TestCase):
+    """Test visit counts add analytics not yet rolled up to the rollups."""
+
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice")
+        self.post = models.Post.objects.create(
+            owner=self.user, title="Welcome post", slug="welcome-post", body="Hi."
+        )
+        self.other_post = models.Post.objects.create(
+            owner=self.user, title="Other post", slug="other-post", body="Hi."
+        )
+        for _ in range(3):
+            models.AnalyticPost.objects.create(post=self.other_post)
+        models.AnalyticPost.objects.create(post=self.post)
+        call_command("rollupanalytics", stdout=StringIO())
+        call_command("rollupanalytics", stdout=StringIO())
+
+        # visits since the rollup
+        for _ in range(3):
+            models.AnalyticPost.objects.create(post=self.post)
+
+    def test_day_counts(self):
+        today = timezone.now().date()
+        day_counts = rollups.get_day_counts(
+            "post", today - timedelta(days=24), post_id=self.post.id
+        )
+        self.assertEqual(day_counts, {today: 4})
+
+    def test_top_posts(self):
+        self.assertEqual(
+            rollups.get_top_counts("post", ["post_id"], 1),
+            [((self.post.id,), 4)],
+        )
+        self.assertEqual(rollups.get_total("post"), 7)
+
+    def test_analytic_detail(self):
+        self.client.force_login(self.user)
+        response = self.client.get(
+            reverse("analytic_post_detail", args=(self.post.slug,))
+        )
+        self.assertContains(response, "4 hits")
+
+    def test_moderation_top(self):
+        self.user.is_superuser = True
+        self.user.save()
+        self.client.force_login(self.user)
+        models.AnalyticPage.objects.create(user=self.user, path="rss")
+
+        response = self.client.get(reverse("moderation_top_posts"))
+        self.assertEqual(
+            [(post, post.visit_count) for post in response.context["post_list"]],
+            [(self.post, 4), (self.other_post, 3)],
+        )
+        response = self.client.get(reverse("moderation_top_blogs"))
+        self.assertEqual(response.context["user_list"][0].visit_count, 7)
+        response = self.client.get(reverse("moderation_top_pages"))
+        self.assertEqual(response.context["page_list"][0]["visit_count"], 1)
+        date_str = timezone.now().date().isoformat()
+        response = self.client.get(reverse("moderation_summary", args=(date_str,)))
+        self.assertEqual(response.context["counts"]["post_visits"], 7)
+
+
+class AnalyticExportTestCase(TestCase):
+    """Test analytics export streams daily visits of posts and pages."""
+
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice")
+        self.post = models.Post.objects.create(
+            owner=self.user, title="Welcome post", slug="welcome-post", body="Hi."
+        )
+        self.today = timezone.now().date()
+        self.old_date = self.today - timedelta(days=400)
+        models.AnalyticPostDay.objects.create(
+            post=self.post, date=self.old_date, count=5
+        )
+        models.AnalyticPageDay.objects.create(
+            user=self.user, path="index", date=self.old_date, count=2
+        )
+        # visits not rolled up yet
+        models.AnalyticPost.objects.create(post=self.post)
+        models.AnalyticPage.objects.create(user=self.user, path="rss")
+
+        # other blogs are not exported
+        other_user = models.User.objects.create(username="bob")
+        other_post = models.Post.objects.create(
+            owner=other_user, title="Other post", slug="other-post", body="Hi."
+        )
+        models.AnalyticPostDay.objects.create(
+            post=other_post, date=self.old_date, count=7
+        )
+        self.client.force_login(self.user)
+
+    def test_csv(self):
+        response = self.client.get(reverse("export_analytics"))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response["Content-Type"], "text/csv")
+        self.assertEqual(
+            b"".join(response.streaming_content).decode().splitlines(),
+            [
+                "date,type,name,visits",
+                f"{self.old_date},post,welcome-post,5",
+                f"{self.today},post,welcome-post,1",
+                f"{self.old_date},page,index,2",
+                f"{self.today},page,rss,1",
+            ],
+        )
+
+    def test_ndjson(self):
+        response = self.client.get(reverse("export_analytics"), {"format": "ndjson"})
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(
+            json.loads(lines[0]),
+            {
+                "date": self.old_date.isoformat(),
+                "type": "post",
+                "name": "welcome-post",
+                "visits": 5,
+            },
+        )
+        self.assertEqual(len(lines), 4)
+
+    def test_rolled_up_tail_merged(self):
+        models.AnalyticPostDay.objects.create(post=self.post, date=self.today, count=3)
+        response = self.client.get(reverse("export_analytics"))
+        content = b"".join(response.streaming_content).decode()
+        self.assertIn(f"{self.today},post,welcome-post,4", content)
+
+    def test_unknown_format(self):
+        response = self.client.get(reverse("export_analytics"), {"format": "xml"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_anon(self):
+        self.client.logout()
+        response = self.client.get(reverse("export_analytics"))
+        self.assertEqual(response.status_code, 302)
@@ -4,11 +4,16 @@ import json
 import zipfile
 
 from django.conf import settings
-from django.core import mail
-from django.test import SimpleTestCase, TestCase, override_settings
+from django.core import mail, signing
+from django.core.cache import caches
+from django.db import connection
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 
-from main import models, scheme
+from main import models, pagecache, scheme
 
 
 class IndexTestCase(TestCase):
@@ -213,6 +218,270 @@ class BlogRetiredCustomDomainRedirectTestCase(TestCase):
                 self.assertEqual(response.status_code, 400)
 
 
+class BlogHostCacheTestCase(TestCase):
+    """Test host to blog resolutions are cached and invalidated on changes."""
+
+    def setUp(self):
+        caches["hosts"].clear()
+        self.user = models.User.objects.create(
+            username="alice", custom_domain="alice.example.com"
+        )
+        self.host = self.user.username + "." + settings.CANONICAL_HOST
+
+    def test_resolution_cached(self):
+        response = self.client.get(reverse("index"), HTTP_HOST=self.host)
+        self.assertEqual(response.status_code, 302)
+
+        # redirect to custom domain needs no query once host is resolved
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse("index"), HTTP_HOST=self.host)
+        self.assertEqual(response.status_code, 302)
+
+    def test_unknown_host_cached(self):
+        host = "bob." + settings.CANONICAL_HOST
+        response = self.client.get(reverse("index"), HTTP_HOST=host)
+        self.assertEqual(response.status_code, 404)
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse("index"), HTTP_HOST=host)
+        self.assertEqual(response.status_code, 404)
+
+        # signing up invalidates the cached miss
+        models.User.objects.create(username="bob")
+        response = self.client.get(reverse("index"), HTTP_HOST=host)
+        self.assertEqual(response.status_code, 200)
+
+    def test_previous_domain_invalidated_on_update(self):
+        response = self.client.get(reverse("index"), HTTP_HOST="alice.example.com")
+        self.assertEqual(response.status_code, 200)
+
+        self.client.force_login(self.user)
+        data = {"username": "alice2", "custom_domain": "new.example.com"}
+        response = self.client.post(reverse("user_update"), data)
+        self.assertEqual(response.status_code, 302)
+
+        response = self.client.get(reverse("index"), HTTP_HOST="alice.example.com")
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(reverse("index"), HTTP_HOST=self.host)
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get(reverse("index"), HTTP_HOST="new.example.com")
+        self.assertEqual(response.status_code, 200)
+
+    def test_deleted_blog_invalidated(self):
+        response = self.client.get(reverse("index"), HTTP_HOST="alice.example.com")
+        self.assertEqual(response.status_code, 200)
+
+        self.user.delete()
+        response = self.client.get(reverse("index"), HTTP_HOST="alice.example.com")
+        self.assertEqual(response.status_code, 400)
+
+
+class BlogPageCacheTestCase(TestCase):
+    """Test anonymous blog pages are cached until the blog changes."""
+
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice", comments_on=True)
+        self.post = models.Post.objects.create(
+            owner=self.user, title="Welcome post", slug="welcome-post", body="Hello."
+        )
+        self.host = self.user.username + "." + settings.CANONICAL_HOST
+
+    def get_post(self):
+        return self.client.get(
+            reverse("post_detail", args=(self.post.slug,)),
+            HTTP_HOST=self.host,
+            HTTP_USER_AGENT="Firefox/128.0",
+        )
+
+    def test_post_cached(self):
+        response = self.get_post()
+        self.assertEqual(response["X-Page-Cache"], "miss")
+
+        # blog validators, the analytic hit and its visitor sketch in a savepoint
+        with self.assertNumQueries(5):
+            response = self.get_post()
+        self.assertEqual(response["X-Page-Cache"], "hit")
+        self.assertContains(response, "Hello.")
+        self.assertEqual(models.AnalyticPost.objects.filter(post=self.post).count(), 2)
+
+    def test_index_cached(self):
+        headers = {"HTTP_HOST": self.host, "HTTP_USER_AGENT": "Firefox/128.0"}
+        response = self.client.get(reverse("index"), **headers)
+        self.assertEqual(response["X-Page-Cache"], "miss")
+        response = self.client.get(reverse("index"), **headers)
+        self.assertEqual(response["X-Page-Cache"], "hit")
+        self.assertContains(response, "Welcome post")
+        self.assertEqual(
+            models.AnalyticPage.objects.filter(user=self.user, path="index").count(),
+            2,
+        )
+
+    def test_blog_change_invalidates(self):
+        self.get_post()
+        self.post.body = "Updated."
+        self.post.save()
+
+        response = self.get_post()
+        self.assertEqual(response["X-Page-Cache"], "miss")
+        self.assertContains(response, "Updated.")
+
+        models.Comment.objects.create(post=self.post, body="Nice", is_approved=True)
+        response = self.get_post()
+        self.assertEqual(response["X-Page-Cache"], "miss")
+        self.assertContains(response, "Nice")
+
+    def test_change_without_signals_invalidates(self):
+        # as saved by another worker, which this one has no notice of
+        self.get_post()
+        models.Post.objects.filter(id=self.post.id).update(
+            body="Updated.", updated_at=timezone.now()
+        )
+
+        response = self.get_post()
+        self.assertEqual(response["X-Page-Cache"], "miss")
+        self.assertContains(response, "Updated.")
+
+    def test_theme_change_rendered(self):
+        self.get_post()
+        # saved by another worker, whose hosts cache entry this one lacks
+        models.User.objects.filter(id=self.user.id).update(
+            theme_sansserif=True, updated_at=timezone.now()
+        )
+
+        response = self.get_post()
+        self.assertEqual(response["X-Page-Cache"], "miss")
+        self.assertNotContains(response, "font-family: serif;")
+        response = self.get_post()
+        self.assertEqual(response["X-Page-Cache"], "hit")
+        self.assertNotContains(response, "font-family: serif;")
+
+    def test_partial_user_save_invalidates(self):
+        self.get_post()
+        self.user.is_premium = True
+        self.user.save(update_fields=["is_premium"])
+
+        response = self.get_post()
+        self.assertEqual(response["X-Page-Cache"], "miss")
+
+    def test_headers_replayed(self):
+        @pagecache.cache_page
+        def view(request):
+            response = HttpResponse("Hello.", content_type="text/plain")
+            response["Content-Language"] = "en"
+            return response
+
+        request = RequestFactory().get("/", HTTP_HOST=self.host)
+        request.blog_user_id = self.user.id
+        request.blog_last_modified = timezone.now()
+        self.assertEqual(view(request)["X-Page-Cache"], "miss")
+
+        response = view(request)
+        self.assertEqual(response["X-Page-Cache"], "hit")
+        self.assertEqual(response["Content-Type"], "text/plain")
+        self.assertEqual(response["Content-Language"], "en")
+        self.assertEqual(response.content, b"Hello.")
+
+    def test_per_visitor_values_filled(self):
+        self.get_post()
+        response = self.get_post()
+        self.assertEqual(response["X-Page-Cache"], "hit")
+        self.assertIn(settings.CSRF_COOKIE_NAME, response.cookies)
+
+        content = response.content.decode()
+        self.assertNotIn(pagecache.CSRF_TOKEN_PLACEHOLDER, content)
+        self.assertNotIn(pagecache.TIMESTAMP_PLACEHOLDER, content)
+        self.assertIn('name="csrfmiddlewaretoken"', content)
+        comment_ts = content.split('name="ts" value="')[1].split('"')[0]
+        self.assertIsInstance(signing.loads(comment_ts), int)
+
+    def test_logged_in_not_cached(self):
+        self.client.force_login(self.user)
+        self.get_post()
+        response = self.get_post()
+        self.assertNotIn("X-Page-Cache", response)
+
+
+class BlogConditionalGetTestCase(TestCase):
+    """Test blog views answer revalidations with 304 until the blog changes."""
+
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice")
+        self.post = models.Post.objects.create(
+            owner=self.user, title="Welcome post", slug="welcome-post", body="Hello."
+        )
+        self.host = self.user.username + "." + settings.CANONICAL_HOST
+
+    def get(self, url, **headers):
+        return self.client.get(
+            url, HTTP_HOST=self.host, HTTP_USER_AGENT="Firefox/128.0", **headers
+        )
+
+    def test_post_not_modified(self):
+        url = reverse("post_detail", args=(self.post.slug,))
+        response = self.get(url)
+        self.assertEqual(response.status_code, 200)
+
+        response = self.get(url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(models.AnalyticPost.objects.filter(post=self.post).count(), 2)
+
+    def test_if_modified_since(self):
+        response = self.get(reverse("sitemap"))
+        self.assertEqual(response.status_code, 200)
+        response = self.get(
+            reverse("sitemap"), HTTP_IF_MODIFIED_SINCE=response["Last-Modified"]
+        )
+        self.assertEqual(response.status_code, 304)
+
+    def test_rss_not_modified_recorded(self):
+        response = self.get(reverse("rss_feed"))
+        response = self.get(reverse("rss_feed"), HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(
+            models.AnalyticPage.objects.filter(user=self.user, path="rss").count(), 2
+        )
+
+    def test_changes_modify(self):
+        etag = self.get(reverse("index"))["ETag"]
+
+        comment = models.Comment.objects.create(
+            post=self.post, body="Nice", is_approved=True
+        )
+        response = self.get(reverse("index"), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        etag = response["ETag"]
+
+        comment.delete()
+        response = self.get(reverse("index"), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        etag = response["ETag"]
+
+        self.post.delete()
+        response = self.get(reverse("index"), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotContains(response, "Welcome post")
+
+    def test_post_comments_deleted_in_bulk(self):
+        for i in range(3):
+            models.Comment.objects.create(post=self.post, body=f"Comment {i}")
+
+        with CaptureQueriesContext(connection) as context:
+            self.post.delete()
+        comment_selects = [
+            query
+            for query in context.captured_queries
+            if query["sql"].startswith("SELECT") and "main_comment" in query["sql"]
+        ]
+        self.assertEqual(comment_selects, [])
+        self.assertFalse(models.Comment.objects.exists())
+
+    def test_logged_in_no_validators(self):
+        self.client.force_login(self.user)
+        response = self.get(reverse("index"))
+        self.assertNotIn("ETag", response)
+
+
 class BlogImportTestCase(TestCase):
     def setUp(self):
         self.user = models.User.objects.create(username="alice")
@@ -258,11 +527,14 @@ class BlogExportMarkdownTestCase(TestCase):
     def test_blog_export(self):
         response = self.client.post(reverse("export_markdown"))
         self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
         self.assertEqual(response["Content-Type"], "application/zip")
-        self.assertContains(response, b"export-markdown")
-        self.assertContains(response, self.data["slug"].encode("utf-8"))
+        content = b"".join(response.streaming_content)
+        self.assertIn(b"export-markdown", content)
+        self.assertIn(self.data["slug"].encode("utf-8"), content)
 
-        with zipfile.ZipFile(io.BytesIO(response.content)) as export_archive:
+        with zipfile.ZipFile(io.BytesIO(content)) as export_archive:
+            self.assertIsNone(export_archive.testzip())
             exported_files = export_archive.namelist()
 
         self.assertTrue(
@@ -314,8 +586,9 @@ class BlogExportZolaTestCase(TestCase):
         response = self.client.post(reverse("export_zola"))
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response["Content-Type"], "application/zip")
-        self.assertContains(response, b"export-zola")
-        self.assertContains(response, self.data["slug"].encode("utf-8"))
+        content = b"".join(response.streaming_content)
+        self.assertIn(b"export-zola", content)
+        self.assertIn(self.data["slug"].encode("utf-8"), content)
 
 
 class BlogExportHugoTestCase(TestCase):
@@ -333,8 +606,9 @@ class BlogExportHugoTestCase(TestCase):
         response = self.client.post(reverse("export_hugo"))
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response["Content-Type"], "application/zip")
-        self.assertContains(response, b"export-hugo")
-        self.assertContains(response, self.data["slug"].encode("utf-8"))
+        content = b"".join(response.streaming_content)
+        self.assertIn(b"export-hugo", content)
+        self.assertIn(self.data["slug"].encode("utf-8"), content)
 
 
 class BlogExportEpubTestCase(TestCase):
@@ -352,8 +626,28 @@ class BlogExportEpubTestCase(TestCase):
         response = self.client.post(reverse("export_epub"))
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response["Content-Type"], "application/epub")
-        self.assertContains(response, b"OEBPS/titlepage.xhtml")
-        self.assertContains(response, b"OEBPS/toc.xhtml")
+        content = b"".join(response.streaming_content)
+        self.assertIn(b"OEBPS/titlepage.xhtml", content)
+        self.assertIn(b"OEBPS/toc.xhtml", content)
+
+    def test_blog_export_images(self):
+        image = models.Image.objects.create(
+            owner=self.user,
+            name="vulf",
+            slug="vulf1234",
+            extension="png",
+            data=b"image data",
+            size=10,
+        )
+        response = self.client.post(reverse("export_epub"))
+        content = b"".join(response.streaming_content)
+        with zipfile.ZipFile(io.BytesIO(content)) as export_archive:
+            self.assertEqual(
+                export_archive.read(f"OEBPS/images/{image.filename}"), b"image data"
+            )
+            self.assertIn("OEBPS/1.xhtml", export_archive.namelist())
+            opf = export_archive.read("OEBPS/content.opf").decode()
+        self.assertIn(f'href="images/{image.filename}"', opf)
 
 
 class BlogNotificationListTestCase(TestCase):
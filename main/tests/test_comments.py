@@ -1,11 +1,14 @@
 import time
+from datetime import timedelta
 
 from django.conf import settings
+from django.contrib.admin import site
 from django.core import signing
 from django.test import TestCase
 from django.urls import reverse
+from django.utils import timezone
 
-from main import models
+from main import admin, models
 
 
 def _signed_ts(seconds_ago=10):
@@ -633,3 +636,28 @@ class CommentsDeleteNonOwnerTestCase(TestCase):
         )
         self.assertEqual(response.status_code, 403)
         self.assertEqual(models.Comment.objects.all().count(), 1)
+
+
+class CommentAdminDeleteTestCase(TestCase):
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice", comments_on=True)
+        self.post = models.Post.objects.create(
+            title="Hello world",
+            slug="hello-world",
+            owner=self.user,
+        )
+        models.Comment.objects.create(
+            name="Jon",
+            email="jon@wick.com",
+            body="Content sentence.",
+            post=self.post,
+        )
+        models.User.objects.update(updated_at=timezone.now() - timedelta(days=1))
+
+    def test_bulk_delete_touches_blog(self):
+        before = models.User.objects.get(id=self.user.id).updated_at
+        comment_admin = admin.CommentAdmin(models.Comment, site)
+        comment_admin.delete_queryset(None, models.Comment.objects.all())
+        self.assertEqual(models.Comment.objects.count(), 0)
+        user = models.User.objects.get(id=self.user.id)
+        self.assertGreater(user.updated_at, before)
@@ -127,3 +127,70 @@ class RSSFeedFormatTestCase(TestCase):
         self.assertContains(
             response, f"<description>{self.user.blog_byline}</description>"
         )
+
+
+class RSSFeedStoredTestCase(TestCase):
+    """Tests the feed document is stored and dropped when posts change."""
+
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice")
+        self.post = models.Post.objects.create(
+            owner=self.user,
+            title="Welcome post",
+            slug="welcome-post",
+            body="Content sentence.",
+            published_at=timezone.now().date(),
+        )
+
+    def get_feed(self):
+        return self.client.get(
+            reverse("rss_feed"),
+            HTTP_HOST=self.user.username + "." + settings.CANONICAL_HOST,
+            HTTP_USER_AGENT="Firefox/128.0",
+        )
+
+    def test_poll_reads_stored_document(self):
+        self.get_feed()
+        # validators, stored document and the analytic hit
+        with self.assertNumQueries(3):
+            response = self.get_feed()
+        self.assertContains(response, "Welcome post")
+
+    def test_post_edit_regenerates(self):
+        self.get_feed()
+        self.post.title = "Edited post"
+        self.post.save()
+        self.assertFalse(models.Feed.objects.filter(owner=self.user).exists())
+
+        response = self.get_feed()
+        self.assertContains(response, "Edited post")
+        self.assertNotContains(response, "Welcome post")
+        document = models.Feed.objects.get(owner=self.user).document
+        self.assertIn("Edited post", document)
+
+    def test_post_delete(self):
+        self.get_feed()
+        self.post.delete()
+        self.assertFalse(models.Feed.objects.filter(owner=self.user).exists())
+        response = self.get_feed()
+        self.assertNotContains(response, "Welcome post")
+
+    def test_scheduled_post_published(self):
+        tomorrow = timezone.now().date() + timedelta(days=1)
+        models.Post.objects.create(
+            owner=self.user,
+            title="Scheduled post",
+            slug="scheduled-post",
+            body="Later.",
+            published_at=tomorrow,
+        )
+        self.assertNotContains(self.get_feed(), "Scheduled post")
+        self.assertEqual(models.Feed.objects.get(owner=self.user).stale_on, tomorrow)
+
+        # a day later, without any write to the blog
+        models.Post.objects.filter(slug="scheduled-post").update(
+            published_at=timezone.now().date()
+        )
+        models.Feed.objects.update(stale_on=timezone.now().date())
+        self.assertContains(self.get_feed(), "Scheduled post")
+        self.assertIsNone(models.Feed.objects.get(owner=self.user).stale_on)
@@ -1,7 +1,39 @@
-from django.test import TestCase
+import io
+import tempfile
+import threading
+from unittest import skipUnless
+from unittest.mock import patch
+
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import DatabaseError, connection
+from django.test import TestCase, override_settings
 from django.urls import reverse
 
-from main import models
+from main import imagequota, imagestore, imagevariants, models
+from main.imagevariants import PILImage
+from main.views import general
+
+
+def setUpModule():
+    # store image files of the tests in a directory of their own
+    global images_dir, storage_settings
+    images_dir = tempfile.TemporaryDirectory()
+    storage_settings = override_settings(
+        STORAGES={
+            **settings.STORAGES,
+            "images": {
+                "BACKEND": "django.core.files.storage.FileSystemStorage",
+                "OPTIONS": {"location": images_dir.name},
+            },
+        }
+    )
+    storage_settings.enable()
+
+
+def tearDownModule():
+    storage_settings.disable()
+    images_dir.cleanup()
 
 
 class ImageCreateTestCase(TestCase):
@@ -17,6 +49,181 @@ class ImageCreateTestCase(TestCase):
             self.assertIsNotNone(models.Image.objects.get(name="vulf").slug)
 
 
+class ImageStorageTestCase(TestCase):
+    """Test image files are kept in the image storage, named by their hash."""
+
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice")
+        self.client.force_login(self.user)
+        with open("main/tests/testdata/vulf.jpeg", "rb") as fp:
+            self.data = fp.read()
+            fp.seek(0)
+            self.client.post(reverse("image_list"), {"file": fp})
+        self.image = models.Image.objects.get(name="vulf")
+
+    def test_stored(self):
+        self.assertIsNone(self.image.data)
+        self.assertEqual(self.image.size, len(self.data))
+        self.assertEqual(len(self.image.sha256), 64)
+        storage = imagestore.get_storage()
+        self.assertTrue(storage.exists(imagestore.get_name(self.image.sha256)))
+        self.assertEqual(self.image.read(), self.data)
+
+    def test_quota(self):
+        response = self.client.get(reverse("image_list"))
+        self.assertEqual(response.context["total_quota"], 0.04)
+
+    def test_deleted(self):
+        name = imagestore.get_name(self.image.sha256)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse("image_delete", args=(self.image.slug,)))
+        self.assertFalse(imagestore.get_storage().exists(name))
+
+    def test_same_file_kept(self):
+        with open("main/tests/testdata/vulf.jpeg", "rb") as fp:
+            self.client.post(reverse("image_list"), {"file": fp})
+        self.assertEqual(
+            models.Image.objects.filter(sha256=self.image.sha256).count(), 2
+        )
+
+        name = imagestore.get_name(self.image.sha256)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse("image_delete", args=(self.image.slug,)))
+        self.assertTrue(imagestore.get_storage().exists(name))
+
+    def is_content_locked(self):
+        """Return whether another connection has to wait for the content lock."""
+        results = []
+
+        def try_lock():
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        "SELECT pg_try_advisory_xact_lock(%s)",
+                        [imagestore.get_lock_key(self.image.sha256)],
+                    )
+                    results.append(cursor.fetchone()[0])
+            finally:
+                connection.close()
+
+        thread = threading.Thread(target=try_lock)
+        thread.start()
+        thread.join()
+        return not results[0]
+
+    def test_upload_locks_content(self):
+        # deleting the file waits for the upload, still in this transaction
+        self.assertTrue(self.is_content_locked())
+
+    def test_delete_locks_content(self):
+        # the upload in setUp holds the lock already, so only check it is taken
+        with (
+            patch.object(imagestore, "lock", wraps=imagestore.lock) as lock,
+            self.captureOnCommitCallbacks(execute=True),
+        ):
+            self.client.post(reverse("image_delete", args=(self.image.slug,)))
+        lock.assert_called_once_with(self.image.sha256)
+
+    def test_failed_upload_file_deleted(self):
+        data = b"new content"
+        name = imagestore.get_name(imagestore.get_sha256(data))
+        with (
+            patch.object(models.Image.objects, "create", side_effect=DatabaseError),
+            self.assertRaises(DatabaseError),
+        ):
+            self.client.post(
+                reverse("image_list"), {"file": SimpleUploadedFile("new.png", data)}
+            )
+        self.assertFalse(imagestore.get_storage().exists(name))
+        # stored before by another image, so kept
+        self.assertTrue(
+            imagestore.get_storage().exists(imagestore.get_name(self.image.sha256))
+        )
+
+    def test_contents_locked_up_front(self):
+        files = [
+            SimpleUploadedFile("b.png", b"second"),
+            SimpleUploadedFile("a.png", b"first"),
+        ]
+        with patch.object(imagestore, "lock", wraps=imagestore.lock) as lock:
+            self.client.post(reverse("image_list"), {"file": files})
+        self.assertEqual(
+            set(lock.call_args_list[0].args),
+            {imagestore.get_sha256(b"first"), imagestore.get_sha256(b"second")},
+        )
+
+    def test_same_file_stored_once(self):
+        with open("main/tests/testdata/vulf.jpeg", "rb") as fp:
+            self.client.post(reverse("image_list"), {"file": fp})
+        other = models.Image.objects.exclude(id=self.image.id).get()
+        # a reference of its own, to the same file
+        self.assertNotEqual(other.slug, self.image.slug)
+        self.assertEqual(other.sha256, self.image.sha256)
+        directory = imagestore.get_name(self.image.sha256).rsplit("/", 1)[0]
+        _, filenames = imagestore.get_storage().listdir(directory)
+        variant_prefix = f"{self.image.sha256}."
+        self.assertEqual(
+            [name for name in filenames if not name.startswith(variant_prefix)],
+            [self.image.sha256],
+        )
+        # counted towards the quota once per upload
+        usage = models.ImageUsage.objects.get(owner=self.user)
+        self.assertEqual(usage.total_bytes, 2 * len(self.data))
+
+    def test_database_image(self):
+        # images not moved to the storage yet are read from the database
+        image = models.Image.objects.create(
+            owner=self.user,
+            name="old",
+            slug="old",
+            extension="jpeg",
+            data=self.data,
+            size=len(self.data),
+        )
+        self.assertEqual(image.read(), self.data)
+        response = self.client.get(reverse("image_raw", args=("old", "jpeg")))
+        self.assertEqual(b"".join(response.streaming_content), self.data)
+        self.assertEqual(response["ETag"], f'"{self.image.sha256}"')
+
+
+class ImageUsageTestCase(TestCase):
+    """Test the image storage totals of users follow their images."""
+
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice")
+        self.client.force_login(self.user)
+        with open("main/tests/testdata/vulf.jpeg", "rb") as fp:
+            self.data = fp.read()
+            fp.seek(0)
+            self.client.post(reverse("image_list"), {"file": fp})
+        self.image = models.Image.objects.get(name="vulf")
+
+    def test_upload(self):
+        usage = models.ImageUsage.objects.get(owner=self.user)
+        self.assertEqual(usage.total_bytes, len(self.data))
+        self.assertEqual(usage.image_count, 1)
+
+    def test_delete(self):
+        self.client.post(reverse("image_delete", args=(self.image.slug,)))
+        usage = models.ImageUsage.objects.get(owner=self.user)
+        self.assertEqual(usage.total_bytes, 0)
+        self.assertEqual(usage.image_count, 0)
+
+    def test_quota_exceeded(self):
+        # the quota is checked against the kept totals
+        models.ImageUsage.objects.filter(owner=self.user).update(
+            total_bytes=imagequota.QUOTA_BYTES - 1000
+        )
+        with open("main/tests/testdata/vulf.jpeg", "rb") as fp:
+            response = self.client.post(reverse("image_list"), {"file": fp})
+        self.assertContains(response, "Storage limit exceeded")
+        self.assertEqual(models.Image.objects.filter(owner=self.user).count(), 1)
+
+    def test_user_delete(self):
+        self.user.delete()
+        self.assertFalse(models.ImageUsage.objects.exists())
+
+
 class ImageCreateAnonTestCase(TestCase):
     def test_image_upload_anon(self):
         with open("main/tests/testdata/vulf.jpeg", "rb") as fp:
@@ -86,6 +293,33 @@ class ImageDetailUsedByTestCase(TestCase):
         self.assertContains(response, "Used by posts:")
         self.assertContains(response, "New post")
 
+    def test_body_edited(self):
+        self.post.body = "No more Vulfpeck"
+        self.post.save()
+        self.assertFalse(models.PostImage.objects.exists())
+        response = self.client.get(reverse("image_detail", args=(self.image.slug,)))
+        self.assertNotContains(response, "Used by posts:")
+
+    def test_variant(self):
+        models.Post.objects.create(
+            owner=self.user,
+            title="Smaller",
+            slug="smaller",
+            body=f"![vulf](https://mataroa.blog/images/{self.image.slug}.w640.jpeg)",
+        )
+        response = self.client.get(reverse("image_detail", args=(self.image.slug,)))
+        self.assertContains(response, "Smaller")
+
+    def test_other_user_post(self):
+        # used, but not listed to the owner of the image
+        other = models.User.objects.create(username="bob")
+        post = models.Post.objects.create(
+            owner=other, title="Borrowed", slug="borrowed", body=self.data["body"]
+        )
+        self.assertTrue(post.image_references.filter(image=self.image).exists())
+        response = self.client.get(reverse("image_detail", args=(self.image.slug,)))
+        self.assertNotContains(response, "Borrowed")
+
 
 class ImageRawTestCase(TestCase):
     def setUp(self):
@@ -100,7 +334,171 @@ class ImageRawTestCase(TestCase):
             reverse("image_raw", args=(self.image.slug, self.image.extension)),
         )
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(self.image.data, response.content)
+        self.assertEqual(self.image.read(), b"".join(response.streaming_content))
+
+
+class ImageRawCacheTestCase(TestCase):
+    """Test images are served as immutable files, whole or in ranges."""
+
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice")
+        self.client.force_login(self.user)
+        with open("main/tests/testdata/vulf.jpeg", "rb") as fp:
+            self.data = fp.read()
+            fp.seek(0)
+            self.client.post(reverse("image_list"), {"file": fp})
+        self.image = models.Image.objects.get(name="vulf")
+        self.url = reverse("image_raw", args=(self.image.slug, self.image.extension))
+        self.etag = f'"{self.image.sha256}"'
+
+    def test_headers(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(b"".join(response.streaming_content), self.data)
+        self.assertEqual(response["ETag"], self.etag)
+        self.assertEqual(
+            response["Cache-Control"], "public, max-age=31536000, immutable"
+        )
+        self.assertEqual(response["Content-Type"], "image/jpeg")
+        self.assertEqual(response["Content-Length"], str(len(self.data)))
+        self.assertEqual(response["Accept-Ranges"], "bytes")
+
+    def test_not_modified(self):
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=self.etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], self.etag)
+
+    def test_range(self):
+        response = self.client.get(self.url, HTTP_RANGE="bytes=10-19")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.content, self.data[10:20])
+        self.assertEqual(response["Content-Range"], f"bytes 10-19/{len(self.data)}")
+
+        response = self.client.get(self.url, HTTP_RANGE="bytes=-5")
+        self.assertEqual(response.content, self.data[-5:])
+
+        response = self.client.get(self.url, HTTP_RANGE="bytes=43840-")
+        self.assertEqual(response.content, self.data[43840:])
+
+    def test_range_unsatisfiable(self):
+        response = self.client.get(self.url, HTTP_RANGE=f"bytes={len(self.data)}-")
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response["Content-Range"], f"bytes */{len(self.data)}")
+
+    def test_range_of_empty_file(self):
+        for range_header in ["bytes=-5", "bytes=0-", "bytes=0-9"]:
+            with self.assertRaises(ValueError, msg=range_header):
+                general.get_byte_range(range_header, 0)
+
+    def test_if_range(self):
+        response = self.client.get(
+            self.url, HTTP_RANGE="bytes=0-9", HTTP_IF_RANGE=self.etag
+        )
+        self.assertEqual(response.status_code, 206)
+
+        # the client has another version, so gets the whole file
+        response = self.client.get(
+            self.url, HTTP_RANGE="bytes=0-9", HTTP_IF_RANGE='"other"'
+        )
+        self.assertEqual(response.status_code, 200)
+
+    def test_multiple_ranges_whole(self):
+        response = self.client.get(self.url, HTTP_RANGE="bytes=0-9,20-29")
+        self.assertEqual(response.status_code, 200)
+
+
+@skipUnless(imagevariants.PILImage, "Pillow is not installed")
+class ImageVariantTestCase(TestCase):
+    """Test smaller variants of images are made on first request and kept."""
+
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice")
+        self.client.force_login(self.user)
+        with open("main/tests/testdata/vulf.jpeg", "rb") as fp:
+            self.data = fp.read()
+            fp.seek(0)
+            self.client.post(reverse("image_list"), {"file": fp})
+        self.image = models.Image.objects.get(name="vulf")
+
+    def get_variant(self, width, extension, **headers):
+        return self.client.get(
+            reverse("image_variant", args=(self.image.slug, width, extension)),
+            **headers,
+        )
+
+    def read_picture(self, response):
+        data = b"".join(response.streaming_content)
+        return PILImage.open(io.BytesIO(data))
+
+    def test_resized(self):
+        response = self.get_variant(320, "jpeg")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "image/jpeg")
+        self.assertEqual(response["Vary"], "Accept")
+        self.assertEqual(response["ETag"], f'"{self.image.sha256}.w320.jpeg"')
+        picture = self.read_picture(response)
+        self.assertEqual((picture.format, picture.size), ("JPEG", (320, 320)))
+        self.assertLess(int(response["Content-Length"]), len(self.data))
+
+        # kept in the storage for the next requests
+        name = imagestore.get_variant_name(self.image.sha256, "w320.jpeg")
+        self.assertTrue(imagestore.get_storage().exists(name))
+
+    def test_negotiated(self):
+        response = self.get_variant(640, "jpeg", HTTP_ACCEPT="image/webp,*/*")
+        self.assertEqual(response["Content-Type"], "image/webp")
+        self.assertEqual(response["Vary"], "Accept")
+        self.assertEqual(self.read_picture(response).size, (640, 640))
+
+    def test_format(self):
+        response = self.get_variant(640, "webp")
+        self.assertEqual(response["Content-Type"], "image/webp")
+        self.assertFalse(response.has_header("Vary"))
+
+    def test_not_enlarged(self):
+        response = self.get_variant(1280, "webp")
+        self.assertEqual(self.read_picture(response).size, (864, 864))
+
+    def test_not_modified(self):
+        response = self.get_variant(320, "jpeg")
+        response = self.get_variant(320, "jpeg", HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+
+    def test_unknown_width(self):
+        self.assertEqual(self.get_variant(500, "jpeg").status_code, 404)
+        self.assertEqual(self.get_variant(320, "png").status_code, 404)
+
+    def test_without_pillow(self):
+        # the original is served instead
+        with patch.object(imagevariants, "PILImage", None):
+            response = self.get_variant(320, "webp")
+        self.assertEqual(response["Content-Type"], "image/jpeg")
+        self.assertEqual(b"".join(response.streaming_content), self.data)
+
+    def test_failure_remembered(self):
+        # not an image Pillow can read, whatever its extension says
+        data = b"not a jpeg"
+        self.image = models.Image.objects.create(
+            owner=self.user,
+            name="broken",
+            slug="broken",
+            extension="jpeg",
+            size=len(data),
+            sha256=imagestore.save(data),
+        )
+        with patch.object(imagevariants, "make", wraps=imagevariants.make) as make:
+            for _ in range(2):
+                response = self.get_variant(320, "webp")
+                self.assertEqual(b"".join(response.streaming_content), data)
+        make.assert_called_once()
+
+    def test_deleted(self):
+        self.get_variant(320, "jpeg")
+        name = imagestore.get_variant_name(self.image.sha256, "w320.jpeg")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse("image_delete", args=(self.image.slug,)))
+        self.assertFalse(imagestore.get_storage().exists(name))
 
 
 class ImageRawWrongExtTestCase(TestCase):
@@ -1,17 +1,21 @@
+import hashlib
 import io
+import json
+import tempfile
 import zipfile
-from datetime import datetime
+from datetime import datetime, timedelta
 from io import StringIO
-from unittest.mock import patch
+from unittest.mock import Mock, patch
 
 from django.conf import settings
 from django.core import mail
 from django.core.management import CommandError, call_command
+from django.db import connection
 from django.test import TestCase
 from django.test.utils import override_settings
 from django.utils import timezone
 
-from main import models
+from main import feeds, imagestore, models, partitions, rollups
 from main.management.commands import mailexports, processnotifications
 
 
@@ -257,3 +261,600 @@ class MailExportsTest(TestCase):
     def tearDown(self):
         models.User.objects.all().delete()
         models.Post.objects.all().delete()
+
+
+class RerenderTest(TestCase):
+    """
+    Test rerender regenerates stored renders that are stale.
+    """
+
+    def setUp(self):
+        self.user = models.User.objects.create(
+            username="alice", blog_byline="A **byline**", footer_note="A note"
+        )
+        self.post = models.Post.objects.create(
+            title="Post", slug="post", body="Post **body**", owner=self.user
+        )
+        self.page = models.Page.objects.create(
+            title="Page", slug="page", body="Page **body**", owner=self.user
+        )
+        self.comment = models.Comment.objects.create(
+            post=self.post, body="Comment **body**"
+        )
+        feeds.update_feed(self.user)
+
+    def test_stale_renders_regenerated(self):
+        # simulate renders stored by an older renderer version
+        models.Post.objects.update(body_html="old", body_text="old", body_hash="old")
+        models.Page.objects.update(body_html="old", body_hash="old")
+        models.Comment.objects.update(body_html="old", body_hash="old")
+        models.User.objects.update(footer_note_html="old", footer_note_hash="old")
+
+        output = StringIO()
+        call_command("rerender", "--workers=1", stdout=output)
+
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.body_html, "<p>Post <strong>body</strong></p>")
+        self.assertEqual(self.post.body_text, "Post body")
+        self.page.refresh_from_db()
+        self.assertEqual(self.page.body_html, "<p>Page <strong>body</strong></p>")
+        self.comment.refresh_from_db()
+        self.assertEqual(self.comment.body_html, "<p>Comment <strong>body</strong></p>")
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.footer_note_html, "<p>A note</p>")
+        self.assertEqual(self.user.blog_byline_html, "<p>A <strong>byline</strong></p>")
+        self.assertIn("Re-rendered 1 of 1 post rows", output.getvalue())
+        self.assertIn("Re-rendered 1 of 1 user rows", output.getvalue())
+        # feeds embedding the old renders are dropped
+        self.assertFalse(models.Feed.objects.exists())
+
+    def test_fresh_renders_skipped(self):
+        output = StringIO()
+        call_command("rerender", "--workers=1", stdout=output)
+        self.assertIn("Re-rendered 0 of 1 post rows", output.getvalue())
+        self.assertIn("Re-rendered 0 of 1 comment rows", output.getvalue())
+
+    def test_after_id(self):
+        models.Post.objects.update(body_hash="old")
+        output = StringIO()
+        call_command(
+            "rerender",
+            "--workers=1",
+            "--model=post",
+            f"--after-id={self.post.id}",
+            stdout=output,
+        )
+        self.assertIn("Re-rendered 0 of 0 post rows", output.getvalue())
+        self.assertNotIn("comment", output.getvalue())
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.body_hash, "old")
+
+    def test_owners_touched(self):
+        models.User.objects.update(updated_at=datetime(2020, 1, 1))
+        models.Comment.objects.update(body_hash="old")
+        call_command("rerender", "--workers=1", "--model=comment", stdout=StringIO())
+        self.user.refresh_from_db()
+        self.assertGreater(self.user.updated_at, datetime(2020, 1, 1))
+
+    def test_after_id_needs_single_model(self):
+        with self.assertRaisesMessage(
+            CommandError, "--after-id needs a single --model."
+        ):
+            call_command("rerender", "--workers=1", "--after-id=1", stdout=StringIO())
+
+    def test_workers_invalid(self):
+        with self.assertRaisesMessage(CommandError, "--workers must be positive."):
+            call_command("rerender", "--workers=0", stdout=StringIO())
+
+
+class RolloverFeedsTest(TestCase):
+    """
+    Test rolloverfeeds regenerates feeds with scheduled posts published today.
+    """
+
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice")
+        self.post = models.Post.objects.create(
+            title="Scheduled",
+            slug="scheduled",
+            body="Later.",
+            owner=self.user,
+            published_at=timezone.now().date() + timedelta(days=1),
+        )
+        feeds.update_feed(self.user)
+
+    def test_command(self):
+        # a day later, the post is published without a write to the blog
+        today = timezone.now().date()
+        models.Post.objects.update(published_at=today)
+        models.Feed.objects.update(stale_on=today)
+
+        output = StringIO()
+        call_command("rolloverfeeds", stdout=output)
+
+        feed = models.Feed.objects.get(owner=self.user)
+        self.assertIn("Scheduled", feed.document)
+        self.assertIsNone(feed.stale_on)
+        self.assertIn("Regenerated 1 feeds.", output.getvalue())
+
+    def test_fresh_feeds_skipped(self):
+        output = StringIO()
+        call_command("rolloverfeeds", stdout=output)
+        self.assertIn("Regenerated 0 feeds.", output.getvalue())
+
+
+class RollupAnalyticsTest(TestCase):
+    """
+    Test rollupanalytics adds analytics to daily rollups once.
+    """
+
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice")
+        self.post = models.Post.objects.create(
+            title="Post", slug="post", body="Post", owner=self.user
+        )
+        self.yesterday = timezone.now() - timedelta(days=1)
+        models.AnalyticPost.objects.create(post=self.post, created_at=self.yesterday)
+        models.AnalyticPost.objects.create(post=self.post)
+        models.AnalyticPost.objects.create(post=self.post)
+        models.AnalyticPage.objects.create(user=self.user, path="index")
+
+    def test_command(self):
+        # the first run only sees the analytics
+        output = StringIO()
+        call_command("rollupanalytics", stdout=output)
+        self.assertIn("Rolled up 0 post analytics", output.getvalue())
+        self.assertFalse(models.AnalyticPostDay.objects.exists())
+
+        output = StringIO()
+        call_command("rollupanalytics", "--batch-size=2", stdout=output)
+        self.assertIn("Rolled up 3 post analytics", output.getvalue())
+        self.assertIn("Rolled up 1 page analytics", output.getvalue())
+        self.assertEqual(
+            dict(models.AnalyticPostDay.objects.values_list("date", "count")),
+            {self.yesterday.date(): 1, timezone.now().date(): 2},
+        )
+        page_day = models.AnalyticPageDay.objects.get()
+        self.assertEqual((page_day.user, page_day.path), (self.user, "index"))
+        self.assertEqual(page_day.count, 1)
+
+    def test_counted_once(self):
+        call_command("rollupanalytics", stdout=StringIO())
+        call_command("rollupanalytics", stdout=StringIO())
+        models.AnalyticPost.objects.create(post=self.post)
+        call_command("rollupanalytics", stdout=StringIO())
+        call_command("rollupanalytics", stdout=StringIO())
+
+        day = models.AnalyticPostDay.objects.get(date=timezone.now().date())
+        self.assertEqual(day.count, 3)
+        rollup = models.AnalyticRollup.objects.get(kind="post")
+        self.assertEqual(rollup.last_id, models.AnalyticPost.objects.latest("id").id)
+
+
+class CompactAnalyticsTest(TestCase):
+    """
+    Test compactanalytics deletes old analytics of the legacy partition once
+    they are rolled up.
+    """
+
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice")
+        self.post = models.Post.objects.create(
+            title="Post", slug="post", body="Post", owner=self.user
+        )
+        self.old_date = timezone.now() - timedelta(days=100)
+        for _ in range(3):
+            models.AnalyticPost.objects.create(post=self.post, created_at=self.old_date)
+        models.AnalyticPost.objects.create(post=self.post)
+        models.AnalyticPage.objects.create(
+            user=self.user, path="index", created_at=self.old_date
+        )
+
+    def test_not_rolled_up_kept(self):
+        output = StringIO()
+        call_command("compactanalytics", stdout=output)
+        self.assertIn("Reclaimed 0 post analytics", output.getvalue())
+        self.assertIn("3 older ones not rolled up yet", output.getvalue())
+        self.assertEqual(models.AnalyticPost.objects.count(), 4)
+
+    def test_command(self):
+        call_command("rollupanalytics", stdout=StringIO())
+
+        output = StringIO()
+        call_command("compactanalytics", "--batch-size=2", "--sleep=0", stdout=output)
+        self.assertIn("Reclaimed 3 post analytics", output.getvalue())
+        self.assertIn("Reclaimed 1 page analytics", output.getvalue())
+        self.assertEqual(models.AnalyticPost.objects.count(), 1)
+        self.assertFalse(models.AnalyticPage.objects.exists())
+
+        # counts of deleted analytics are kept in the rollups
+        day = models.AnalyticPostDay.objects.get(date=self.old_date.date())
+        self.assertEqual(day.count, 3)
+        self.assertEqual(rollups.get_total("post"), 4)
+
+    def test_visitor_sketches_deleted(self):
+        models.AnalyticPostVisitors.objects.create(
+            post=self.post, date=self.old_date.date(), sketch=b""
+        )
+        models.AnalyticPostVisitors.objects.create(
+            post=self.post, date=timezone.now().date(), sketch=b""
+        )
+        output = StringIO()
+        call_command("compactanalytics", "--sleep=0", stdout=output)
+        self.assertIn("Deleted 1 visitor sketches.", output.getvalue())
+        self.assertEqual(models.AnalyticPostVisitors.objects.count(), 1)
+
+    def test_without_legacy_skipped(self):
+        with connection.cursor() as cursor:
+            # as if partitionanalytics dropped it, with the deferred foreign
+            # keys of the analytics checked first
+            cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+            partitions.drop_partition(
+                cursor, "main_analyticpost", "main_analyticpost_legacy"
+            )
+
+        output = StringIO()
+        call_command("compactanalytics", "--sleep=0", stdout=output)
+        self.assertIn(
+            "Skipping main_analyticpost, it has no legacy partition",
+            output.getvalue(),
+        )
+        self.assertIn("Reclaimed 0 page analytics", output.getvalue())
+
+
+class PartitionAnalyticsTest(TestCase):
+    """
+    Test partitionanalytics creates monthly partitions ahead and drops expired
+    ones once rolled up.
+    """
+
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice")
+        self.post = models.Post.objects.create(
+            title="Post", slug="post", body="Post", owner=self.user
+        )
+        for _ in range(3):
+            models.AnalyticPost.objects.create(post=self.post)
+        self.today = timezone.now().date()
+        # check the deferred foreign keys of the analytics now, as if they were
+        # committed, for their partition to be droppable in this transaction
+        with connection.cursor() as cursor:
+            cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+
+    def partitionanalytics(self, months_later, *args):
+        later = datetime.combine(
+            partitions.add_months(self.today, months_later), datetime.min.time()
+        )
+        output = StringIO()
+        with patch.object(timezone, "now", return_value=later):
+            call_command("partitionanalytics", *args, stdout=output)
+        return output.getvalue()
+
+    def get_partition_names(self, table):
+        with connection.cursor() as cursor:
+            return [name for name, _ in partitions.get_partitions(cursor, table)]
+
+    def test_partitions_created_ahead(self):
+        output = self.partitionanalytics(6)
+        name = partitions.get_partition_name(
+            "main_analyticpost", partitions.add_months(self.today, 9)
+        )
+        self.assertIn(f"Created partition {name}.", output)
+        self.assertIn(name, self.get_partition_names("main_analyticpost"))
+
+        # nothing to create on the next run
+        output = self.partitionanalytics(6)
+        self.assertNotIn("Created partition", output)
+
+        # analytics of future months go to their partitions
+        created_at = partitions.add_months(self.today, 7)
+        models.AnalyticPost.objects.create(post=self.post, created_at=created_at)
+        self.assertEqual(models.AnalyticPost.objects.count(), 4)
+
+    def test_naive_bounds_kept(self):
+        # bounds of timestamp columns without time zone are not shifted by the
+        # zone of the server
+        cursor = Mock()
+        cursor.fetchall.return_value = [
+            ("t_default", "DEFAULT"),
+            ("t_p2026_11", "FOR VALUES FROM ('2026-11-01') TO ('2026-12-01')"),
+        ]
+        with self.settings(TIME_ZONE="America/New_York"):
+            bounds = partitions.get_partitions(cursor, "t")
+        self.assertEqual(bounds, [("t_p2026_11", datetime(2026, 12, 1))])
+
+    def test_rows_without_partition_kept(self):
+        # visits of a month the command did not create a partition for yet
+        created_at = partitions.add_months(self.today, 6)
+        models.AnalyticPost.objects.create(post=self.post, created_at=created_at)
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM main_analyticpost_default")
+            self.assertEqual(cursor.fetchone()[0], 1)
+
+        self.partitionanalytics(6)
+        name = partitions.get_partition_name("main_analyticpost", created_at)
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM main_analyticpost_default")
+            self.assertEqual(cursor.fetchone()[0], 0)
+            cursor.execute(f"SELECT COUNT(*) FROM {name}")
+            self.assertEqual(cursor.fetchone()[0], 1)
+        self.assertEqual(models.AnalyticPost.objects.count(), 4)
+
+    def test_not_rolled_up_kept(self):
+        output = self.partitionanalytics(8)
+        self.assertIn("Keeping main_analyticpost_legacy, not rolled up yet.", output)
+        self.assertIn(
+            "main_analyticpost_legacy", self.get_partition_names("main_analyticpost")
+        )
+        self.assertEqual(models.AnalyticPost.objects.count(), 3)
+
+    def test_expired_dropped(self):
+        call_command("rollupanalytics", stdout=StringIO())
+
+        output = self.partitionanalytics(8)
+        self.assertIn("Dropped partition main_analyticpost_legacy", output)
+        self.assertNotIn(
+            "main_analyticpost_legacy", self.get_partition_names("main_analyticpost")
+        )
+        self.assertFalse(models.AnalyticPost.objects.exists())
+
+        # counts of dropped analytics are kept in the rollups
+        self.assertEqual(rollups.get_total("post"), 3)
+
+    def test_detach_only(self):
+        call_command("rollupanalytics", stdout=StringIO())
+
+        output = self.partitionanalytics(8, "--detach-only")
+        self.assertIn("Detached partition main_analyticpost_legacy", output)
+        self.assertFalse(models.AnalyticPost.objects.exists())
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM main_analyticpost_legacy")
+            self.assertEqual(cursor.fetchone()[0], 3)
+
+
+class MigrateImagesTest(TestCase):
+    """
+    Test migrateimages moves image data from the database to the image storage.
+    """
+
+    def setUp(self):
+        images_dir = self.enterContext(tempfile.TemporaryDirectory())
+        storage = {
+            "BACKEND": "django.core.files.storage.FileSystemStorage",
+            "OPTIONS": {"location": images_dir},
+        }
+        self.enterContext(
+            override_settings(STORAGES={**settings.STORAGES, "images": storage})
+        )
+        self.user = models.User.objects.create(username="alice")
+        for index, data in enumerate([b"first", b"second", b"first"]):
+            models.Image.objects.create(
+                owner=self.user,
+                name=f"image-{index}",
+                slug=f"image-{index}",
+                extension="png",
+                data=data,
+                size=len(data),
+            )
+
+    def test_command(self):
+        output = StringIO()
+        call_command("migrateimages", "--batch-size=2", "--sleep=0", stdout=output)
+        self.assertIn("Moved 3 images", output.getvalue())
+        self.assertIn("0 left in the database", output.getvalue())
+        self.assertIn("1 had the content of a stored file", output.getvalue())
+        self.assertIn("Storing 3 images (0.00MB) as 2 files", output.getvalue())
+
+        images = models.Image.objects.order_by("id")
+        self.assertFalse(images.filter(data__isnull=False).exists())
+        self.assertEqual(
+            [image.read() for image in images], [b"first", b"second", b"first"]
+        )
+        # the same content is stored once
+        self.assertEqual(images[0].sha256, images[2].sha256)
+        self.assertEqual(images[0].size, 5)
+
+        output = StringIO()
+        call_command("migrateimages", "--sleep=0", stdout=output)
+        self.assertIn("Moved 0 images", output.getvalue())
+
+
+class ReconcileImageUsageTest(TestCase):
+    """Test reconcileimageusage recomputes the image storage totals of users."""
+
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice")
+        for index, data in enumerate([b"first", b"second"]):
+            models.Image.objects.create(
+                owner=self.user,
+                name=f"image-{index}",
+                slug=f"image-{index}",
+                extension="png",
+                data=data,
+                size=len(data),
+            )
+
+    def test_kept(self):
+        usage = models.ImageUsage.objects.get(owner=self.user)
+        self.assertEqual((usage.total_bytes, usage.image_count), (11, 2))
+
+        output = StringIO()
+        call_command("reconcileimageusage", stdout=output)
+        self.assertIn("of 1 users, fixed 0", output.getvalue())
+
+    def test_drift(self):
+        models.ImageUsage.objects.filter(owner=self.user).update(
+            total_bytes=5, image_count=7
+        )
+        # a user whose images are all gone, with totals left behind
+        other = models.User.objects.create(username="bob")
+        models.ImageUsage.objects.create(owner=other, total_bytes=3, image_count=1)
+
+        output = StringIO()
+        call_command("reconcileimageusage", stdout=output)
+        self.assertIn(
+            "7 images of 5 bytes, now 2 images of 11 bytes", output.getvalue()
+        )
+        self.assertIn("of 2 users, fixed 2", output.getvalue())
+
+        usage = models.ImageUsage.objects.get(owner=self.user)
+        self.assertEqual((usage.total_bytes, usage.image_count), (11, 2))
+        usage = models.ImageUsage.objects.get(owner=other)
+        self.assertEqual((usage.total_bytes, usage.image_count), (0, 0))
+
+
+class IndexPostImagesTest(TestCase):
+    """Test indexpostimages indexes the images referred to in post bodies."""
+
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice")
+        self.image = models.Image.objects.create(
+            owner=self.user, name="vulf", slug="vulf1234", extension="png", data=b"x"
+        )
+        posts = [
+            models.Post(
+                owner=self.user,
+                title=f"Post {index}",
+                slug=f"post-{index}",
+                body=f"![vulf](/images/vulf1234.png) {index}" if index % 2 else "",
+            )
+            for index in range(5)
+        ]
+        # bulk_create saves no references, like posts saved before the index
+        models.Post.objects.bulk_create(posts)
+
+    def test_command(self):
+        output = StringIO()
+        call_command("indexpostimages", "--batch-size=2", stdout=output)
+        self.assertIn("Indexed 5 posts", output.getvalue())
+        self.assertIn("added 2 and removed 0 image references", output.getvalue())
+        self.assertEqual(
+            set(self.image.post_references.values_list("post__slug", flat=True)),
+            {"post-1", "post-3"},
+        )
+
+        models.Post.objects.filter(slug="post-1").update(body="")
+        output = StringIO()
+        call_command("indexpostimages", stdout=output)
+        self.assertIn("added 0 and removed 1 image references", output.getvalue())
+
+
+class ImageGCTest(TestCase):
+    """Test imagegc finds and deletes images nothing refers to."""
+
+    def setUp(self):
+        images_dir = self.enterContext(tempfile.TemporaryDirectory())
+        storage = {
+            "BACKEND": "django.core.files.storage.FileSystemStorage",
+            "OPTIONS": {"location": images_dir},
+        }
+        self.enterContext(
+            override_settings(STORAGES={**settings.STORAGES, "images": storage})
+        )
+        self.user = models.User.objects.create(username="alice")
+        for slug in ["inpost", "inpage", "infooter", "unused", "recent"]:
+            data = slug.encode()
+            models.Image.objects.create(
+                owner=self.user,
+                name=slug,
+                slug=slug,
+                extension="png",
+                size=len(data),
+                sha256=imagestore.save(data),
+            )
+        models.Image.objects.exclude(slug="recent").update(
+            uploaded_at=timezone.now() - timedelta(days=40)
+        )
+        models.Post.objects.create(
+            owner=self.user, title="Post", slug="post", body="![](/images/inpost.png)"
+        )
+        models.Page.objects.create(
+            owner=self.user, title="Page", slug="page", body="![](/images/inpage.png)"
+        )
+        self.user.footer_note = "![](/images/infooter.png)"
+        self.user.save()
+
+    def test_dry_run(self):
+        output = StringIO()
+        call_command("imagegc", stdout=output)
+        self.assertIn("alice: 1 images (0.00MB)", output.getvalue())
+        self.assertIn("Found 1 unreferenced images", output.getvalue())
+        self.assertIn("Dry run", output.getvalue())
+        self.assertEqual(models.Image.objects.count(), 5)
+
+    def test_delete(self):
+        output = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command(
+                "imagegc", "--delete", "--batch-size=1", "--sleep=0", stdout=output
+            )
+        self.assertIn("Deleted 1 images.", output.getvalue())
+        self.assertEqual(
+            set(models.Image.objects.values_list("slug", flat=True)),
+            {"inpost", "inpage", "infooter", "recent"},
+        )
+        usage = models.ImageUsage.objects.get(owner=self.user)
+        self.assertEqual(usage.image_count, 4)
+        name = imagestore.get_name(hashlib.sha256(b"unused").hexdigest())
+        self.assertFalse(imagestore.get_storage().exists(name))
+
+    def test_grace_days(self):
+        output = StringIO()
+        call_command("imagegc", "--grace-days=0", stdout=output)
+        self.assertIn("alice: 2 images", output.getvalue())
+
+
+class BenchRenderTest(TestCase):
+    """
+    Test benchrender measures rendering functions and compares to a baseline.
+    """
+
+    def benchrender(self, *args):
+        output = StringIO()
+        call_command(
+            "benchrender",
+            "--sizes=1",
+            "--repeat=2",
+            "--only=prose-1k",
+            *args,
+            stdout=output,
+        )
+        return output.getvalue()
+
+    def test_results_saved(self):
+        with tempfile.NamedTemporaryFile(suffix=".json") as results_file:
+            output = self.benchrender(f"--save={results_file.name}")
+            results = json.load(results_file)
+
+        self.assertEqual(
+            sorted(results),
+            [
+                "clean_html/prose-1k",
+                "create_post_slug/prose-1k",
+                "md_to_html/prose-1k",
+                "sanitize_text/prose-1k",
+                "syntax_highlight/prose-1k",
+            ],
+        )
+        self.assertIn("ops_per_sec", results["md_to_html/prose-1k"])
+        self.assertIn("p99_us", results["md_to_html/prose-1k"])
+        self.assertIn("md_to_html/prose-1k", output)
+        self.assertFalse(
+            models.User.objects.filter(username__startswith="benchrender").exists()
+        )
+
+    def test_existing_user_kept(self):
+        models.User.objects.create(username="benchrender")
+        self.benchrender()
+        self.assertEqual(
+            list(models.User.objects.values_list("username", flat=True)),
+            ["benchrender"],
+        )
+
+    def test_regression_over_baseline(self):
+        baseline = {"md_to_html/prose-1k": {"p50_us": 0.001}}
+        with tempfile.NamedTemporaryFile("w", suffix=".json") as baseline_file:
+            json.dump(baseline, baseline_file)
+            baseline_file.flush()
+            with self.assertRaisesMessage(CommandError, "1 benchmarks regressed"):
+                self.benchrender(f"--baseline={baseline_file.name}")
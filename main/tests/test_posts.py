@@ -243,6 +243,56 @@ class PostSanitizeHTMLTestCase(TestCase):
         self.assertFalse("<script>" in post.body_as_html)
 
 
+class PostRenderedBodyTestCase(TestCase):
+    """Test post body HTML is rendered on save and served from storage."""
+
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice")
+        self.client.force_login(self.user)
+        self.post = models.Post.objects.create(
+            owner=self.user,
+            title="New post",
+            slug="new-post",
+            body="Content **sentence**.",
+        )
+
+    def test_render_stored_on_create(self):
+        post = models.Post.objects.get(id=self.post.id)
+        self.assertEqual(post.body_html, "<p>Content <strong>sentence</strong>.</p>")
+        self.assertEqual(post.body_text, "Content sentence.")
+        self.assertNotEqual(post.body_hash, "")
+
+    def test_render_refreshed_on_update(self):
+        self.client.post(
+            reverse("post_update", args=(self.post.slug,)),
+            data={
+                "title": "New post",
+                "slug": "new-post",
+                "body": "Updated *content*.",
+            },
+            HTTP_HOST=self.user.username + "." + settings.CANONICAL_HOST,
+        )
+        post = models.Post.objects.get(id=self.post.id)
+        self.assertEqual(post.body_html, "<p>Updated <em>content</em>.</p>")
+        self.assertEqual(post.body_text, "Updated content.")
+
+    def test_stored_render_served(self):
+        models.Post.objects.filter(id=self.post.id).update(
+            body_html="<p>Stored render.</p>"
+        )
+        response = self.client.get(
+            reverse("post_detail", args=(self.post.slug,)),
+            HTTP_HOST=self.user.username + "." + settings.CANONICAL_HOST,
+        )
+        self.assertContains(response, "<p>Stored render.</p>")
+
+    def test_stale_render_not_served(self):
+        models.Post.objects.filter(id=self.post.id).update(body="Changed body.")
+        post = models.Post.objects.get(id=self.post.id)
+        self.assertEqual(post.body_as_html, "<p>Changed body.</p>")
+        self.assertEqual(post.body_as_text, "Changed body.")
+
+
 class PostUpdateTestCase(TestCase):
     def setUp(self):
         self.user = models.User.objects.create(username="alice")
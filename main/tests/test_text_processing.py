@@ -1,3 +1,5 @@
+import threading
+
 from django.test import SimpleTestCase
 
 from main import denylist, text_processing
@@ -41,3 +43,54 @@ class SanitizeTextTestCase(SimpleTestCase):
             text_processing.sanitize_text(text),
             "before controlsurrogate",
         )
+
+
+class SyntaxHighlightTestCase(SimpleTestCase):
+    def test_highlights_code_block(self):
+        text = "before\n```python\nx = 1\n```\nafter"
+
+        self.assertEqual(
+            text_processing.syntax_highlight(text),
+            'before\n<div style="background: #fdf6e3"><pre style="line-height: 125%;">'
+            '<span></span><span style="color: #657B83">x</span> '
+            '<span style="color: #93A1A1">=</span> '
+            '<span style="color: #2AA198">1</span>\n</pre></div>\nafter\n',
+        )
+
+    def test_preserves_generic_block(self):
+        text = "```\nplain\n```"
+
+        self.assertEqual(text_processing.syntax_highlight(text), text + "\n")
+
+    def test_unknown_lang_uses_c_lexer(self):
+        self.assertEqual(
+            text_processing.get_code_lexer("nonexistentlang").name,
+            text_processing.get_code_lexer("c").name,
+        )
+        self.assertIs(
+            text_processing.get_code_lexer("py"),
+            text_processing.get_code_lexer("py"),
+        )
+
+
+class MdToHtmlTestCase(SimpleTestCase):
+    def test_state_not_carried_between_renders(self):
+        text = "# Title\n\nText[^1]\n\n[^1]: Note"
+
+        first = text_processing.md_to_html(text)
+        second = text_processing.md_to_html(text)
+
+        self.assertEqual(first, second)
+        self.assertIn('id="title"', second)
+        self.assertEqual(second.count('class="footnote-backref"'), 1)
+        self.assertEqual(text_processing.md_to_html("Plain"), "<p>Plain</p>")
+
+    def test_pipeline_per_thread(self):
+        pipelines = []
+        thread = threading.Thread(
+            target=lambda: pipelines.append(text_processing.render_pipeline.markdown)
+        )
+        thread.start()
+        thread.join()
+
+        self.assertIsNot(pipelines[0], text_processing.render_pipeline.markdown)
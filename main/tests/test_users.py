@@ -1,8 +1,11 @@
+from datetime import timedelta
+
 from django.conf import settings
 from django.test import TestCase, override_settings
 from django.urls import reverse
+from django.utils import timezone
 
-from main import models, scheme
+from main import admin, hosts, models, scheme
 
 
 class IndexTestCase(TestCase):
@@ -301,6 +304,7 @@ class UserUpdateCommentsOnTestCase(TestCase):
 
 class UserDomainCheckTestCase(TestCase):
     def setUp(self):
+        hosts.domain_set.clear()
         self.user = models.User.objects.create(
             username="alice", custom_domain="example.com"
         )
@@ -332,6 +336,49 @@ class UserDomainCheckTestCase(TestCase):
         self.assertEqual(response.status_code, 403)
 
 
+class UserDomainCheckCacheTestCase(TestCase):
+    """Test domain_check answers from the in-memory domain set."""
+
+    def setUp(self):
+        hosts.domain_set.clear()
+        self.user = models.User.objects.create(
+            username="alice", custom_domain="example.com"
+        )
+        self.url = reverse("domain_check") + "?domain="
+
+    def test_answers_without_query(self):
+        response = self.client.get(self.url + "example.com")
+        self.assertEqual(response.status_code, 200)
+
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url + "example.com")
+            self.assertEqual(response.status_code, 200)
+            response = self.client.get(self.url + f"bob.{settings.CANONICAL_HOST}")
+            self.assertEqual(response.status_code, 403)
+
+    def test_new_user_allowed(self):
+        response = self.client.get(self.url + f"bob.{settings.CANONICAL_HOST}")
+        self.assertEqual(response.status_code, 403)
+
+        models.User.objects.create(username="bob", custom_domain="bob.example.com")
+        response = self.client.get(self.url + f"bob.{settings.CANONICAL_HOST}")
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(self.url + "bob.example.com")
+        self.assertEqual(response.status_code, 200)
+
+    def test_refresh_by_watermark(self):
+        response = self.client.get(self.url + "new.example.com")
+        self.assertEqual(response.status_code, 403)
+
+        # update without save() so that only the refresh can pick it up
+        models.User.objects.filter(id=self.user.id).update(
+            custom_domain="new.example.com", updated_at=timezone.now()
+        )
+        hosts.domain_set.refreshed_at = None
+        response = self.client.get(self.url + "new.example.com")
+        self.assertEqual(response.status_code, 200)
+
+
 class CustomDomainAuthRedirectTestCase(TestCase):
     """Test that auth URLs on custom domains redirect to canonical domain."""
 
@@ -391,3 +438,16 @@ class CustomDomainAuthRedirectTestCase(TestCase):
         self.assertEqual(response.status_code, 302)
         expected_url = f"{scheme.get_protocol()}//{settings.CANONICAL_HOST}/accounts/password_change/"
         self.assertEqual(response.url, expected_url)
+
+
+class UserAdminApproveTestCase(TestCase):
+    def setUp(self):
+        self.user = models.User.objects.create(username="alice")
+        models.User.objects.update(updated_at=timezone.now() - timedelta(days=1))
+
+    def test_approve_touches_blog(self):
+        before = models.User.objects.get(id=self.user.id).updated_at
+        admin.make_approved(None, None, models.User.objects.filter(id=self.user.id))
+        user = models.User.objects.get(id=self.user.id)
+        self.assertTrue(user.is_approved)
+        self.assertGreater(user.updated_at, before)
@@ -1,5 +1,7 @@
-import io
+import functools
+import hashlib
 import re
+import threading
 import uuid
 import zipfile
 
@@ -13,6 +15,11 @@ from pygments.lexers import ClassNotFound, get_lexer_by_name, get_lexer_for_file
 
 from main import denylist, models
 
+# Bump whenever a change in the markdown pipeline alters its output (extensions,
+# syntax highlighting, denylist), so that stored renders are recognised as stale
+# and then run `manage.py rerender` to regenerate them in bulk.
+RENDERER_VERSION = 1
+
 
 def get_approx_number(number):
     """Get approximate number, eg. 1823 -> 2k"""
@@ -55,60 +62,95 @@ def create_post_slug(post_title, owner, post=None):
     return slug
 
 
+# one formatter shared by all code blocks, it keeps no state between calls
+CODE_FORMATTER = HtmlFormatter(style="solarized-light", noclasses=True, cssclass="")
+
+
+@functools.lru_cache(maxsize=256)
+def get_code_lexer(lang):
+    """Return the pygments lexer for a code block language tag."""
+    try:
+        return get_lexer_for_filename("file." + lang)
+    except ClassNotFound:
+        try:
+            return get_lexer_by_name(lang)
+        except ClassNotFound:
+            # can't find lexer, just use C lang as default
+            return get_lexer_by_name("c")
+
+
 def syntax_highlight(text):
     """Highlights markdown codeblocks within a markdown text."""
 
-    processed_text = ""
-    within_code_block = False
-    lexer = None
-    code_block = ""
+    processed_parts = []
+    lexer = None  # set while within a code block
+    code_lines = []
     for line in text.split("\n"):
         # code block backticks found, either begin or end
         if line[:3] == "```":
-            if not within_code_block:
+            if lexer is None:
                 # then this is the beginning of a block
                 lang = line[3:].strip()
 
+                # only a block with a lang is a *code* block, a generic
+                # block (non-code) is kept as is
                 if lang:
-                    # then this is a *code* block
-                    within_code_block = True
-                    lang_filename = "file." + lang
-                    try:
-                        lexer = get_lexer_for_filename(lang_filename)
-                    except ClassNotFound:
-                        try:
-                            lexer = get_lexer_by_name(lang)
-                        except ClassNotFound:
-                            # can't find lexer, just use C lang as default
-                            lexer = get_lexer_by_name("c")
+                    lexer = get_code_lexer(lang)
 
                     # continue because we don't want to add backticks in the processed text
                     continue
-                else:
-                    # no lang, so just a generic block (non-code)
-                    lexer = None
 
             else:
                 # then this is the end of a code block
                 # actual highlighting happens here
-                within_code_block = False
-                highlighted_block = pygments.highlight(
-                    code_block,
-                    lexer,
-                    HtmlFormatter(style="solarized-light", noclasses=True, cssclass=""),
+                code_lines.append("")  # every code line ends with a newline
+                processed_parts.append(
+                    pygments.highlight("\n".join(code_lines), lexer, CODE_FORMATTER)
                 )
-                processed_text += highlighted_block
-                code_block = ""  # reset code_block variable
+                lexer = None
+                code_lines = []
 
                 # continue because we don't want to add backticks in the processed text
                 continue
 
-        if within_code_block:
-            code_block += line + "\n"
+        if lexer is None:
+            processed_parts.append(line)
+            processed_parts.append("\n")
         else:
-            processed_text += line + "\n"
+            code_lines.append(line)
+
+    return "".join(processed_parts)
 
-    return processed_text
+
+class RenderPipeline(threading.local):
+    """
+    Markdown and bleach objects are costly to construct and not thread-safe,
+    so each thread builds them once and reuses them for every render.
+    """
+
+    def __init__(self):
+        self.markdown = markdown.Markdown(
+            extensions=[
+                "markdown.extensions.fenced_code",
+                "markdown.extensions.tables",
+                "markdown.extensions.footnotes",
+                "markdown.extensions.toc",
+            ]
+        )
+        self.cleaner = bleach.sanitizer.Cleaner(
+            tags=denylist.ALLOWED_HTML_ELEMENTS,
+            attributes=denylist.ALLOWED_HTML_ATTRS,
+            css_sanitizer=CSSSanitizer(
+                allowed_css_properties=denylist.ALLOWED_CSS_STYLES
+            ),
+        )
+        self.strip_cleaner = bleach.sanitizer.Cleaner(strip=True)
+        self.text_cleaner = bleach.sanitizer.Cleaner(tags=[], strip=True)
+        # callback drops the generated links, keeping their text only
+        self.linker = bleach.linkifier.Linker(callbacks=[lambda attrs, new: None])
+
+
+render_pipeline = RenderPipeline()
 
 
 def clean_html(dirty_html, strip_tags=False):
@@ -117,33 +159,36 @@ def clean_html(dirty_html, strip_tags=False):
     - strip_tags: true will strip everything, false will escape.
     """
     if strip_tags:
-        return bleach.clean(dirty_html, strip=True)
-
-    css_sanitizer = CSSSanitizer(allowed_css_properties=denylist.ALLOWED_CSS_STYLES)
-    return bleach.clean(
-        dirty_html,
-        tags=denylist.ALLOWED_HTML_ELEMENTS,
-        attributes=denylist.ALLOWED_HTML_ATTRS,
-        css_sanitizer=css_sanitizer,
-    )
+        return render_pipeline.strip_cleaner.clean(dirty_html)
+    return render_pipeline.cleaner.clean(dirty_html)
 
 
 def md_to_html(markdown_string, strip_tags=False):
     """Return HTML formatted string, given a markdown one."""
     if not markdown_string:
         return ""
-    dirty_html = markdown.markdown(
-        syntax_highlight(markdown_string),
-        extensions=[
-            "markdown.extensions.fenced_code",
-            "markdown.extensions.tables",
-            "markdown.extensions.footnotes",
-            "markdown.extensions.toc",
-        ],
-    )
+    # reset clears state such as footnotes and toc ids left by the last render
+    md = render_pipeline.markdown.reset()
+    dirty_html = md.convert(syntax_highlight(markdown_string))
     return clean_html(dirty_html, strip_tags)
 
 
+def html_to_text(html):
+    """Return plain text of an HTML string, with all tags stripped."""
+    return render_pipeline.text_cleaner.clean(html)
+
+
+def linkify(html):
+    """Run HTML string through the bleach linkifier."""
+    return render_pipeline.linker.linkify(html)
+
+
+def get_render_hash(markdown_string):
+    """Return the hash that keys the stored render of a markdown string."""
+    payload = f"{RENDERER_VERSION}:{markdown_string or ''}"
+    return hashlib.sha256(payload.encode("utf-8", "surrogatepass")).hexdigest()
+
+
 def remove_control_chars(text):
     """Remove control characters from a string.
 
@@ -167,25 +212,27 @@ def sanitize_text(text):
 
 
 def get_markdown_export_files(user):
-    export_files = []
-
-    posts = models.Post.objects.filter(owner=user)
-    for post in posts:
+    """
+    Yield (file name, markdown) of the posts and pages of user, read with a
+    server-side cursor so that they are never all in memory.
+    """
+    posts = models.Post.objects.filter(owner=user).only(
+        "title", "slug", "body", "published_at", "created_at"
+    )
+    for post in posts.iterator(chunk_size=100):
         pub_date = post.published_at or post.created_at
         title = post.slug + ".md"
         body = f"# {post.title}\n\n"
         body += f"> Published on {pub_date.strftime('%b %-d, %Y')}\n\n"
         body += f"{post.body}\n"
-        export_files.append((title, io.BytesIO(body.encode())))
+        yield title, body
 
-    pages = models.Page.objects.filter(owner=user)
-    for page in pages:
+    pages = models.Page.objects.filter(owner=user).only("title", "slug", "body")
+    for page in pages.iterator(chunk_size=100):
         title = f"pages/{page.slug}.md"
         body = f"# {page.title}\n\n"
         body += f"{page.body}\n"
-        export_files.append((title, io.BytesIO(body.encode())))
-
-    return export_files
+        yield title, body
 
 
 def generate_markdown_export(user_id):
@@ -205,7 +252,7 @@ def generate_markdown_export(user_id):
     ) as export_archive:
         for file_name, data in export_files:
             export_archive.writestr(
-                export_name + f"/{container_dir}/" + file_name, data.getvalue()
+                export_name + f"/{container_dir}/" + file_name, data
             )
 
     return (export_name, zip_outfile)
@@ -125,7 +125,7 @@ urlpatterns += [
 
 # blog extras
 urlpatterns += [
-    path("rss/", feeds.RSSBlogFeed(), name="rss_feed"),
+    path("rss/", feeds.rss_feed, name="rss_feed"),
     path("sitemap.xml", general.sitemap, name="sitemap"),
     path("newsletter/", general.Notification.as_view(), name="notification_subscribe"),
     path(
@@ -250,6 +250,11 @@ urlpatterns += [
 # images
 urlpatterns += [
     path("images/<slug:slug>.<slug:extension>", general.image_raw, name="image_raw"),
+    path(
+        "images/<slug:slug>.w<int:width>.<slug:extension>",
+        general.image_variant,
+        name="image_variant",
+    ),
     re_path(
         r"^images/(?P<options>\?[\w\=]+)?$",  # e.g. images/ or images/?raw=true
         general.ImageList.as_view(),
@@ -269,6 +274,7 @@ urlpatterns += [
 # analytics
 urlpatterns += [
     path("analytics/", general.AnalyticList.as_view(), name="analytic_list"),
+    path("analytics/export/", export.export_analytics, name="export_analytics"),
     path(
         "analytics/post/<slug:post_slug>/",
         general.AnalyticPostDetail.as_view(),
@@ -1,17 +1,18 @@
-import io
+import csv
+import itertools
+import json
 import re
 import uuid
-import zipfile
 from datetime import datetime
 from string import Template
 
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponse
+from django.http import HttpResponseBadRequest, StreamingHttpResponse
 from django.shortcuts import render
 from django.views.decorators.http import require_POST
 
-from main import models, text_processing
+from main import models, rollups, text_processing, zipstream
 
 
 def prepend_zola_frontmatter(body, post_title, pub_date):
@@ -36,6 +37,17 @@ def prepend_hugo_frontmatter(body, post_title, pub_date, post_slug):
     return frontmatter + body
 
 
+def _iter_export_posts(user, *fields):
+    """
+    Return iterator of posts of user, read with a server-side cursor so that
+    only a chunk of them is in memory at once.
+    """
+    posts = models.Post.objects.filter(owner=user).only(
+        "title", "slug", "body", "published_at", "created_at", *fields
+    )
+    return posts.iterator(chunk_size=100)
+
+
 def export_index(request):
     return render(request, "main/export_index.html")
 
@@ -45,19 +57,17 @@ def export_index(request):
 def export_markdown(request):
     export_files = text_processing.get_markdown_export_files(request.user)
 
-    # create zip archive in memory
+    # zip archive streamed as it is written
     export_name = "export-markdown-" + str(uuid.uuid4())[:8]
     container_dir = f"{request.user.username}-mataroa-blog"
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(
-        zip_buffer, "a", zipfile.ZIP_DEFLATED, False
-    ) as export_archive:
-        for file_name, data in export_files:
-            export_archive.writestr(
-                export_name + f"/{container_dir}/" + file_name, data.getvalue()
-            )
+    entries = (
+        (export_name + f"/{container_dir}/" + file_name, data)
+        for file_name, data in export_files
+    )
 
-    response = HttpResponse(zip_buffer.getvalue(), content_type="application/zip")
+    response = StreamingHttpResponse(
+        zipstream.iter_zip(entries), content_type="application/zip"
+    )
     response["Content-Disposition"] = f"attachment; filename={export_name}.zip"
     return response
 
@@ -84,35 +94,27 @@ def export_zola(request):
     with open("./export_base_zola/404.html") as zola_404_file:
         zola_404 = zola_404_file.read()
 
-    # get all user posts and add them into export_posts encoded
-    posts = models.Post.objects.filter(owner=request.user)
-    export_posts = []
-    for p in posts:
-        pub_date = p.published_at or p.created_at.date()
-        title = p.slug + ".md"
-        body = prepend_zola_frontmatter(
-            p.body, text_processing.escape_quotes(p.title), pub_date
-        )
-        export_posts.append((title, io.BytesIO(body.encode())))
-
-    # create zip archive in memory
     export_name = "export-zola-" + str(uuid.uuid4())[:8]
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(
-        zip_buffer, "a", zipfile.ZIP_DEFLATED, False
-    ) as export_archive:
-        export_archive.writestr(export_name + "/config.toml", zola_config)
-        export_archive.writestr(export_name + "/static/style.css", zola_styles)
-        export_archive.writestr(export_name + "/templates/index.html", zola_index)
-        export_archive.writestr(export_name + "/templates/post.html", zola_post)
-        export_archive.writestr(export_name + "/templates/404.html", zola_404)
-        export_archive.writestr(export_name + "/content/_index.md", zola_content_index)
-        for file_name, data in export_posts:
-            export_archive.writestr(
-                export_name + "/content/" + file_name, data.getvalue()
+
+    def get_entries():
+        yield export_name + "/config.toml", zola_config
+        yield export_name + "/static/style.css", zola_styles
+        yield export_name + "/templates/index.html", zola_index
+        yield export_name + "/templates/post.html", zola_post
+        yield export_name + "/templates/404.html", zola_404
+        yield export_name + "/content/_index.md", zola_content_index
+
+        # all user posts, read as the archive is written
+        for p in _iter_export_posts(request.user):
+            pub_date = p.published_at or p.created_at.date()
+            body = prepend_zola_frontmatter(
+                p.body, text_processing.escape_quotes(p.title), pub_date
             )
+            yield export_name + "/content/" + p.slug + ".md", body
 
-    response = HttpResponse(zip_buffer.getvalue(), content_type="application/zip")
+    response = StreamingHttpResponse(
+        zipstream.iter_zip(get_entries()), content_type="application/zip"
+    )
     response["Content-Disposition"] = f"attachment; filename={export_name}.zip"
     return response
 
@@ -145,51 +147,35 @@ def export_hugo(request):
     with open("./export_base_hugo/404.html") as hugo_404_file:
         hugo_404 = hugo_404_file.read()
 
-    # get all user posts and add them into export_posts encoded
-    posts = models.Post.objects.filter(owner=request.user)
-    export_posts = []
-    for p in posts:
-        title = p.slug + ".md"
-        pub_date = p.published_at or p.created_at.date()
-        body = prepend_hugo_frontmatter(
-            p.body, text_processing.escape_quotes(p.title), pub_date, p.slug
-        )
-        export_posts.append((title, io.BytesIO(body.encode())))
-
-    # create zip archive in memory
     export_name = "export-hugo-" + str(uuid.uuid4())[:8]
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(
-        zip_buffer, "a", zipfile.ZIP_DEFLATED, False
-    ) as export_archive:
-        export_archive.writestr(export_name + "/config.toml", hugo_config)
-        export_archive.writestr(export_name + "/themes/mataroa/theme.toml", hugo_theme)
-        export_archive.writestr(
-            export_name + "/themes/mataroa/static/style.css", hugo_styles
-        )
-        export_archive.writestr(
-            export_name + "/themes/mataroa/layouts/index.html", hugo_index
-        )
-        export_archive.writestr(
-            export_name + "/themes/mataroa/layouts/404.html", hugo_404
-        )
-        export_archive.writestr(
+
+    def get_entries():
+        yield export_name + "/config.toml", hugo_config
+        yield export_name + "/themes/mataroa/theme.toml", hugo_theme
+        yield export_name + "/themes/mataroa/static/style.css", hugo_styles
+        yield export_name + "/themes/mataroa/layouts/index.html", hugo_index
+        yield export_name + "/themes/mataroa/layouts/404.html", hugo_404
+        yield (
             export_name + "/themes/mataroa/layouts/_default/single.html",
             hugo_single,
         )
-        export_archive.writestr(
-            export_name + "/themes/mataroa/layouts/_default/list.html", hugo_list
-        )
-        export_archive.writestr(
+        yield export_name + "/themes/mataroa/layouts/_default/list.html", hugo_list
+        yield (
             export_name + "/themes/mataroa/layouts/_default/baseof.html",
             hugo_baseof,
         )
-        for file_name, data in export_posts:
-            export_archive.writestr(
-                export_name + "/content/" + file_name, data.getvalue()
+
+        # all user posts, read as the archive is written
+        for p in _iter_export_posts(request.user):
+            pub_date = p.published_at or p.created_at.date()
+            body = prepend_hugo_frontmatter(
+                p.body, text_processing.escape_quotes(p.title), pub_date, p.slug
             )
+            yield export_name + "/content/" + p.slug + ".md", body
 
-    response = HttpResponse(zip_buffer.getvalue(), content_type="application/zip")
+    response = StreamingHttpResponse(
+        zipstream.iter_zip(get_entries()), content_type="application/zip"
+    )
     response["Content-Disposition"] = f"attachment; filename={export_name}.zip"
     return response
 
@@ -316,17 +302,18 @@ def export_epub(request):
     with open("./export_base_epub/container.xml") as container_xml_file:
         container_xml_content = container_xml_file.read()
 
-    # process posts
-    posts = models.Post.objects.filter(owner=request.user)
+    # process posts, only their titles as chapter bodies are made while streamed
+    posts = models.Post.objects.filter(owner=request.user).values_list("id", "title")
     content_chapters = []
-    for index, p in enumerate(posts):
+    for index, (post_id, title) in enumerate(posts):
         chapter = {
-            "body": _get_epub_chapter(p),
-            "title": p.title,
+            "post_id": post_id,
+            "title": title,
             "id": index + 1,  # +1 because we want to start from 1
             "link": f"{str(index + 1)}.xhtml",
         }
         content_chapters.append(chapter)
+    images = models.Image.objects.filter(owner=request.user)
 
     # process content.opf
     content_opf_manifest = ""
@@ -340,7 +327,7 @@ def export_epub(request):
         content_opf_spine += f'    <itemref idref="{chapter["id"]}"/>' + "\n"
 
     # add images to manifest
-    for img in models.Image.objects.filter(owner=request.user):
+    for img in images.only("slug", "extension"):
         # determine media type based on file extension
         if img.filename.lower().endswith((".jpg", ".jpeg")):
             media_type = "image/jpeg"
@@ -435,32 +422,77 @@ def export_epub(request):
         )
         toc_ncx_content = toc_ncx_content.replace("<!-- nav points -->", toc_ncx_body)
 
-    # create zip archive in memory
     export_name = "export-book-" + epub_uuid[:8]
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(
-        zip_buffer, "a", zipfile.ZIP_DEFLATED, False
-    ) as export_archive:
-        # write meta pages
-        export_archive.writestr("mimetype", mimetype_content)
-        export_archive.writestr("META-INF/container.xml", container_xml_content)
-        export_archive.writestr("OEBPS/content.opf", content_opf_content)
-        export_archive.writestr("OEBPS/toc.xhtml", toc_xhtml_content)
-        export_archive.writestr("OEBPS/toc.ncx", toc_ncx_content)
 
-        # write post / chapter  files
-        for chapter in content_chapters:
-            export_archive.writestr(f"OEBPS/{chapter['link']}", chapter["body"])
+    def get_entries():
+        # write meta pages
+        yield "mimetype", mimetype_content
+        yield "META-INF/container.xml", container_xml_content
+        yield "OEBPS/content.opf", content_opf_content
+        yield "OEBPS/toc.xhtml", toc_xhtml_content
+        yield "OEBPS/toc.ncx", toc_ncx_content
+
+        # write post / chapter files, reading posts as the archive is written
+        chapter_links = {
+            chapter["post_id"]: chapter["link"] for chapter in content_chapters
+        }
+        for p in _iter_export_posts(request.user, "body_html", "body_hash"):
+            # posts added since the chapters were listed are left out
+            if p.id in chapter_links:
+                yield f"OEBPS/{chapter_links[p.id]}", _get_epub_chapter(p)
 
-        # write images
-        for img in models.Image.objects.filter(owner=request.user):
-            export_archive.writestr(f"OEBPS/images/{img.filename}", img.data)
+        # write images, each file read in chunks
+        for img in images.iterator(chunk_size=20):
+            yield f"OEBPS/images/{img.filename}", img.open()
 
         # write title page
-        export_archive.writestr(
-            "OEBPS/titlepage.xhtml", _get_epub_titlepage(request.user)
-        )
+        yield "OEBPS/titlepage.xhtml", _get_epub_titlepage(request.user)
 
-    response = HttpResponse(zip_buffer.getvalue(), content_type="application/epub")
+    response = StreamingHttpResponse(
+        zipstream.iter_zip(get_entries()), content_type="application/epub"
+    )
     response["Content-Disposition"] = f"attachment; filename={export_name}.epub"
     return response
+
+
+class Echo:
+    """File-like object returning what is written, for csv writers to stream."""
+
+    def write(self, value):
+        return value
+
+
+def get_analytics_export_rows(user):
+    """Yield (date, type, post slug or page path, visits) of analytics of user."""
+    post_slugs = dict(models.Post.objects.filter(owner=user).values_list("id", "slug"))
+    for post_id, date, count in rollups.iter_day_counts("post", post__owner=user):
+        yield date, "post", post_slugs.get(post_id, post_id), count
+    for _, path, date, count in rollups.iter_day_counts("page", user=user):
+        yield date, "page", path, count
+
+
+@login_required
+def export_analytics(request):
+    export_format = request.GET.get("format", "csv")
+    rows = get_analytics_export_rows(request.user)
+    if export_format == "csv":
+        writer = csv.writer(Echo())
+        header = [("date", "type", "name", "visits")]
+        content = (writer.writerow(row) for row in itertools.chain(header, rows))
+        content_type = "text/csv"
+    elif export_format == "ndjson":
+        content = (
+            json.dumps(
+                {"date": date.isoformat(), "type": kind, "name": name, "visits": count}
+            )
+            + "\n"
+            for date, kind, name, count in rows
+        )
+        content_type = "application/x-ndjson"
+    else:
+        return HttpResponseBadRequest("Unknown export format.")
+
+    response = StreamingHttpResponse(content, content_type=content_type)
+    export_name = f"{request.user.username}-mataroa-analytics.{export_format}"
+    response["Content-Disposition"] = f"attachment; filename={export_name}"
+    return response
@@ -1,7 +1,9 @@
 import base64
 import binascii
+import hashlib
 import json
 import logging
+import re
 import time
 import uuid
 from collections import defaultdict
@@ -9,6 +11,7 @@ from datetime import datetime, timedelta
 from email.utils import parseaddr
 
 import stripe
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth import authenticate, login
@@ -19,9 +22,11 @@ from django.contrib.messages.views import SuccessMessageMixin
 from django.contrib.sitemaps.views import sitemap as DjSitemapView
 from django.core import mail, signing
 from django.core.exceptions import PermissionDenied, TooManyFilesSent
-from django.db.models import Count, Sum
-from django.db.models.functions import Length, TruncDay
+from django.db import transaction
+from django.db.models import Count
+from django.db.models.functions import TruncDay
 from django.http import (
+    FileResponse,
     Http404,
     HttpResponse,
     HttpResponseBadRequest,
@@ -30,7 +35,9 @@ from django.http import (
 from django.shortcuts import get_object_or_404, redirect, render
 from django.urls import reverse, reverse_lazy
 from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_vary_headers
 from django.utils.crypto import constant_time_compare
+from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
 from django.views.generic import (
@@ -43,7 +50,21 @@ from django.views.generic import (
     UpdateView,
 )
 
-from main import denylist, forms, models, scheme, text_processing
+from main import (
+    analytics,
+    conditional,
+    denylist,
+    forms,
+    hosts,
+    imagequota,
+    imagestore,
+    imagevariants,
+    models,
+    pagecache,
+    rollups,
+    scheme,
+    text_processing,
+)
 from main.sitemaps import PageSitemap, PostSitemap, StaticSitemap
 from main.views import billing
 
@@ -76,51 +97,54 @@ def dashboard(request):
     )
 
 
+@conditional.blog_conditional(
+    get_hit=lambda request: ("page", request.blog_user_id, "index")
+)
+@pagecache.cache_page
 def index(request):
-    if hasattr(request, "subdomain"):
-        if models.User.objects.filter(username=request.subdomain).exists():
-            drafts = []
-            if request.user.is_authenticated and request.user == request.blog_user:
-                posts = (
-                    models.Post.objects.filter(owner=request.blog_user)
-                    .defer("body")
-                    .select_related("owner")
-                )
-                drafts = (
-                    models.Post.objects.filter(
-                        owner=request.blog_user,
-                        published_at__isnull=True,
-                    )
-                    .defer("body")
-                    .select_related("owner")
-                )
-            else:
-                models.AnalyticPage.objects.create(user=request.blog_user, path="index")
-                posts = (
-                    models.Post.objects.filter(
-                        owner=request.blog_user,
-                        published_at__isnull=False,
-                        published_at__lte=timezone.now().date(),
-                    )
-                    .defer("body")
-                    .select_related("owner")
+    # host_middleware sets the blog of a subdomain or custom domain only when it
+    # exists, and raises 404 otherwise
+    if hasattr(request, "blog_user_id"):
+        drafts = []
+        if request.user.is_authenticated and request.user == request.blog_user:
+            posts = (
+                models.Post.objects.filter(owner=request.blog_user)
+                .defer("body", "body_html", "body_text")
+                .select_related("owner")
+            )
+            drafts = (
+                models.Post.objects.filter(
+                    owner=request.blog_user,
+                    published_at__isnull=True,
                 )
-
-            return render(
-                request,
-                "main/blog_index.html",
-                {
-                    "subdomain": request.subdomain,
-                    "blog_user": request.blog_user,
-                    "posts": posts,
-                    "drafts": drafts,
-                    "pages": models.Page.objects.filter(
-                        owner=request.blog_user, is_hidden=False
-                    ).defer("body"),
-                },
+                .defer("body", "body_html", "body_text")
+                .select_related("owner")
             )
         else:
-            return redirect("//" + settings.CANONICAL_HOST + reverse("index"))
+            analytics.record_hit(request, "page", request.blog_user_id, "index")
+            posts = (
+                models.Post.objects.filter(
+                    owner=request.blog_user,
+                    published_at__isnull=False,
+                    published_at__lte=timezone.now().date(),
+                )
+                .defer("body", "body_html", "body_text")
+                .select_related("owner")
+            )
+
+        return render(
+            request,
+            "main/blog_index.html",
+            {
+                "subdomain": request.subdomain,
+                "blog_user": request.blog_user,
+                "posts": posts,
+                "drafts": drafts,
+                "pages": models.Page.objects.filter(
+                    owner=request.blog_user, is_hidden=False
+                ).defer("body"),
+            },
+        )
 
     if request.user.is_authenticated:
         return redirect("blog_index")
@@ -134,6 +158,9 @@ def domain_check(request):
     * canonical host (main domain)
     * subdomain of canonical host of existing user/blog
     * custom domain of existing user/blog
+
+    Caddy asks this on every TLS handshake for an unknown name, so users are
+    looked up in the in-memory hosts.domain_set instead of the database.
     """
     url = request.GET.get("domain")
     if not url:
@@ -151,11 +178,11 @@ def domain_check(request):
         and ".".join(host_parts[1:]) == settings.CANONICAL_HOST
     ):
         subdomain = host_parts[0]
-        if models.User.objects.filter(username=subdomain).exists():
+        if hosts.domain_set.has_username(subdomain):
             return HttpResponse()
 
     # allow custom domains
-    if models.User.objects.filter(custom_domain=url).exists():
+    if hosts.domain_set.has_custom_domain(url):
         return HttpResponse()
 
     raise PermissionDenied()
@@ -254,12 +281,9 @@ class UserUpdate(LoginRequiredMixin, SuccessMessageMixin, UpdateView):
             return self.render_to_response(self.get_context_data(form=form))
 
         # we need to check if more than one users have the same custom domain
-        if not form.cleaned_data.get("custom_domain"):
-            # if it's not submitted, then just return
-            return super().form_valid(form)
-
         if (
-            models.User.objects.filter(
+            form.cleaned_data.get("custom_domain")
+            and models.User.objects.filter(
                 custom_domain=form.cleaned_data.get("custom_domain")
             )
             .exclude(id=self.request.user.id)  # exclude current user
@@ -271,7 +295,11 @@ class UserUpdate(LoginRequiredMixin, SuccessMessageMixin, UpdateView):
             )
             return self.render_to_response(self.get_context_data(form=form))
 
-        return super().form_valid(form)
+        response = super().form_valid(form)
+        # hosts of the new username and domain are invalidated on save, but
+        # the previous ones must stop resolving to this blog too
+        hosts.invalidate_blog(form.initial["username"], form.initial["custom_domain"])
+        return response
 
 
 class UserDelete(LoginRequiredMixin, DeleteView):
@@ -305,6 +333,7 @@ def post_detail_redir(request, slug):
     return redirect("post_detail", slug=slug, permanent=True)
 
 
+@conditional.blog_conditional()
 def post_raw(request, slug):
     """Return raw markdown source of a post as plain text."""
     if not hasattr(request, "subdomain"):
@@ -326,6 +355,17 @@ def post_raw(request, slug):
     return HttpResponse(content, content_type="text/plain; charset=utf-8")
 
 
+def _get_post_hit(request, slug):
+    post_id = (
+        models.Post.objects.filter(owner_id=request.blog_user_id, slug=slug)
+        .values_list("id", flat=True)
+        .first()
+    )
+    return ("post", post_id) if post_id else None
+
+
+@method_decorator(conditional.blog_conditional(get_hit=_get_post_hit), name="dispatch")
+@method_decorator(pagecache.cache_page, name="dispatch")
 class PostDetail(DetailView):
     model = models.Post
 
@@ -348,6 +388,7 @@ class PostDetail(DetailView):
             )
             # Signed timestamp for the anti-spam time trap in CommentCreate.
             context["comment_ts"] = signing.dumps(int(time.time()))
+            context.update(pagecache.get_placeholders(self.request))
 
         # do not record analytic if post is authed user's
         if (
@@ -355,7 +396,7 @@ class PostDetail(DetailView):
             and self.request.user == self.object.owner
         ):
             return context
-        models.AnalyticPost.objects.create(post=self.object)
+        analytics.record_hit(self.request, "post", self.object.id)
 
         return context
 
@@ -769,11 +810,123 @@ class BlogImport(LoginRequiredMixin, FormView):
         return HttpResponseRedirect(self.get_success_url())
 
 
+def get_byte_range(range_header, size):
+    """
+    Return (first, last) byte positions of a single range Range header, or
+    None for headers of other forms, which are served the whole file. Raises
+    ValueError for ranges outside of a file of size.
+    """
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", range_header.strip())
+    if not match or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if size == 0:
+        # no byte of an empty file can be sent, not even of a suffix range
+        raise ValueError("Range of empty file.")
+    if not first:
+        # suffix range, of the last bytes
+        if int(last) == 0:
+            raise ValueError("Empty suffix range.")
+        return max(size - int(last), 0), size - 1
+    first, last = int(first), int(last) if last else size - 1
+    if first >= size or last < first:
+        raise ValueError("Range outside of file.")
+    return first, min(last, size - 1)
+
+
+def serve_image_file(request, image_file, size, etag, content_type, filename):
+    """
+    Return response of an immutable image file of size, closing image_file
+    unless the response streams it.
+    """
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "public, max-age=31536000, immutable",
+        "Accept-Ranges": "bytes",
+    }
+    response = get_conditional_response(request, etag=etag)
+    byte_range = None
+    range_header = request.headers.get("Range")
+    if_range = request.headers.get("If-Range")
+    if response is None and range_header and if_range in (None, etag):
+        try:
+            byte_range = get_byte_range(range_header, size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            headers["Content-Range"] = f"bytes */{size}"
+
+    if response is not None:
+        image_file.close()
+    elif byte_range is not None:
+        first, last = byte_range
+        with image_file:
+            image_file.seek(first)
+            data = image_file.read(last - first + 1)
+        response = HttpResponse(data, status=206, content_type=content_type)
+        headers["Content-Range"] = f"bytes {first}-{last}/{size}"
+    else:
+        # files on disk are sent by the server without passing through python
+        response = FileResponse(
+            image_file, content_type=content_type, filename=filename
+        )
+    for header, value in headers.items():
+        response[header] = value
+    return response
+
+
+def serve_image(request, image):
+    sha256 = image.sha256 or hashlib.sha256(image.data).hexdigest()
+    return serve_image_file(
+        request,
+        image.open(),
+        size=image.size,
+        etag=f'"{sha256}"',
+        content_type="image/" + image.extension,
+        filename=image.filename,
+    )
+
+
+def serve_image_variant(request, image, width, extension):
+    variant = imagevariants.open_variant(image, width, extension)
+    if variant is None:
+        return serve_image(request, image)
+    variant_file, size = variant
+    return serve_image_file(
+        request,
+        variant_file,
+        size=size,
+        etag=f'"{image.sha256}.{imagevariants.get_variant_name(width, extension)}"',
+        content_type="image/" + extension,
+        filename=f"{image.slug}.w{width}.{extension}",
+    )
+
+
 async def image_raw(request, slug, extension):
     image = await models.Image.objects.filter(slug=slug).afirst()
     if not image or extension != image.extension:
         raise Http404()
-    return HttpResponse(image.data, content_type="image/" + image.extension)
+    return await sync_to_async(serve_image)(request, image)
+
+
+async def image_variant(request, slug, width, extension):
+    image = await models.Image.objects.filter(slug=slug).afirst()
+    if not image or width not in imagevariants.WIDTHS:
+        raise Http404()
+    if extension == image.extension:
+        # the same URL serves the best format each browser takes
+        variant_extension = imagevariants.negotiate(
+            extension, request.headers.get("Accept", "")
+        )
+    elif extension in imagevariants.MODERN_FORMATS:
+        variant_extension = extension
+    else:
+        raise Http404()
+    response = await sync_to_async(serve_image_variant)(
+        request, image, width, variant_extension
+    )
+    if extension == image.extension:
+        patch_vary_headers(response, ["Accept"])
+    return response
 
 
 class ImageList(LoginRequiredMixin, FormView):
@@ -787,9 +940,9 @@ class ImageList(LoginRequiredMixin, FormView):
 
         # Total quota in MB (decimal, 1MB = 1,000,000 bytes)
         total_bytes = (
-            models.Image.objects.filter(owner=self.request.user)
-            .aggregate(total=Sum(Length("data")))
-            .get("total")
+            models.ImageUsage.objects.filter(owner=self.request.user)
+            .values_list("total_bytes", flat=True)
+            .first()
             or 0
         )
         context["total_quota"] = round(total_bytes / 1_000_000, 2)
@@ -804,20 +957,31 @@ class ImageList(LoginRequiredMixin, FormView):
             messages.error(request, "Too many files uploaded at once.")
             return self.render_to_response(self.get_context_data())
         if form.is_valid():
-            # calculate current total storage used by user
-            user_total_bytes = (
-                models.Image.objects.filter(owner=self.request.user)
-                .aggregate(total=Sum(Length("data")))
-                .get("total")
-                or 0
-            )
+            # files stored by this upload, deleted again if it fails
+            stored_sha256s = []
+            try:
+                return self.save_images(form, files, stored_sha256s)
+            except Exception:
+                for sha256 in stored_sha256s:
+                    models.Image.delete_unused_file(sha256)
+                raise
+        else:
+            return self.form_invalid(form)
 
+    def save_images(self, form, files, stored_sha256s):
+        with transaction.atomic():
+            # storage used by user, locked so that concurrent uploads
+            # cannot both fit in what is left of the quota
+            usage = imagequota.lock_usage(self.request.user.id)
+            user_total_bytes = usage.total_bytes
+
+            uploads = []
             for f in files:
                 name_ext_parts = f.name.rsplit(".", 1)
                 name = name_ext_parts[0].replace(".", "-")
-                self.extension = name_ext_parts[1].casefold()
-                if self.extension == "jpg":
-                    self.extension = "jpeg"
+                extension = name_ext_parts[1].casefold()
+                if extension == "jpg":
+                    extension = "jpeg"
                 data = f.read()
 
                 # check for file limit
@@ -826,7 +990,7 @@ class ImageList(LoginRequiredMixin, FormView):
                     return self.form_invalid(form)
 
                 # quota limit 1GB total per user
-                if user_total_bytes + len(data) > 1_000_000_000:
+                if user_total_bytes + len(data) > imagequota.QUOTA_BYTES:
                     current_usage_mb = user_total_bytes / 1_000_000
                     form.add_error(
                         "file",
@@ -834,19 +998,28 @@ class ImageList(LoginRequiredMixin, FormView):
                     )
                     return self.form_invalid(form)
 
+                uploads.append((name, extension, data))
+                # increment running total for multiple-file uploads
+                user_total_bytes += len(data)
+
+            # all contents locked up front, as concurrent uploads of the same
+            # files in another order would deadlock locking them one by one
+            imagestore.lock(*(imagestore.get_sha256(data) for _, _, data in uploads))
+            for name, extension, data in uploads:
+                sha256, stored = imagestore.store(data)
+                if stored:
+                    stored_sha256s.append(sha256)
+                self.extension = extension
                 self.slug = str(uuid.uuid4())[:8]
                 models.Image.objects.create(
                     name=name,
-                    data=data,
-                    extension=self.extension,
-                    owner=request.user,
+                    size=len(data),
+                    sha256=sha256,
+                    extension=extension,
+                    owner=self.request.user,
                     slug=self.slug,
                 )
-                # increment running total for multiple-file uploads
-                user_total_bytes += len(data)
-            return self.form_valid(form)
-        else:
-            return self.form_invalid(form)
+        return self.form_valid(form)
 
     def get_success_url(self):
         # if ?raw=true in url, return to image_raw instead of image_list
@@ -875,11 +1048,14 @@ class ImageDetail(LoginRequiredMixin, DetailView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
 
-        # find posts that use this image
-        context["used_by_posts"] = []
-        for post in models.Post.objects.filter(owner=self.request.user):
-            if "/images/" + self.object.filename in post.body:
-                context["used_by_posts"].append(post)
+        # posts that use this image, from their references, see imagerefs
+        context["used_by_posts"] = (
+            models.Post.objects.filter(
+                owner=self.request.user, image_references__image=self.object
+            )
+            .select_related("owner")
+            .defer("body", "body_html", "body_text")
+        )
 
         return context
 
@@ -942,6 +1118,12 @@ class PageCreate(LoginRequiredMixin, SuccessMessageMixin, CreateView):
         return HttpResponseRedirect(self.get_success_url())
 
 
+def _get_page_hit(request, slug):
+    return ("page", request.blog_user_id, request.path.strip("/"))
+
+
+@method_decorator(conditional.blog_conditional(get_hit=_get_page_hit), name="dispatch")
+@method_decorator(pagecache.cache_page, name="dispatch")
 class PageDetail(DetailView):
     model = models.Page
 
@@ -963,8 +1145,8 @@ class PageDetail(DetailView):
             and self.request.user == self.object.owner
         ):
             return context
-        models.AnalyticPage.objects.create(
-            user=self.request.blog_user, path=self.request.path.strip("/")
+        analytics.record_hit(
+            self.request, "page", self.object.owner_id, self.request.path.strip("/")
         )
 
         return context
@@ -1056,20 +1238,19 @@ class AnalyticList(LoginRequiredMixin, TemplateView):
         return context
 
 
-def populate_analytics_context(context, date_25d_ago, current_date, day_counts):
+def populate_analytics_context(
+    context, date_25d_ago, current_date, day_counts, day_visitors=None
+):
     context["date_25d_ago"] = date_25d_ago
+    context["total_count"] = sum(day_counts.values())
     context["analytics_per_day"] = {}
     current_x_offset = 0
 
-    # transform day_counts into dict with date as key
-    count_per_day = defaultdict(int)
-    highest_day_count = 1
-    for item in day_counts:
-        count_per_day[item["created_at"].date()] += item["id__count"]
+    # day_counts is a dict with date as key
+    count_per_day = defaultdict(int, day_counts)
 
-        # find day with the most analytics counts (i.e. visits)
-        if highest_day_count < count_per_day[item["created_at"].date()]:
-            highest_day_count = count_per_day[item["created_at"].date()]
+    # find day with the most analytics counts (i.e. visits)
+    highest_day_count = max([1, *count_per_day.values()])
 
     # calculate analytics count and percentages for each day
     while date_25d_ago <= current_date:
@@ -1083,6 +1264,7 @@ def populate_analytics_context(context, date_25d_ago, current_date, day_counts):
                 count_per_day[current_date]
             ),
             "count_exact": count_per_day[current_date],
+            "visitors": (day_visitors or {}).get(current_date, 0),
             "x_offset": current_x_offset,
             "count_percent": count_percent,
             "negative_count_percent": 100 - count_percent,
@@ -1111,12 +1293,11 @@ class AnalyticPostDetail(LoginRequiredMixin, DetailView):
         date_25d_ago = timezone.now().date() - timedelta(days=24)
 
         # get all counts for the last 25 days
-        day_counts = (
-            models.AnalyticPost.objects.filter(
-                post=self.object, created_at__gt=date_25d_ago
-            )
-            .values("created_at")
-            .annotate(Count("id"))
+        day_counts = rollups.get_day_counts(
+            "post", date_25d_ago, post_id=self.object.id
+        )
+        day_visitors, context["unique_visitors"] = analytics.get_unique_visitors(
+            self.object.id, date_25d_ago
         )
 
         return populate_analytics_context(
@@ -1124,6 +1305,7 @@ class AnalyticPostDetail(LoginRequiredMixin, DetailView):
             date_25d_ago=date_25d_ago,
             current_date=current_date,
             day_counts=day_counts,
+            day_visitors=day_visitors,
         )
 
 
@@ -1131,16 +1313,13 @@ class AnalyticPageDetail(LoginRequiredMixin, DetailView):
     template_name = "main/analytic_detail.html"
 
     def get_object(self):
-        # our object is annotated with counts for the last 25 days
+        # our object is the dict of counts for the last 25 days
         date_25d_ago = timezone.now().date() - timedelta(days=24)
-        return (
-            models.AnalyticPage.objects.filter(
-                user=self.request.user,
-                path=self.kwargs["page_path"],
-                created_at__gt=date_25d_ago,
-            )
-            .values("created_at")
-            .annotate(Count("id"))
+        return rollups.get_day_counts(
+            "page",
+            date_25d_ago,
+            user_id=self.request.user.id,
+            path=self.kwargs["page_path"],
         )
 
     def get_context_data(self, **kwargs):
@@ -1549,6 +1728,7 @@ def transparency(request):
     )
 
 
+@conditional.blog_conditional()
 def sitemap(request):
     if not hasattr(request, "subdomain"):
         raise Http404()
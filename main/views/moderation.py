@@ -4,7 +4,6 @@ from urllib.parse import urlencode
 from django.conf import settings
 from django.core.paginator import EmptyPage, PageNotAnInteger, Paginator
 from django.db.models import Avg, Count, F, Max, Q, Sum
-from django.db.models.expressions import Func
 from django.db.models.functions import (
     Coalesce,
     Length,
@@ -16,7 +15,7 @@ from django.http import Http404, JsonResponse
 from django.shortcuts import get_object_or_404, redirect, render
 from django.utils import timezone
 
-from main import models
+from main import models, rollups
 
 
 def index(request):
@@ -177,10 +176,13 @@ def images_leaderboard(request):
     sort_by_mb = "bymb" in current_modes
     reverse = "reverse" in current_modes
 
-    users_with_counts = models.User.objects.annotate(
-        image_count=Count("image"),
-        image_bytes=Sum(Func(F("image__data"), function="octet_length")),
-    ).filter(image_count__gt=0)
+    # from the kept totals, rather than adding up the images of every user
+    users_with_counts = models.User.objects.filter(
+        image_usage__image_count__gt=0
+    ).annotate(
+        image_count=F("image_usage__image_count"),
+        image_bytes=F("image_usage__total_bytes"),
+    )
 
     if sort_by_mb:
         ordering = ["image_bytes", "id"] if reverse else ["-image_bytes", "-id"]
@@ -410,7 +412,7 @@ def stats(request):
     # Images
     image_stats = models.Image.objects.aggregate(
         count=Count("id"),
-        total_bytes=Sum(Func(F("data"), function="octet_length")),
+        total_bytes=Sum("size"),
     )
     total_images = image_stats["count"] or 0
     total_image_megabytes = round((image_stats["total_bytes"] or 0) / (1024 * 1024), 2)
@@ -712,18 +714,12 @@ def summary(request, date_str: str):
         .order_by("-created_at")
     )
 
-    post_visits_count = models.AnalyticPost.objects.filter(
-        created_at__date=target_date
-    ).count()
-    top_posts_by_visits_qs = (
-        models.Post.objects.filter(analyticpost__created_at__date=target_date)
-        .annotate(
-            visit_count=Count(
-                "analyticpost", filter=Q(analyticpost__created_at__date=target_date)
-            )
-        )
-        .select_related("owner")
-        .order_by("-visit_count", "-id")
+    post_visits_count = rollups.get_total("post", target_date)
+    bot_visits_count = (
+        models.AnalyticBotDay.objects.filter(date=target_date)
+        .values_list("count", flat=True)
+        .first()
+        or 0
     )
 
     context = {
@@ -736,12 +732,13 @@ def summary(request, date_str: str):
             "pages": new_pages_qs.count(),
             "comments": new_comments_qs.count(),
             "post_visits": post_visits_count,
+            "bot_visits": bot_visits_count,
         },
         "new_users": list(new_users_qs),
         "new_posts": list(new_posts_qs),
         "new_pages": list(new_pages_qs),
         "new_comments": list(new_comments_qs),
-        "top_posts_by_visits": list(top_posts_by_visits_qs[:20]),
+        "top_posts_by_visits": rollups.get_top_posts(20, target_date),
     }
 
     return render(request, "main/moderation_summary.html", context)
@@ -763,33 +760,11 @@ def top_posts_alltime(request):
     if top_limit <= 0:
         top_limit = default_limit
 
-    # Aggregate from AnalyticPost directly - faster than annotating all Posts
-    visits_by_post = (
-        models.AnalyticPost.objects.values("post_id")
-        .annotate(visit_count=Count("id"))
-        .order_by("-visit_count")[:top_limit]
-    )
-
-    # Build lookup of post_id -> visit_count
-    post_ids = []
-    visit_counts = {}
-    for row in visits_by_post:
-        post_id = row["post_id"]
-        post_ids.append(post_id)
-        visit_counts[post_id] = row["visit_count"]
-
-    # Fetch posts with owners
-    posts = models.Post.objects.filter(id__in=post_ids).select_related("owner")
-
-    # Attach visit counts and sort by visits desc
-    post_list = []
-    for p in posts:
-        p.visit_count = visit_counts.get(p.id, 0)
-        post_list.append(p)
-    post_list.sort(key=lambda x: (-x.visit_count, -x.id))
+    # Read from the daily rollups - raw analytics are too many to count
+    post_list = rollups.get_top_posts(top_limit)
 
     # total visits count
-    total_visits = models.AnalyticPost.objects.count()
+    total_visits = rollups.get_total("post")
 
     context = {
         "post_list": post_list,
@@ -816,20 +791,15 @@ def top_blogs_alltime(request):
     if top_limit <= 0:
         top_limit = default_limit
 
-    # Aggregate from AnalyticPost directly - much faster than joining through User
-    visits_by_owner = (
-        models.AnalyticPost.objects.values("post__owner_id")
-        .annotate(visit_count=Count("id"))
-        .order_by("-visit_count")[:top_limit]
-    )
+    # Read from the daily rollups - raw analytics are too many to count
+    visits_by_owner = rollups.get_top_counts("post", ["post__owner_id"], top_limit)
 
     # Build lookup of owner_id -> visit_count
     owner_ids = []
     visit_counts = {}
-    for row in visits_by_owner:
-        owner_id = row["post__owner_id"]
+    for (owner_id,), visit_count in visits_by_owner:
         owner_ids.append(owner_id)
-        visit_counts[owner_id] = row["visit_count"]
+        visit_counts[owner_id] = visit_count
 
     # Fetch users
     users = models.User.objects.filter(id__in=owner_ids)
@@ -842,7 +812,7 @@ def top_blogs_alltime(request):
     user_list.sort(key=lambda x: (-x.visit_count, -x.id))
 
     # total visits count
-    total_visits = models.AnalyticPost.objects.count()
+    total_visits = rollups.get_total("post")
 
     context = {
         "user_list": user_list,
@@ -869,31 +839,27 @@ def top_pages_alltime(request):
     if top_limit <= 0:
         top_limit = default_limit
 
-    # Aggregate from AnalyticPage by user and path
-    visits_by_page = (
-        models.AnalyticPage.objects.values("user_id", "path")
-        .annotate(visit_count=Count("id"))
-        .order_by("-visit_count")[:top_limit]
-    )
+    # Read from the daily rollups by user and path
+    visits_by_page = rollups.get_top_counts("page", ["user_id", "path"], top_limit)
 
     # Build list with user info
-    user_ids = set(row["user_id"] for row in visits_by_page)
+    user_ids = set(user_id for (user_id, _), _ in visits_by_page)
     users = {u.id: u for u in models.User.objects.filter(id__in=user_ids)}
 
     page_list = []
-    for row in visits_by_page:
-        user = users.get(row["user_id"])
+    for (user_id, path), visit_count in visits_by_page:
+        user = users.get(user_id)
         if user:
             page_list.append(
                 {
                     "user": user,
-                    "path": row["path"],
-                    "visit_count": row["visit_count"],
+                    "path": path,
+                    "visit_count": visit_count,
                 }
             )
 
     # total page visits count
-    total_visits = models.AnalyticPage.objects.count()
+    total_visits = rollups.get_total("page")
 
     context = {
         "page_list": page_list,
@@ -0,0 +1,56 @@
+"""
+Zip archives written while they are sent, eg. in a StreamingHttpResponse, so
+that no archive is ever held whole in memory.
+
+Entries are written with zipfile, to an output it cannot seek back in, so that
+each entry is followed by a data descriptor with its size and CRC, as zipfile
+does for any unseekable output.
+"""
+
+import zipfile
+
+# bytes read at once from file objects of entries
+CHUNK_SIZE = 64 * 1024
+
+
+class _Output:
+    """Write-only file object holding what is written until taken."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def iter_zip(entries, compression=zipfile.ZIP_DEFLATED):
+    """
+    Yield the bytes of a zip archive of entries, an iterable of tuples of name
+    and data, where data is a string, bytes or a binary file object, which is
+    read in chunks and closed. Entries are only taken as the archive is
+    written, so they can be generated lazily too.
+    """
+    output = _Output()
+    with zipfile.ZipFile(output, "w", compression) as archive:
+        for name, data in entries:
+            if isinstance(data, str | bytes):
+                archive.writestr(name, data)
+            else:
+                with data, archive.open(name, "w") as entry:
+                    while chunk := data.read(CHUNK_SIZE):
+                        entry.write(chunk)
+                        if written := output.take():
+                            yield written
+            if written := output.take():
+                yield written
+    # the central directory
+    yield output.take()
@@ -126,6 +126,55 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/6.0/topics/cache/
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    # host to blog user resolutions of host_middleware, per gunicorn worker;
+    # invalidated on user changes in the same worker, expire in the others
+    "hosts": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "hosts",
+        "TIMEOUT": int(os.getenv("HOSTS_CACHE_TIMEOUT", "60")),
+        "OPTIONS": {"MAX_ENTRIES": 20_000},
+    },
+    # whole blog pages served to anonymous visitors, see main/pagecache.py;
+    # eg. django.core.cache.backends.filebased.FileBasedCache and a directory
+    # as location to share one cache between workers
+    "pages": {
+        "BACKEND": os.getenv(
+            "PAGES_CACHE_BACKEND", "django.core.cache.backends.locmem.LocMemCache"
+        ),
+        "LOCATION": os.getenv("PAGES_CACHE_LOCATION", "pages"),
+        "TIMEOUT": int(os.getenv("PAGES_CACHE_TIMEOUT", "600")),
+        "OPTIONS": {"MAX_ENTRIES": 5_000},
+    },
+}
+
+
+# Analytics
+# hits are buffered per worker and saved in batches, see main/analytics.py;
+# in development, and tests, a buffer size of 1 saves every hit as it happens
+
+ANALYTICS_BUFFER_SIZE = int(
+    os.getenv("ANALYTICS_BUFFER_SIZE", "1" if DEBUG or LOCALDEV else "50")
+)
+ANALYTICS_BUFFER_MAX = int(os.getenv("ANALYTICS_BUFFER_MAX", "10000"))
+ANALYTICS_FLUSH_INTERVAL = float(os.getenv("ANALYTICS_FLUSH_INTERVAL", "10"))
+
+# visits per minute above which further visits of an IP address are counted as
+# bot visits, see main/bots.py; 0 classifies by User-Agent only
+ANALYTICS_BOT_IP_RATE = int(os.getenv("ANALYTICS_BOT_IP_RATE", "0"))
+
+# days raw analytics are kept for, after which partitionanalytics drops their
+# monthly partitions and compactanalytics deletes them from the legacy one, as
+# long as they are counted in the daily rollups, see main/rollups.py
+ANALYTICS_RETENTION_DAYS = int(os.getenv("ANALYTICS_RETENTION_DAYS", "90"))
+
+
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
 
@@ -169,6 +218,14 @@ STORAGES = {
     "staticfiles": {
         "BACKEND": "django.contrib.staticfiles.storage.ManifestStaticFilesStorage",
     },
+    # uploaded image files, see main/imagestore.py; an S3-compatible storage,
+    # eg. storages.backends.s3.S3Storage of django-storages, can replace it
+    "images": {
+        "BACKEND": "django.core.files.storage.FileSystemStorage",
+        "OPTIONS": {
+            "location": os.getenv("IMAGES_ROOT", BASE_DIR / "images"),
+        },
+    },
 }
 
 